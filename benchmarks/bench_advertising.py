@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+"""
+Time to discovery against advertising duty cycle for a constant fast,
+a constant slow and the adaptive (fast burst, then slow) advertising
+plan, simulated: advertising events every interval plus the 0-10 ms
+random advDelay of the spec, a phone that starts scanning at a uniformly
+random time within --horizon seconds of arming, and scanner windows of
+common Android scan modes. An event is seen when it starts inside a scan
+window.
+
+    python3 benchmarks/bench_advertising.py [-n 2000] [--horizon 120] [--seed 1]
+"""
+import argparse
+import random
+
+from common import latency_stats, report
+
+from pisugar_wifi_config.advertising import (FAST_INTERVAL, FAST_TIME, SLOW_INTERVAL, STOPPED,
+                                              AdvertisingPlan)
+
+# ms; ADV_IND on the 3 primary channels with ~150 us between them
+EVENT_AIRTIME = 1.5
+MAX_ADV_DELAY = 10.0
+GIVE_UP = 60000.0
+
+# (scan window, scan interval) in ms
+SCANNERS = {
+    'low_latency': (4096, 4096),
+    'balanced': (1024, 4096),
+    'low_power': (512, 5120),
+}
+
+
+def plans():
+    return {
+        'fast': AdvertisingPlan(0, FAST_INTERVAL, FAST_INTERVAL),
+        'slow': AdvertisingPlan(0, SLOW_INTERVAL, SLOW_INTERVAL),
+        'adaptive': AdvertisingPlan(FAST_TIME, FAST_INTERVAL, SLOW_INTERVAL),
+    }
+
+
+def interval_at(plan, ms):
+    phase, interval = plan.phase_at(ms / 1000.0)
+    return None if phase == STOPPED else interval
+
+
+def discovery_ms(plan, scanner, start, rng):
+    """
+    ms from `start` (ms after arming) to the first advertising event inside
+    a scan window, or None if not seen within GIVE_UP.
+    """
+    window, period = scanner
+    phase = rng.uniform(0, period)
+    interval = interval_at(plan, start)
+    if interval is None:
+        return None
+    t = start + rng.uniform(0, interval + MAX_ADV_DELAY)
+    while t - start < GIVE_UP:
+        if (t - start + phase) % period < window:
+            return t - start
+        interval = interval_at(plan, t)
+        if interval is None:
+            return None
+        t += interval + rng.uniform(0, MAX_ADV_DELAY)
+    return None
+
+
+def duty_cycle(plan, horizon):
+    """
+    Mean fraction of time on air over the first `horizon` seconds.
+    """
+    airtime = 0.0
+    changes = plan.changes() + [(horizon, STOPPED, None)]
+    for (at, phase, interval), (end, _, _) in zip(changes, changes[1:]):
+        if at >= horizon or phase == STOPPED:
+            continue
+        end = min(end, horizon)
+        airtime += (end - at) * 1000 / (interval + MAX_ADV_DELAY / 2) * EVENT_AIRTIME
+    return airtime / (horizon * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='advertising plan simulation')
+    parser.add_argument('-n', dest='iterations', type=int, default=2000)
+    parser.add_argument('--horizon', dest='horizon', type=float, default=120,
+                        help='Seconds after arming within which the phone starts scanning')
+    parser.add_argument('--seed', dest='seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {'iterations': args.iterations, 'horizon_s': args.horizon}
+    for name, plan in sorted(plans().items()):
+        result = {'duty_cycle_pct': duty_cycle(plan, args.horizon) * 100}
+        for scanner_name, scanner in sorted(SCANNERS.items()):
+            samples = []
+            missed = 0
+            for _ in range(args.iterations):
+                found = discovery_ms(plan, scanner, rng.uniform(0, args.horizon * 1000), rng)
+                if found is None:
+                    missed += 1
+                else:
+                    samples.append(found)
+            stats = latency_stats(samples)
+            result[scanner_name] = {
+                'mean_ms': stats['mean_ms'],
+                'median_ms': stats['median_ms'],
+                'p95_ms': stats['p95_ms'],
+                'missed': missed,
+            }
+        results[name] = result
+    report('advertising', results)
+
+
+if __name__ == '__main__':
+    main()
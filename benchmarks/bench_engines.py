@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+"""
+Compare RSS and thread count of the GLib and asyncio engines.
+
+Each engine is started against the system bus (BlueZ, or any bus given by
+DBUS_SYSTEM_BUS_ADDRESS), sampled for a while after startup, then stopped.
+
+    python3 benchmarks/bench_engines.py [-d 10] [--engine glib --engine asyncio]
+"""
+import argparse
+import signal
+import subprocess
+import sys
+import time
+
+from common import ROOT, proc_status, report
+
+
+def sample_engine(engine, duration, interval):
+    proc = subprocess.Popen([sys.executable, '-c',
+                             'from pisugar_wifi_config import main; main()',
+                             '--engine', engine], cwd=ROOT,
+                            stdout=subprocess.DEVNULL)
+    samples = []
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline and proc.poll() is None:
+            samples.append(proc_status(proc.pid))
+            time.sleep(interval)
+    finally:
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+    if not samples:
+        return {'error': 'exited with %s' % proc.returncode}
+    return {
+        'samples': len(samples),
+        'rss_kb_max': max(s['rss_kb'] for s in samples),
+        'rss_kb_last': samples[-1]['rss_kb'],
+        'threads_max': max(s['threads'] for s in samples),
+        'threads_last': samples[-1]['threads'],
+        'exited_early': proc.returncode not in (None, 0, -signal.SIGINT),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='engine resource usage')
+    parser.add_argument('-d', dest='duration', type=float, default=10)
+    parser.add_argument('-i', dest='interval', type=float, default=0.5)
+    parser.add_argument('--engine', dest='engines', action='append')
+    args = parser.parse_args()
+
+    results = {}
+    for engine in args.engines or ['glib', 'asyncio']:
+        results[engine] = sample_engine(engine, args.duration, args.interval)
+    report('engines', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""
+End to end over D-Bus: starts a private dbus-daemon with the stand-in
+BlueZ of fake_bluez.py and a fake wpa_supplicant, runs the server
+against them as a subprocess and measures, as seen from BlueZ:
+
+    - startup: process spawn to RegisterApplication and
+      RegisterAdvertisement done
+    - GetManagedObjects latency
+    - WriteValue throughput of MTU-sized credential chunks on InputSepChrc
+    - CommandChrc round trip of a command, from the write to its END frame
+    - notification rate of a command with a large output
+    - recovery from a bluetoothd restart: a new org.bluez owner to the
+      application and advertisement registered again
+
+Needs dbus-daemon and dbus-next, and for the glib engine dbus-python and
+PyGObject.
+
+    python3 benchmarks/bench_gatt.py [--engine glib|asyncio] [-n 50] [--mtu 185]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT, measure_async, proc_status, report
+from fake_bluez import FakeBluez, PrivateBus
+from fake_wpa_supplicant import FakeWpaSupplicant
+
+from pisugar_wifi_config.commands import END_PAYLOAD, FRAME_END, FRAME_HEADER, FRAME_STDOUT
+# gatt.py imports neither dbus-python nor GLib
+from pisugar_wifi_config.gatt import END, INPUT_SEP as INPUT_SEP_UUID, SEP, SSH_CHRC as COMMAND_UUID
+
+KEY = 'pisugar'
+STARTUP_TIMEOUT = 30
+LARGE_OUTPUT = 64 * 1024
+
+
+class CommandClient(object):
+    """
+    Collects CommandChrc notifications; wait_end() returns the frames of
+    the next finished command.
+    """
+    def __init__(self):
+        self.frames = []
+        self.ended = asyncio.Queue()
+
+    def on_notify(self, uuid, value):
+        if uuid != COMMAND_UUID:
+            return
+        self.frames.append(value)
+        if value[FRAME_HEADER.size - 1] == FRAME_END:
+            frames, self.frames = self.frames, []
+            self.ended.put_nowait(frames)
+
+    async def wait_end(self, timeout=10):
+        return await asyncio.wait_for(self.ended.get(), timeout)
+
+
+def end_of(frames):
+    returncode, reason = END_PAYLOAD.unpack(frames[-1][FRAME_HEADER.size:])
+    return returncode, reason
+
+
+async def run_command(bluez, client, cmd, mtu):
+    await bluez.write_value(COMMAND_UUID, cmd.encode(), mtu)
+    frames = await client.wait_end()
+    returncode, reason = end_of(frames)
+    if returncode != 0:
+        raise RuntimeError('%r ended with %d (reason %d)' % (cmd, returncode, reason))
+    return frames
+
+
+async def bench(args, directory, address):
+    bluez = await FakeBluez(address).start()
+    client = CommandClient()
+    bluez.on_notify = client.on_notify
+
+    env = dict(os.environ, DBUS_SYSTEM_BUS_ADDRESS=address, PYTHONUNBUFFERED='1')
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (ROOT, env.get('PYTHONPATH')) if p)
+    log = open(os.path.join(directory, 'server.log'), 'w')
+    started = time.monotonic()
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'import pisugar_wifi_config as p; p.main()',
+         '--engine', args.engine, '--key', KEY,
+         '--wpa-ctrl-dir', directory,
+         '--wpa-config', os.path.join(directory, 'wpa_supplicant.conf'),
+         '--stats-file', os.path.join(directory, 'provisioning.json'),
+         '--metrics-socket', os.path.join(directory, 'metrics.sock')],
+        env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        try:
+            await asyncio.wait_for(asyncio.gather(bluez.registered.wait(),
+                                                  bluez.advertised.wait()), STARTUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError('server did not register, see %s' % log.name)
+        results = {
+            'engine': args.engine,
+            'mtu': args.mtu,
+            'startup': {
+                'registered_ms': (bluez.registered_at - started) * 1000,
+                'advertised_ms': (bluez.advertised_at - started) * 1000,
+            },
+        }
+
+        objects = await bluez.get_managed_objects()
+        results['get_managed_objects'] = await measure_async(bluez.get_managed_objects,
+                                                             args.iterations)
+        results['get_managed_objects']['objects'] = len(objects)
+
+        message = (KEY + SEP + 'PiSugar' + SEP + 'password' + END).encode()
+        size = args.mtu - 3
+        chunks = [message[i:i + size] for i in range(0, len(message), size)]
+
+        async def write_credentials():
+            for chunk in chunks:
+                await bluez.write_value(INPUT_SEP_UUID, chunk, args.mtu)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            await write_credentials()
+        elapsed = time.perf_counter() - start
+        results['input_sep_write'] = {
+            'iterations': args.iterations,
+            'chunks_per_message': len(chunks),
+            'messages_per_s': args.iterations / elapsed,
+            'writes_per_s': args.iterations * len(chunks) / elapsed,
+        }
+
+        await bluez.start_notify(COMMAND_UUID)
+        await run_command(bluez, client, 'true', args.mtu)
+        results['command_round_trip'] = await measure_async(
+            lambda: run_command(bluez, client, 'true', args.mtu), args.iterations)
+        results['command_round_trip']['commands_per_s'] = (
+            1000.0 / results['command_round_trip']['mean_ms'])
+
+        start = time.perf_counter()
+        frames = await run_command(bluez, client, 'head -c %d /dev/zero | tr "\\0" x' % (
+            LARGE_OUTPUT), args.mtu)
+        elapsed = time.perf_counter() - start
+        output = sum(len(f) - FRAME_HEADER.size for f in frames
+                     if f[FRAME_HEADER.size - 1] == FRAME_STDOUT)
+        assert output == LARGE_OUTPUT, output
+        results['notifications'] = {
+            'output_bytes': output,
+            'notifications': len(frames),
+            'notifications_per_s': len(frames) / elapsed,
+            'bytes_per_s': output / elapsed,
+        }
+
+        bluez.stop()
+        restarted = time.monotonic()
+        bluez = await FakeBluez(address).start()
+        try:
+            await asyncio.wait_for(asyncio.gather(bluez.registered.wait(),
+                                                  bluez.advertised.wait()), STARTUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise RuntimeError('server did not register again, see %s' % log.name)
+        results['restart'] = {
+            'registered_ms': (bluez.registered_at - restarted) * 1000,
+            'advertised_ms': (bluez.advertised_at - restarted) * 1000,
+        }
+        results['server'] = proc_status(server.pid)
+        return results
+    finally:
+        server.terminate()
+        try:
+            # the loop keeps running, the server unregisters on the way out
+            await asyncio.get_event_loop().run_in_executor(None, server.wait, 5)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        log.close()
+        bluez.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GATT server benchmark against a fake BlueZ')
+    parser.add_argument('--engine', dest='engine', choices=['glib', 'asyncio'], default='glib')
+    parser.add_argument('-n', dest='iterations', type=int, default=50)
+    parser.add_argument('--mtu', dest='mtu', type=int, default=185)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-gatt-')
+    private_bus = PrivateBus().start()
+    wpa = FakeWpaSupplicant(directory).start()
+    try:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        results = loop.run_until_complete(bench(args, directory, private_bus.address))
+        loop.close()
+    finally:
+        wpa.stop()
+        private_bus.stop()
+    shutil.rmtree(directory, ignore_errors=True)
+    report('gatt', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+"""
+Per-call cost of the metrics wrapper put around GATT methods, with
+metrics enabled and disabled (--no-metrics), against an unwrapped call.
+
+    python3 benchmarks/bench_metrics.py [-n 100000]
+"""
+import argparse
+import time
+
+from common import report
+
+from pisugar_wifi_config.metrics import metrics, timed
+
+
+def handler(value, options):
+    return value
+
+
+def per_call_ns(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(b'x', {})
+    return (time.perf_counter() - start) * 1e9 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='metrics overhead benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    wrapped = timed('WriteValue', 'Bench')(handler)
+    plain_ns = per_call_ns(handler, args.iterations)
+    metrics.enabled = True
+    enabled_ns = per_call_ns(wrapped, args.iterations)
+    metrics.enabled = False
+    disabled_ns = per_call_ns(wrapped, args.iterations)
+    metrics.enabled = True
+
+    rendered = metrics.render()
+    assert 'pisugar_gatt_call_seconds_count{method="WriteValue",object="Bench"} %d' % (
+        args.iterations) in rendered
+    report('metrics', {
+        'iterations': args.iterations,
+        'plain_ns': plain_ns,
+        'enabled_ns': enabled_ns,
+        'disabled_ns': disabled_ns,
+        'overhead_enabled_ns': enabled_ns - plain_ns,
+        'overhead_disabled_ns': disabled_ns - plain_ns,
+    })
+
+
+if __name__ == '__main__':
+    main()
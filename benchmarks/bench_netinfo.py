@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+"""
+Compare the in-process network state reader with the old
+iwconfig/ifconfig subprocess path.
+
+    python3 benchmarks/bench_netinfo.py [-i wlan0] [-n 200]
+"""
+import argparse
+import re
+import subprocess
+
+from common import measure, report
+
+from pisugar_wifi_config.netinfo import read_network_state
+
+
+def subprocess_state(ifname):
+    ssid = None
+    output = subprocess.check_output(['iwconfig', ifname]).decode()
+    for line in output.split('\n'):
+        matches = re.match(r'.*ESSID:"(.*)"', line, re.M|re.I)
+        if matches:
+            ssid = matches.group(1)
+            break
+    ip_addr = None
+    output = subprocess.check_output(['ifconfig', ifname]).decode()
+    for line in output.split('\n'):
+        matches = re.match(r'.*inet6?\s(\S*)\s.*', line, re.M|re.I)
+        if matches:
+            ip_addr = matches.group(1)
+            break
+    return ssid, ip_addr
+
+
+def main():
+    parser = argparse.ArgumentParser(description='netinfo microbenchmark')
+    parser.add_argument('-i', '--iface', dest='iface', default='wlan0')
+    parser.add_argument('-n', dest='iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    results = {
+        'iface': args.iface,
+        'state': read_network_state(args.iface)._asdict(),
+        'native': measure(lambda: read_network_state(args.iface), args.iterations),
+    }
+    try:
+        results['subprocess'] = measure(lambda: subprocess_state(args.iface),
+                                        max(1, args.iterations // 10))
+        results['speedup'] = results['subprocess']['median_ms'] / \
+            max(results['native']['median_ms'], 1e-6)
+    except (OSError, subprocess.CalledProcessError) as e:
+        results['subprocess'] = None
+        results['subprocess_error'] = str(e)
+
+    report('netinfo', results)
+
+
+if __name__ == '__main__':
+    main()
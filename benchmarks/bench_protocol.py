@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+"""
+Binary provisioning messages against the legacy 'key%&%ssid%&%password&#&'
+text: bytes on the wire, ATT writes needed at a few MTUs and decode time.
+
+    python3 benchmarks/bench_protocol.py [-n 100000] [--mtu 23 185 247]
+"""
+import argparse
+import time
+
+from common import report
+
+from pisugar_wifi_config.protocol import SECURITY_SAE, decode_request, encode_request
+from pisugar_wifi_config.psk import derive_psk
+from pisugar_wifi_config.reassembly import frame
+
+SEP = '%&%'
+END = '&#&'
+ATT_WRITE_HEADER_SIZE = 3
+
+# key, ssid, passphrase, send the derived PSK, binary only options
+CREDENTIALS = {
+    'typical': ('pisugar', 'HomeNetwork-5G', 'correct horse battery', False, {}),
+    'typical_options': ('pisugar', 'HomeNetwork-5G', 'correct horse battery', False,
+                        {'security': SECURITY_SAE, 'hidden': True, 'priority': 5}),
+    'derived_psk': ('pisugar', 'HomeNetwork-5G', 'correct horse battery', True, {}),
+    'long': ('a-longer-secret-key', 'x' * 32, 'p' * 63, False, {}),
+}
+
+
+def writes(size, mtu):
+    return -(-size // (mtu - ATT_WRITE_HEADER_SIZE))
+
+
+def per_call_ns(fn, msg, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(msg)
+    return (time.perf_counter() - start) * 1e9 / iterations
+
+
+def legacy_decode(msg):
+    return msg[:-len(END)].decode('utf8').split(SEP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='provisioning message benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=100000)
+    parser.add_argument('--mtu', dest='mtus', type=int, nargs='+', default=[23, 185, 247])
+    args = parser.parse_args()
+
+    results = {}
+    for name, (key, ssid, password, derived, options) in sorted(CREDENTIALS.items()):
+        if derived:
+            psk = derive_psk(ssid, password)
+            legacy = (key + SEP + ssid + SEP + psk + END).encode()
+            binary = encode_request(key, ssid, psk=bytes.fromhex(psk), **options)
+            password = psk
+        else:
+            legacy = (key + SEP + ssid + SEP + password + END).encode()
+            binary = encode_request(key, ssid, password, **options)
+        framed = frame(binary)
+        request = decode_request(binary)
+        assert (request.key, request.ssid, request.password) == (key, ssid, password)
+        results[name] = {
+            'legacy_bytes': len(legacy),
+            'binary_bytes': len(binary),
+            'framed_bytes': len(framed),
+            'legacy_decode_ns': per_call_ns(legacy_decode, legacy, args.iterations),
+            'binary_decode_ns': per_call_ns(decode_request, binary, args.iterations),
+        }
+        for mtu in args.mtus:
+            results[name]['writes_mtu_%d' % mtu] = {
+                'legacy': writes(len(legacy), mtu),
+                'framed': writes(len(framed), mtu),
+            }
+    report('protocol', results)
+
+
+if __name__ == '__main__':
+    main()
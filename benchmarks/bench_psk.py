@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+"""
+WPA PSK derivation cost on this machine: PBKDF2 itself, a cache hit, and
+how long PskDeriver.submit() (what the write handler calls) takes while
+the worker is busy deriving.
+
+    python3 benchmarks/bench_psk.py [-n 20]
+"""
+import argparse
+import threading
+
+from common import measure, report
+
+from pisugar_wifi_config.psk import PskDeriver, derive_psk
+
+# IEEE 802.11i-2004, H.4.1
+TEST_VECTOR = ('IEEE', 'password',
+               'f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PSK derivation benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    ssid, passphrase, expected = TEST_VECTOR
+    assert derive_psk(ssid, passphrase) == expected
+
+    deriver = PskDeriver()
+    deriver.psk(ssid, passphrase)
+
+    # the worker derives a new PSK on every callback; submit must not wait
+    done = threading.Semaphore(0)
+    counter = [0]
+
+    def submit():
+        counter[0] += 1
+        deriver.submit('ssid-%d' % counter[0], passphrase, lambda psk: done.release())
+
+    submit_ms = measure(submit, args.iterations, warmup=0)
+    for _ in range(args.iterations):
+        done.acquire()
+
+    report('psk', {
+        'derive': measure(lambda: derive_psk(ssid, passphrase), args.iterations),
+        'cached': measure(lambda: deriver.psk(ssid, passphrase), args.iterations),
+        'submit_while_deriving': submit_ms,
+        'cache_hits': deriver.cache.hits,
+        'cache_misses': deriver.cache.misses,
+    })
+
+
+if __name__ == '__main__':
+    main()
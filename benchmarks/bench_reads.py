@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""
+Long characteristic reads: encoding the whole value on every read against
+ReadBuffer slices, for the read + blob reads a central makes per MTU.
+Every MTU/offset combination is checked to give back the value.
+
+    python3 benchmarks/bench_reads.py [-s 512] [-n 200]
+"""
+import argparse
+
+from common import measure, report
+
+from pisugar_wifi_config.reassembly import InvalidOffset
+from pisugar_wifi_config.values import ReadBuffer
+
+MTUS = [23, 64, 185, 247, 517]
+
+
+def legacy(value, mtu):
+    data = b''
+    while True:
+        # the old ReadValue: whole value, BlueZ keeps MTU - 1 bytes at offset
+        part = value.encode()[len(data):len(data) + mtu - 1]
+        data += part
+        if len(part) < mtu - 1:
+            return data
+
+
+def sliced(buf, value, mtu):
+    data = b''
+    while True:
+        part = buf.read(value, len(data), mtu)
+        data += part
+        if len(part) < mtu - 1:
+            return data
+
+
+def check(value):
+    buf = ReadBuffer()
+    data = value.encode()
+    for mtu in MTUS:
+        assert sliced(buf, value, mtu) == data
+        for offset in range(0, len(data) + 1, 7):
+            assert buf.read(value, offset, mtu) == data[offset:offset + mtu - 1]
+    assert buf.read(value) == data
+    assert buf.read(value, len(data), 23) == b''
+    try:
+        buf.read(value, len(data) + 1, 23)
+    except InvalidOffset:
+        pass
+    else:
+        raise AssertionError('read past the end accepted')
+    assert buf.read(value + 'x', 0) == data + b'x'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='offset read benchmark')
+    parser.add_argument('-s', dest='size', type=int, default=512,
+                        help='value length in characters')
+    parser.add_argument('-n', dest='iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    value = ('PiSugar 3 Plus ' * args.size)[:args.size]
+    check(value)
+    buf = ReadBuffer()
+    results = {}
+    for mtu in MTUS:
+        results[str(mtu)] = {
+            'reads': len(value.encode()) // (mtu - 1) + 1,
+            'legacy': measure(lambda: legacy(value, mtu), args.iterations),
+            'read_buffer': measure(lambda: sliced(buf, value, mtu), args.iterations),
+        }
+    report('offset_reads', results)
+
+
+if __name__ == '__main__':
+    main()
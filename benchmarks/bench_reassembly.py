@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+"""
+Reassembly of long InputSepChrc writes: the old bytes-concatenation path
+against MessageReassembler, for payloads of many ATT-sized chunks.
+
+    python3 benchmarks/bench_reassembly.py [-c 20] [-n 50]
+"""
+import argparse
+
+from common import measure, report
+
+from pisugar_wifi_config.gatt import END
+from pisugar_wifi_config.reassembly import MessageReassembler, frame
+
+SIZES = [64, 512, 4096, 16384]
+
+
+def chunks_of(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def legacy(chunks):
+    full_msg = b''
+    for value in chunks:
+        msg = bytes([x for x in value])
+        full_msg += msg
+        try:
+            decoded = full_msg.decode('utf8')
+            if decoded.endswith(END):
+                return decoded.split(END)[0]
+        except UnicodeDecodeError:
+            pass
+
+
+def reassembled(reassembler, chunks):
+    for value in chunks:
+        messages = reassembler.feed(value)
+        if messages:
+            return messages[0].decode('utf8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='reassembly benchmark')
+    parser.add_argument('-c', dest='chunk', type=int, default=20,
+                        help='chunk size, ATT MTU - 3')
+    parser.add_argument('-n', dest='iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    results = {}
+    for size in SIZES:
+        text = ('pisugar%&%ssid%&%' + 'pässwörd' * size)[:size]
+        payload = (text + END).encode()
+        chunks = chunks_of(payload, args.chunk)
+        framed_chunks = chunks_of(frame(text.encode()), args.chunk)
+        reassembler = MessageReassembler(END.encode(), max_size=2 * len(payload))
+
+        assert reassembled(reassembler, chunks) == text
+        results[str(size)] = {
+            'chunks': len(chunks),
+            'legacy': measure(lambda: legacy(chunks), args.iterations),
+            'end_marker': measure(lambda: reassembled(reassembler, chunks), args.iterations),
+            'length_prefixed': measure(lambda: reassembled(reassembler, framed_chunks),
+                                       args.iterations),
+        }
+    report('reassembly', results)
+
+
+if __name__ == '__main__':
+    main()
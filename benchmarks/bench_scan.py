@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+Scan results: time to scan and page through the BSS table of a fake
+wpa_supplicant holding a large venue's worth of BSSes, then bytes and
+notifications of a snapshot against the diffs of the following scans,
+with a few BSSes appearing, leaving and changing signal each time.
+
+    python3 benchmarks/bench_scan.py [-b 300] [-r 20] [--mtu 23 185] [--seed 1]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+
+from common import measure, report
+from fake_wpa_supplicant import FakeWpaSupplicant
+
+from pisugar_wifi_config.scan import (ScanResults, ScanStream, chunk_size, decode_records,
+                                      encode_snapshot)
+
+FLAGS = ['[WPA2-PSK-CCMP][ESS]', '[WPA-PSK-TKIP][WPA2-PSK-CCMP][ESS]', '[RSN-SAE-CCMP][ESS]',
+         '[WPA2-EAP-CCMP][ESS]', '[ESS]']
+
+
+def random_bss(rng, index):
+    return {
+        'bssid': ':'.join('%02x' % b for b in [0x02, index >> 8 & 0xff, index & 0xff] +
+                          [rng.randrange(256) for _ in range(3)]),
+        'freq': rng.choice([2412, 2437, 2462, 5180, 5500, 5745]),
+        'level': rng.randrange(-92, -30),
+        'flags': rng.choice(FLAGS),
+        'ssid': 'venue-%s-%d' % (rng.choice(['guest', 'staff', 'iot', 'pos']), rng.randrange(40)),
+    }
+
+
+def churn(rng, bsses, next_index, moved=0.05, left=0.02, joined=0.02):
+    """
+    Next scan: some BSSes change signal by up to 12 dB, some leave, new
+    ones appear.
+    """
+    result = []
+    for bss in bsses:
+        if rng.random() < left:
+            continue
+        bss = dict(bss)
+        if rng.random() < moved:
+            bss['level'] = max(-95, min(-20, bss['level'] + rng.randrange(-12, 13)))
+        result.append(bss)
+    for _ in range(int(len(bsses) * joined)):
+        result.append(random_bss(rng, next_index))
+        next_index += 1
+    return result, next_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wifi scan results benchmark')
+    parser.add_argument('-b', dest='bsses', type=int, default=300)
+    parser.add_argument('-r', dest='rounds', type=int, default=20)
+    parser.add_argument('-n', dest='iterations', type=int, default=20)
+    parser.add_argument('--mtu', dest='mtus', type=int, nargs='+', default=[23, 185])
+    parser.add_argument('--seed', dest='seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bsses = [random_bss(rng, i) for i in range(args.bsses)]
+    directory = tempfile.mkdtemp(prefix='bench-scan-')
+    wpa = FakeWpaSupplicant(directory, bsses=bsses, scan_delay=0).start()
+    try:
+        scanner = ScanResults('wlan0', ttl=0, ctrl_dir=directory)
+        entries = scanner.get()
+        assert len(entries) == args.bsses, len(entries)
+        results = {'bsses': args.bsses, 'scan': measure(scanner.scan, args.iterations)}
+
+        snapshot = encode_snapshot(entries)
+        assert len(decode_records(snapshot)) == args.bsses
+        results['snapshot_bytes'] = len(snapshot)
+        results['scan_results_text_bytes'] = sum(
+            len('%s\t%d\t%d\t%s\t%s\n' % (b['bssid'], b['freq'], b['level'], b['flags'], b['ssid']))
+            for b in bsses)
+
+        for mtu in args.mtus:
+            chunk = chunk_size(mtu)
+            stream = ScanStream()
+            snapshot_frames = len(stream.update(entries, chunk))
+            current, next_index = bsses, args.bsses
+            diff_frames = diff_bytes = full_frames = 0
+            for _ in range(args.rounds):
+                current, next_index = churn(rng, current, next_index)
+                wpa.bsses = current
+                scanned = scanner.get()
+                frames = stream.update(scanned, chunk)
+                diff_frames += len(frames)
+                diff_bytes += sum(len(f) for f in frames)
+                full_frames += len(ScanStream().update(scanned, chunk))
+            results['mtu_%d' % mtu] = {
+                'snapshot_notifications': snapshot_frames,
+                'diff_notifications_per_scan': diff_frames / args.rounds,
+                'diff_bytes_per_scan': diff_bytes / args.rounds,
+                'snapshot_notifications_per_scan': full_frames / args.rounds,
+            }
+            wpa.bsses = bsses
+            entries = scanner.get()
+    finally:
+        wpa.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    report('scan', results)
+
+
+if __name__ == '__main__':
+    main()
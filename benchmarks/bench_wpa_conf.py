@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+"""
+Saving one provisioned network into a wpa_supplicant.conf holding
+`networks` others: time of an upsert + atomic save, and how many lines
+of the file changed.
+
+    python3 benchmarks/bench_wpa_conf.py [-n 50]
+"""
+import argparse
+import difflib
+import os
+import tempfile
+
+from common import measure, report
+
+from pisugar_wifi_config.wpa_conf import WpaConfig, save_network
+
+HEADER = '''ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
+update_config=1
+country=GB
+'''
+
+SIZES = [1, 10, 50]
+
+
+def write_config(path, networks):
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for i in range(networks):
+            f.write('\n# saved network %d\nnetwork={\n    ssid="wifi-%d"\n'
+                    '    psk="password-%d"\n    priority=%d\n}\n' % (i, i, i, i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wpa_supplicant.conf store benchmark')
+    parser.add_argument('-n', dest='iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='wpa-conf-')
+    path = os.path.join(directory, 'wpa_supplicant.conf')
+    results = {}
+    for networks in SIZES:
+        write_config(path, networks)
+        with open(path) as f:
+            before = f.readlines()
+        save_network(path, 'PiSugar', 'f' * 64)
+        with open(path) as f:
+            after = f.readlines()
+        changed = [l for l in difflib.unified_diff(before, after, n=0)
+                   if l[:1] in '+-' and l[:3] not in ('+++', '---')]
+        assert len(WpaConfig(path).networks()) == networks + 1
+
+        counter = [0]
+
+        def provision():
+            counter[0] += 1
+            save_network(path, 'PiSugar', '%064x' % counter[0])
+
+        results[str(networks)] = {
+            'file_bytes': len(''.join(after)),
+            'lines_changed': len(changed),
+            'upsert_save': measure(provision, args.iterations),
+            'unchanged': measure(lambda: save_network(path, 'PiSugar', '%064x' % counter[0]),
+                                 args.iterations),
+        }
+    report('wpa_conf', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+"""
+Time from applying wifi credentials to association through the
+wpa_supplicant control interface. By default against FakeWpaSupplicant,
+which associates after --assoc-delay seconds, so the result is the
+overhead of the control path; with --ctrl-dir against a real one.
+
+    python3 benchmarks/bench_wpa_ctrl.py [-n 20]
+    sudo python3 benchmarks/bench_wpa_ctrl.py --ctrl-dir /var/run/wpa_supplicant \
+        -i wlan0 --ssid MyWifi --psk secret -n 3
+"""
+import argparse
+import tempfile
+import threading
+import time
+
+from common import report
+
+from fake_wpa_supplicant import FakeWpaSupplicant
+from pisugar_wifi_config.wpa_ctrl import WpaSupplicant
+
+
+def apply_once(wpa, ssid, psk, timeout):
+    done = threading.Event()
+    messages = []
+
+    def on_report(message):
+        messages.append(message)
+        done.set()
+
+    start = time.perf_counter()
+    wpa.connect(ssid, psk, on_report)
+    applied = time.perf_counter()
+    done.wait(timeout + 1)
+    connected = time.perf_counter()
+    return (applied - start) * 1000, (connected - start) * 1000, messages[0] if messages else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='wpa_supplicant control interface benchmark')
+    parser.add_argument('--ctrl-dir', dest='ctrl_dir', default=None,
+                        help='ctrl_interface of a running wpa_supplicant, fake when not set')
+    parser.add_argument('-i', dest='ifname', default='wlan0')
+    parser.add_argument('--ssid', default='PiSugar')
+    parser.add_argument('--psk', default='pisugar123')
+    parser.add_argument('--wrong-psk', dest='wrong_psk', action='store_true',
+                        help='make the fake reject the psk, to time the failure path')
+    parser.add_argument('--assoc-delay', dest='assoc_delay', type=float, default=0.05)
+    parser.add_argument('-n', dest='iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    fake = None
+    ctrl_dir = args.ctrl_dir
+    if ctrl_dir is None:
+        ctrl_dir = tempfile.mkdtemp(prefix='fake-wpa-')
+        fake = FakeWpaSupplicant(ctrl_dir, args.ifname, args.assoc_delay,
+                                 args.psk + 'x' if args.wrong_psk else args.psk).start()
+
+    wpa = WpaSupplicant(args.ifname, ctrl_dir)
+    applied, connected, outcomes = [], [], {}
+    try:
+        for _ in range(args.iterations):
+            apply_ms, connect_ms, message = apply_once(wpa, args.ssid, args.psk,
+                                                       WpaSupplicant.CONNECT_TIMEOUT)
+            applied.append(apply_ms)
+            connected.append(connect_ms)
+            outcomes[message] = outcomes.get(message, 0) + 1
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    results = {
+        'iterations': args.iterations,
+        'fake': fake is not None,
+        'outcomes': outcomes,
+        'apply_ms_median': sorted(applied)[len(applied) // 2],
+        'write_to_association_ms_median': sorted(connected)[len(connected) // 2],
+        'write_to_association_ms_max': max(connected),
+    }
+    if fake is not None:
+        results['assoc_delay_ms'] = args.assoc_delay * 1000
+        results['networks_left'] = len(fake.networks)
+        results['config_saved'] = fake.saved
+    report('wpa_ctrl', results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def measure(fn, iterations, warmup=3):
+    """
+    Call `fn` repeatedly and return latency statistics in milliseconds.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return latency_stats(samples)
+
+
+async def measure_async(fn, iterations, warmup=3):
+    """
+    measure() for a coroutine function.
+    """
+    for _ in range(warmup):
+        await fn()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return latency_stats(samples)
+
+
+def latency_stats(samples):
+    samples = sorted(samples)
+    return {
+        'iterations': len(samples),
+        'min_ms': samples[0],
+        'median_ms': samples[len(samples) // 2],
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max_ms': samples[-1],
+        'mean_ms': sum(samples) / len(samples),
+    }
+
+
+def report(name, results):
+    print(json.dumps({'benchmark': name, 'results': results}, sort_keys=True))
+
+
+def proc_status(pid):
+    """
+    VmRSS (kB) and thread count of a process from /proc/<pid>/status.
+    """
+    status = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name == 'VmRSS':
+                status['rss_kb'] = int(value.split()[0])
+            elif name == 'Threads':
+                status['threads'] = int(value)
+    return status
@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+"""
+Stand-in for BlueZ on a private D-Bus: a dbus-daemon of its own, and an
+org.bluez owner exposing adapters with Adapter1, GattManager1 and
+LEAdvertisingManager1. RegisterApplication reads the application's
+objects with GetManagedObjects, as bluetoothd does, before replying;
+after that the fake plays the central, calling ReadValue, WriteValue and
+StartNotify on the registered characteristics. Needs dbus-daemon and
+dbus-next.
+
+    python3 benchmarks/fake_bluez.py    # runs a bus and an adapter until ^C
+"""
+import asyncio
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from dbus_next import Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, method
+
+BLUEZ_SERVICE_NAME =           'org.bluez'
+ADAPTER_PATH =                 '/org/bluez/hci0'
+ADAPTER_IFACE =                'org.bluez.Adapter1'
+GATT_MANAGER_IFACE =           'org.bluez.GattManager1'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+GATT_CHRC_IFACE =              'org.bluez.GattCharacteristic1'
+LE_ADVERTISEMENT_IFACE =       'org.bluez.LEAdvertisement1'
+DBUS_OM_IFACE =                'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE =              'org.freedesktop.DBus.Properties'
+
+DEVICE_PATH = ADAPTER_PATH + '/dev_00_11_22_33_44_55'
+
+BUS_CONFIG = '''<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <listen>unix:path=%s</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow user="*"/>
+    <allow own="*"/>
+    <allow send_type="method_call"/>
+    <allow send_type="method_return"/>
+    <allow send_type="signal"/>
+    <allow send_type="error"/>
+    <allow receive_type="method_call"/>
+    <allow receive_type="method_return"/>
+    <allow receive_type="signal"/>
+    <allow receive_type="error"/>
+  </policy>
+</busconfig>
+'''
+
+
+class PrivateBus(object):
+    """
+    A dbus-daemon listening on a socket in a temporary directory; point
+    DBUS_SYSTEM_BUS_ADDRESS at `address` to use it as the system bus.
+    """
+    def __init__(self):
+        self.directory = None
+        self.process = None
+        self.address = None
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix='fake-bluez-')
+        config = os.path.join(self.directory, 'bus.conf')
+        with open(config, 'w') as f:
+            f.write(BUS_CONFIG % os.path.join(self.directory, 'bus.sock'))
+        self.process = subprocess.Popen(
+            ['dbus-daemon', '--config-file=' + config, '--nofork', '--print-address'],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.address = self.process.stdout.readline().strip()
+        if not self.address:
+            raise RuntimeError('dbus-daemon did not start')
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class ObjectManager(ServiceInterface):
+    """
+    Makes introspection of / list the interface; dbus-next answers
+    GetManagedObjects itself with every exported object.
+    """
+    def __init__(self):
+        super().__init__(DBUS_OM_IFACE)
+
+    @method()
+    def GetManagedObjects(self) -> 'a{oa{sa{sv}}}':
+        return {}
+
+
+class Adapter(ServiceInterface):
+    def __init__(self):
+        super().__init__(ADAPTER_IFACE)
+        self.powered = False
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> 's':
+        return '00:00:00:00:5A:AD'
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Name(self) -> 's':
+        return 'fake-bluez'
+
+    @dbus_property()
+    def Powered(self) -> 'b':
+        return self.powered
+
+    @Powered.setter
+    def Powered(self, value: 'b'):
+        self.powered = value
+
+
+class GattManager(ServiceInterface):
+    """
+    Only here for introspection and GetManagedObjects; the calls are
+    answered by FakeBluez.on_message, which knows the caller.
+    """
+    def __init__(self):
+        super().__init__(GATT_MANAGER_IFACE)
+
+    @method()
+    def RegisterApplication(self, application: 'o', options: 'a{sv}'):
+        pass
+
+    @method()
+    def UnregisterApplication(self, application: 'o'):
+        pass
+
+
+class AdvertisingManager(ServiceInterface):
+    def __init__(self):
+        super().__init__(LE_ADVERTISING_MANAGER_IFACE)
+
+    @method()
+    def RegisterAdvertisement(self, advertisement: 'o', options: 'a{sv}'):
+        pass
+
+    @method()
+    def UnregisterAdvertisement(self, service: 'o'):
+        pass
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ActiveInstances(self) -> 'y':
+        return 0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def SupportedInstances(self) -> 'y':
+        return 5
+
+
+def options(mtu=None, offset=None):
+    opts = {'device': Variant('o', DEVICE_PATH), 'link': Variant('s', 'LE')}
+    if mtu is not None:
+        opts['mtu'] = Variant('q', mtu)
+    if offset is not None:
+        opts['offset'] = Variant('q', offset)
+    return opts
+
+
+class FakeBluez(object):
+    """
+    Owner of org.bluez on `address` with `adapters` adapters, hci0 and
+    up. After start(), `registered` is set once an application
+    registered, `applications` and `advertisements` hold the adapters they
+    were registered on; `chrcs` maps characteristic UUIDs to
+    their paths and `registered_at` is the time.monotonic() of the reply.
+    Notifications of the application arrive at `on_notify(uuid, value)`.
+    """
+    def __init__(self, address, adapters=1):
+        self.address = address
+        self.bus = None
+        self.adapter_paths = ['/org/bluez/hci%d' % i for i in range(adapters)]
+        self.applications = set()
+        self.advertisements = set()
+        self.app = None
+        self.app_path = None
+        self.chrcs = {}
+        self.paths = {}
+        self.advertisement = None
+        self.registered = asyncio.Event()
+        self.advertised = asyncio.Event()
+        self.registered_at = None
+        self.advertised_at = None
+        self.on_notify = None
+
+    async def start(self):
+        self.bus = await MessageBus(bus_address=self.address).connect()
+        self.bus.export('/', ObjectManager())
+        for path in self.adapter_paths:
+            self.bus.export(path, Adapter())
+            self.bus.export(path, GattManager())
+            self.bus.export(path, AdvertisingManager())
+        self.bus.add_message_handler(self.on_message)
+        await self.bus.request_name(BLUEZ_SERVICE_NAME)
+        return self
+
+    def stop(self):
+        if self.bus is not None:
+            self.bus.disconnect()
+            self.bus = None
+
+    def on_message(self, msg):
+        if msg.message_type == MessageType.SIGNAL:
+            if msg.member == 'PropertiesChanged' and msg.path in self.paths:
+                self.properties_changed(msg)
+            return None
+        if msg.message_type != MessageType.METHOD_CALL or msg.path not in self.adapter_paths:
+            return None
+        if msg.interface == GATT_MANAGER_IFACE and msg.member == 'RegisterApplication':
+            asyncio.ensure_future(self.register_application(msg))
+            return True
+        if msg.interface == LE_ADVERTISING_MANAGER_IFACE:
+            if msg.member == 'RegisterAdvertisement':
+                asyncio.ensure_future(self.register_advertisement(msg))
+                return True
+            if msg.member == 'UnregisterAdvertisement':
+                self.advertisements.discard(msg.path)
+                if not self.advertisements:
+                    self.advertisement = None
+                    self.advertised.clear()
+                return Message.new_method_return(msg)
+        if msg.interface == GATT_MANAGER_IFACE and msg.member == 'UnregisterApplication':
+            self.applications.discard(msg.path)
+            if not self.applications:
+                self.app = None
+                self.registered.clear()
+            return Message.new_method_return(msg)
+        return None
+
+    async def register_application(self, msg):
+        reply = await self.bus.call(Message(destination=msg.sender, path=msg.body[0],
+                                            interface=DBUS_OM_IFACE, member='GetManagedObjects'))
+        if reply.message_type == MessageType.ERROR:
+            self.bus.send(Message.new_error(msg, 'org.bluez.Error.Failed', str(reply.body)))
+            return
+        self.chrcs = {}
+        for path, interfaces in reply.body[0].items():
+            chrc = interfaces.get(GATT_CHRC_IFACE)
+            if chrc is not None:
+                self.chrcs[chrc['UUID'].value] = path
+        self.paths = dict((path, uuid) for uuid, path in self.chrcs.items())
+        self.app = msg.sender
+        self.app_path = msg.body[0]
+        await self.bus.call(Message(
+            destination='org.freedesktop.DBus', path='/org/freedesktop/DBus',
+            interface='org.freedesktop.DBus', member='AddMatch', signature='s',
+            body=["type='signal',sender='%s',interface='%s',member='PropertiesChanged'" % (
+                msg.sender, DBUS_PROP_IFACE)]))
+        self.registered_at = time.monotonic()
+        self.applications.add(msg.path)
+        self.bus.send(Message.new_method_return(msg))
+        self.registered.set()
+
+    async def register_advertisement(self, msg):
+        reply = await self.bus.call(Message(destination=msg.sender, path=msg.body[0],
+                                            interface=DBUS_PROP_IFACE, member='GetAll',
+                                            signature='s', body=[LE_ADVERTISEMENT_IFACE]))
+        if reply.message_type == MessageType.ERROR:
+            self.bus.send(Message.new_error(msg, 'org.bluez.Error.Failed', str(reply.body)))
+            return
+        self.advertisement = dict((k, v.value) for k, v in reply.body[0].items())
+        self.advertised_at = time.monotonic()
+        self.advertisements.add(msg.path)
+        self.bus.send(Message.new_method_return(msg))
+        self.advertised.set()
+
+    def properties_changed(self, msg):
+        iface, changed, _ = msg.body
+        if iface == GATT_CHRC_IFACE and 'Value' in changed and self.on_notify is not None:
+            self.on_notify(self.paths[msg.path], bytes(changed['Value'].value))
+
+    async def call(self, path, iface, member, signature='', body=()):
+        reply = await self.bus.call(Message(destination=self.app, path=path, interface=iface,
+                                            member=member, signature=signature, body=list(body)))
+        if reply.message_type == MessageType.ERROR:
+            raise RuntimeError('%s: %s %s' % (member, reply.error_name, reply.body))
+        return reply.body
+
+    async def get_managed_objects(self):
+        return (await self.call(self.app_path, DBUS_OM_IFACE, 'GetManagedObjects'))[0]
+
+    async def read_value(self, uuid, mtu=None, offset=None):
+        body = await self.call(self.chrcs[uuid], GATT_CHRC_IFACE, 'ReadValue', 'a{sv}',
+                               [options(mtu, offset)])
+        return bytes(body[0])
+
+    async def write_value(self, uuid, value, mtu=None):
+        await self.call(self.chrcs[uuid], GATT_CHRC_IFACE, 'WriteValue', 'aya{sv}',
+                        [bytes(value), options(mtu)])
+
+    async def start_notify(self, uuid):
+        await self.call(self.chrcs[uuid], GATT_CHRC_IFACE, 'StartNotify')
+
+    async def stop_notify(self, uuid):
+        await self.call(self.chrcs[uuid], GATT_CHRC_IFACE, 'StopNotify')
+
+
+async def serve():
+    private_bus = PrivateBus().start()
+    print('DBUS_SYSTEM_BUS_ADDRESS=' + private_bus.address)
+    bluez = await FakeBluez(private_bus.address).start()
+    try:
+        while True:
+            await bluez.registered.wait()
+            print('Application registered by %s: %s' % (bluez.app, sorted(bluez.chrcs)))
+            bluez.registered.clear()
+    finally:
+        bluez.stop()
+        private_bus.stop()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.get_event_loop().run_until_complete(serve())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+"""
+Stand-in for the wpa_supplicant control interface: a unix datagram socket
+answering the commands WpaSupplicant uses, and sending
+CTRL-EVENT-CONNECTED to attached clients `assoc_delay` seconds after a
+SELECT_NETWORK of a network whose psk is `good_psk` (any psk if None).
+SCAN sends CTRL-EVENT-SCAN-RESULTS after `scan_delay` seconds and BSS
+RANGE pages through `bsses`, dicts of bssid, freq, level, flags and ssid.
+
+    python3 benchmarks/fake_wpa_supplicant.py [-d /tmp/fake-wpa] [-i wlan0]
+"""
+import argparse
+import binascii
+import os
+import socket
+import threading
+
+REPLY_SIZE = 4096
+
+
+class FakeWpaSupplicant(object):
+    def __init__(self, ctrl_dir, ifname='wlan0', assoc_delay=0.05, good_psk=None,
+                 bsses=(), scan_delay=0.05):
+        self.path = os.path.join(ctrl_dir, ifname)
+        self.assoc_delay = assoc_delay
+        self.good_psk = good_psk
+        self.bsses = list(bsses)
+        self.scan_delay = scan_delay
+        self.scans = 0
+        os.makedirs(ctrl_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.networks = {}
+        self.next_id = 0
+        self.attached = set()
+        self.saved = 0
+        self.commands = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def serve(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            reply = self.handle(data.decode(), addr)
+            try:
+                self.sock.sendto(reply.encode(), addr)
+            except OSError:
+                pass
+
+    def send_event(self, event):
+        with self.lock:
+            clients = list(self.attached)
+        for addr in clients:
+            try:
+                self.sock.sendto(('<3>' + event).encode(), addr)
+            except OSError:
+                pass
+
+    def associate(self, network_id):
+        network = self.networks.get(network_id)
+        if network is None:
+            return
+        if self.good_psk is not None and network.get('psk') != '"%s"' % self.good_psk:
+            self.send_event('CTRL-EVENT-SSID-TEMP-DISABLED id=%d reason=WRONG_KEY' % network_id)
+            return
+        self.send_event('CTRL-EVENT-CONNECTED - Connection to 00:11:22:33:44:55 completed [id=%d]'
+                        % network_id)
+
+    def handle(self, cmd, addr):
+        self.commands.append(cmd)
+        args = cmd.split(' ', 3)
+        name = args[0]
+        with self.lock:
+            if name == 'PING':
+                return 'PONG\n'
+            if name == 'ATTACH':
+                self.attached.add(addr)
+                return 'OK\n'
+            if name == 'DETACH':
+                self.attached.discard(addr)
+                return 'OK\n'
+            if name == 'ADD_NETWORK':
+                network_id = self.next_id
+                self.next_id += 1
+                self.networks[network_id] = {'disabled': '1'}
+                return '%d\n' % network_id
+            if name == 'SET_NETWORK' and len(args) == 4:
+                network = self.networks.get(int(args[1]))
+                if network is None:
+                    return 'FAIL\n'
+                network[args[2]] = args[3]
+                return 'OK\n'
+            if name == 'GET_NETWORK' and len(args) == 3:
+                network = self.networks.get(int(args[1]))
+                if network is None or args[2] not in network:
+                    return 'FAIL\n'
+                return network[args[2]]
+            if name == 'REMOVE_NETWORK':
+                if self.networks.pop(int(args[1]), None) is None:
+                    return 'FAIL\n'
+                return 'OK\n'
+            if name == 'SELECT_NETWORK':
+                network_id = int(args[1])
+                if network_id not in self.networks:
+                    return 'FAIL\n'
+                for other_id, network in self.networks.items():
+                    network['disabled'] = '0' if other_id == network_id else '1'
+                threading.Timer(self.assoc_delay, self.associate, (network_id,)).start()
+                return 'OK\n'
+            if name == 'ENABLE_NETWORK':
+                for network_id, network in self.networks.items():
+                    if args[1] in ('all', str(network_id)):
+                        network['disabled'] = '0'
+                return 'OK\n'
+            if name == 'SAVE_CONFIG':
+                self.saved += 1
+                return 'OK\n'
+            if name == 'SCAN':
+                self.scans += 1
+                threading.Timer(self.scan_delay, self.send_event,
+                                ('CTRL-EVENT-SCAN-RESULTS ',)).start()
+                return 'OK\n'
+            if name == 'BSS' and len(args) > 1 and args[1].startswith('RANGE='):
+                first = int(args[1][len('RANGE='):].split('-')[0])
+                reply = ''
+                for bss_id, bss in enumerate(self.bsses):
+                    if bss_id < first:
+                        continue
+                    entry = 'id=%d\n' % bss_id + ''.join(
+                        '%s=%s\n' % (k, bss[k]) for k in ('bssid', 'freq', 'level', 'flags', 'ssid')
+                    ) + '====\n'
+                    if len(reply) + len(entry) > REPLY_SIZE:
+                        break
+                    reply += entry
+                return reply
+            if name == 'LIST_NETWORKS':
+                lines = ['network id / ssid / bssid / flags']
+                for network_id, network in sorted(self.networks.items()):
+                    ssid = binascii.unhexlify(network.get('ssid', '')).decode('utf8', 'replace')
+                    flags = '[DISABLED]' if network['disabled'] == '1' else ''
+                    lines.append('%d\t%s\tany\t%s' % (network_id, ssid, flags))
+                return '\n'.join(lines) + '\n'
+        return 'UNKNOWN COMMAND\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake wpa_supplicant control interface')
+    parser.add_argument('-d', dest='ctrl_dir', default='/tmp/fake-wpa')
+    parser.add_argument('-i', dest='ifname', default='wlan0')
+    parser.add_argument('--assoc-delay', dest='assoc_delay', type=float, default=0.05)
+    args = parser.parse_args()
+    server = FakeWpaSupplicant(args.ctrl_dir, args.ifname, args.assoc_delay)
+    print('Listening on ' + server.path)
+    server.start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
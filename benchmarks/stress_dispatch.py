@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""
+Hammer the main loop dispatcher from many threads and check that every
+item runs exactly once, on the main thread, in per-producer order.
+
+    python3 benchmarks/stress_dispatch.py [-t 32] [-n 5000] [-b 32]
+"""
+import argparse
+import sys
+import threading
+import time
+
+from common import report
+
+from gi.repository import GLib
+
+from pisugar_wifi_config.dispatch import MainLoopDispatcher
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dispatcher stress test')
+    parser.add_argument('-t', dest='threads', type=int, default=32)
+    parser.add_argument('-n', dest='items', type=int, default=5000)
+    parser.add_argument('-b', dest='batch_size', type=int, default=32)
+    args = parser.parse_args()
+
+    dispatcher = MainLoopDispatcher(batch_size=args.batch_size)
+    mainloop = GLib.MainLoop()
+    main_thread = threading.current_thread()
+    total = args.threads * args.items
+    last_seen = [-1] * args.threads
+    state = {'count': 0, 'errors': 0, 'max_latency': 0.0}
+
+    def consume(producer, seq, posted_at):
+        if threading.current_thread() is not main_thread:
+            state['errors'] += 1
+        if seq != last_seen[producer] + 1:
+            state['errors'] += 1
+        last_seen[producer] = seq
+        state['max_latency'] = max(state['max_latency'], time.perf_counter() - posted_at)
+        state['count'] += 1
+        if state['count'] == total:
+            mainloop.quit()
+
+    def produce(producer):
+        for seq in range(args.items):
+            dispatcher.post(consume, producer, seq, time.perf_counter())
+
+    # keep the main loop busy with other sources, as BlueZ would
+    GLib.timeout_add(1, lambda: True)
+    GLib.timeout_add_seconds(60, mainloop.quit)
+
+    workers = [threading.Thread(target=produce, args=(i,), daemon=True)
+               for i in range(args.threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    mainloop.run()
+    elapsed = time.perf_counter() - start
+
+    ok = state['count'] == total and state['errors'] == 0
+    report('dispatch_stress', {
+        'threads': args.threads,
+        'items': total,
+        'delivered': state['count'],
+        'errors': state['errors'],
+        'ok': ok,
+        'elapsed_s': elapsed,
+        'items_per_s': state['count'] / elapsed,
+        'max_latency_ms': state['max_latency'] * 1000,
+    })
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import time
+
+FAST =                         'fast'
+SLOW =                         'slow'
+STOPPED =                      'stopped'
+
+# ms; 20 ms for the first 30 s then one of Apple's recommended intervals
+# (1022.5 ms) to be found quickly by phones scanning in the background
+FAST_INTERVAL =                20
+SLOW_INTERVAL =                1022
+FAST_TIME =                    30
+
+
+class AdvertisingPlan(object):
+    """
+    Advertising phases from the time advertising is (re)armed: FAST for
+    `fast_time` seconds, then SLOW, then STOPPED `duration` seconds after
+    arming (<=0: never).
+    """
+    def __init__(self, fast_time=FAST_TIME, fast_interval=FAST_INTERVAL,
+                 slow_interval=SLOW_INTERVAL, duration=0):
+        self.fast_time = fast_time
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.duration = duration
+
+    def changes(self):
+        """
+        [(seconds after arming, phase, interval in ms or None)]
+        """
+        changes = []
+        if self.fast_time > 0:
+            changes.append((0, FAST, self.fast_interval))
+            changes.append((self.fast_time, SLOW, self.slow_interval))
+        else:
+            changes.append((0, SLOW, self.slow_interval))
+        if self.duration and self.duration > 0:
+            changes = [c for c in changes if c[0] < self.duration]
+            changes.append((self.duration, STOPPED, None))
+        return changes
+
+    def phase_at(self, elapsed):
+        current = None
+        for change in self.changes():
+            if change[0] > elapsed:
+                break
+            current = change
+        return current[1], current[2]
+
+
+class AdvertisingScheduler(object):
+    """
+    Walk an AdvertisingPlan on the main loop. arm() starts it over from
+    the beginning, at startup and on SIGUSR1 (a button press, or
+    `systemctl kill -s USR1 pisugar-wifi-config`), and `apply(phase,
+    interval)` is called on every change. Event loop hooks default to
+    GLib and can be overridden for asyncio.
+    """
+    def __init__(self, plan, apply):
+        self.plan = plan
+        self.apply = apply
+        self.phase = STOPPED
+        self.armed_at = None
+        self.sources = []
+
+    def arm(self):
+        for source in self.sources:
+            self.cancel(source)
+        self.sources = []
+        self.armed_at = time.monotonic()
+        for at, phase, interval in self.plan.changes():
+            if at <= 0:
+                self.enter(phase, interval)
+            else:
+                self.sources.append(self.call_later(int(at * 1000), self.fire,
+                                                    phase, interval))
+        # keep the GLib signal source
+        return True
+
+    def fire(self, phase, interval):
+        self.sources.pop(0)
+        self.enter(phase, interval)
+
+    def enter(self, phase, interval):
+        if interval is None:
+            print('Advertising %s' % phase)
+        else:
+            print('Advertising %s, every %d ms' % (phase, interval))
+        self.phase = phase
+        self.apply(phase, interval)
+
+    # Event loop hooks, GLib by default. GLib is imported in them, the
+    # asyncio engine runs without it.
+
+    def call_later(self, ms, callback, *args):
+        from gi.repository import GLib
+
+        def on_timeout():
+            callback(*args)
+            return False
+        return GLib.timeout_add(ms, on_timeout)
+
+    def cancel(self, source):
+        from gi.repository import GLib
+        GLib.source_remove(source)
@@ -0,0 +1,910 @@
+"""
+asyncio engine: the same GATT tree as the GLib engine, served by dbus-next
+from a single event loop. Notifications, samplers and commands are tasks
+or loop callbacks instead of OS threads. What the characteristics do is
+in gatt.py, shared with the GLib engine.
+
+Requires the optional `dbus-next` package.
+"""
+import asyncio
+import os
+import signal
+import time
+
+from dbus_next import BusType, Message, MessageType, Variant
+from dbus_next.aio import MessageBus
+from dbus_next.constants import PropertyAccess
+from dbus_next.errors import DBusError
+from dbus_next.service import ServiceInterface, dbus_property, method
+
+from .advertising import FAST_INTERVAL, STOPPED, AdvertisingScheduler
+from .commands import (END_CANCELLED, END_EXITED, END_FAILED, END_PAYLOAD,
+                       END_REJECTED, END_TIMEOUT, FRAME_END, FRAME_STDERR, FRAME_STDOUT,
+                       CommandStats, frame)
+from .gatt import (ADAPTER_IFACE, BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE,
+                   GATT_CHRC_IFACE, GATT_DESC_IFACE, GATT_MANAGER_IFACE, GATT_SERVICE_IFACE,
+                   LE_ADVERTISEMENT_IFACE, LE_ADVERTISING_MANAGER_IFACE, RETRY_DELAY, RETRY_MAX,
+                   SERVICE_ID, WIFI_IFACE, Attribute, CommandValue, DeviceModelDescriptorValue,
+                   DeviceModelValue, InputNotifyMessageValue, InputSepValue, InputValue,
+                   IPAddressValue, NotSupported, Notifier, ProvisioningStatsValue, ScanValue,
+                   ServiceNameDescriptorValue, ServiceNameValue, WifiNameValue, advertising_plan,
+                   error_name, is_adapter, new_reassembler)
+from .metrics import metrics, observe, subprocesses
+from .netinfo import NetworkStateCache
+from .netlink import NetlinkMonitor
+from .provisioning import provisioning
+from .reassembly import FrameError
+from .scan import ScanResults, ScanStream, chunk_size as scan_chunk_size
+from .sessions import SessionTable
+from .startup import sd_notify, startup
+from .status import (MANUFACTURER_ID, PISUGAR_SERVER, StatusBroadcast, encode_status,
+                     read_battery)
+from .values import ReadBuffer
+
+# seconds to wait for bluetoothd when shutting down
+STOP_TIMEOUT = 2
+
+
+def unwrap(options):
+    return dict((k, v.value) for k, v in options.items())
+
+
+def call(obj, method, fn, *args):
+    """
+    Run a GATT method of `obj`, timed in pisugar_gatt_call_seconds; errors
+    of the values are returned to BlueZ as its own, see gatt.ERRORS.
+    """
+    started = time.perf_counter()
+    failed = True
+    try:
+        result = fn(*args)
+        failed = False
+        return result
+    except (NotSupported, FrameError) as e:
+        print('%s: %s' % (type(obj).__name__, e))
+        raise DBusError(error_name(e), str(e))
+    finally:
+        if metrics.enabled:
+            observe(method, type(obj).__name__, started, failed)
+
+
+class AsyncioNetlinkMonitor(NetlinkMonitor):
+    """
+    NetlinkMonitor driven by an asyncio event loop.
+    """
+    def __init__(self, ifname, loop, **kwargs):
+        super().__init__(ifname, **kwargs)
+        self.loop = loop
+
+    def add_reader(self, sock, callback):
+        self.loop.add_reader(sock.fileno(), callback)
+        return ('reader', sock.fileno())
+
+    def call_later(self, ms, callback):
+        return self.loop.call_later(ms / 1000.0, callback)
+
+    def call_every(self, seconds, callback):
+        def tick():
+            callback()
+            handle[0] = self.loop.call_later(seconds, tick)
+        handle = [self.loop.call_later(seconds, tick)]
+        return handle
+
+    def cancel(self, source):
+        if isinstance(source, tuple):
+            self.loop.remove_reader(source[1])
+        elif isinstance(source, list):
+            source[0].cancel()
+        else:
+            source.cancel()
+
+
+class Application(object):
+    """
+    GetManagedObjects on '/' for BlueZ, answered from a message handler
+    ahead of the ObjectManager of dbus-next: as on the GLib engine the
+    tree is built once, typed up front, and the call is timed.
+    """
+    path = '/'
+
+    def __init__(self, bus, services):
+        self.bus = bus
+        self.services = services
+        self.managed_objects = None
+
+    def start(self):
+        self.bus.add_message_handler(self.on_message)
+
+    def on_message(self, msg):
+        if msg.message_type != MessageType.METHOD_CALL or msg.path != self.path or \
+                msg.interface not in (None, DBUS_OM_IFACE) or msg.member != 'GetManagedObjects':
+            return None
+        started = time.perf_counter()
+        print('GetManagedObjects')
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+        reply = Message.new_method_return(msg, 'a{oa{sa{sv}}}', [self.managed_objects])
+        if metrics.enabled:
+            observe('GetManagedObjects', 'Application', started)
+        return reply
+
+    def build_managed_objects(self):
+        response = {}
+        for service in self.services:
+            response[service.path] = service.get_properties()
+            for chrc in service.characteristics:
+                response[chrc.path] = chrc.get_properties()
+                for desc in chrc.descriptors:
+                    response[desc.path] = desc.get_properties()
+        return response
+
+
+class Service(ServiceInterface):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+    PATH_BASE = '/com/pisugar/wifi/service'
+
+    def __init__(self, index, uuid, primary):
+        super().__init__(GATT_SERVICE_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+
+    def get_properties(self):
+        return {GATT_SERVICE_IFACE: {
+            'UUID': Variant('s', self.uuid),
+            'Primary': Variant('b', self.primary),
+            'Characteristics': Variant('ao', [chrc.path for chrc in self.characteristics]),
+        }}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> 'b':
+        return self.primary
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> 'ao':
+        return [chrc.path for chrc in self.characteristics]
+
+
+# The D-Bus UUID property of characteristics and descriptors is named
+# uuid_property here: the values mixed in have a UUID class attribute.
+
+class Characteristic(Notifier, ServiceInterface):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+
+    notify_value() is thread safe as on the GLib engine, values are
+    coalesced on the loop, see gatt.Notifier.
+    """
+    def __init__(self, index, uuid, flags, service):
+        super().__init__(GATT_CHRC_IFACE)
+        self.path = service.path + '/char' + str(index)
+        self.uuid = uuid
+        self.flags = flags
+        self.service = service
+        self.descriptors = []
+        self.value = b''
+        self.notifying = False
+        self.read_buffer = ReadBuffer()
+        self.loop = asyncio.get_event_loop()
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+
+    def get_properties(self):
+        return {GATT_CHRC_IFACE: {
+            'Service': Variant('o', self.service.path),
+            'UUID': Variant('s', self.uuid),
+            'Flags': Variant('as', self.flags),
+            'Descriptors': Variant('ao', [desc.path for desc in self.descriptors]),
+        }}
+
+    def notify_value(self, value):
+        self.loop.call_soon_threadsafe(self.coalesce_notify, bytes(value))
+
+    def call_later(self, seconds, callback):
+        return self.loop.call_later(seconds, callback)
+
+    def emit_value(self, value):
+        self.value = value
+        self.emit_properties_changed({'Value': value})
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> 'o':
+        return self.service.path
+
+    @dbus_property(access=PropertyAccess.READ, name='UUID')
+    def uuid_property(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return self.flags
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> 'ao':
+        return [desc.path for desc in self.descriptors]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> 'ay':
+        return self.value
+
+    @method()
+    def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return call(self, 'ReadValue', self.read, unwrap(options))
+
+    @method()
+    def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        call(self, 'WriteValue', self.write_value, bytes(value), unwrap(options))
+
+    @method()
+    def StartNotify(self):
+        call(self, 'StartNotify', self.start_notify)
+
+    @method()
+    def StopNotify(self):
+        call(self, 'StopNotify', self.stop_notify)
+
+
+class Descriptor(Attribute, ServiceInterface):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    def __init__(self, index, uuid, flags, chrc):
+        super().__init__(GATT_DESC_IFACE)
+        self.path = chrc.path + '/desc' + str(index)
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = chrc
+        self.read_buffer = ReadBuffer()
+
+    def get_properties(self):
+        return {GATT_DESC_IFACE: {
+            'Characteristic': Variant('o', self.chrc.path),
+            'UUID': Variant('s', self.uuid),
+            'Flags': Variant('as', self.flags),
+        }}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> 'o':
+        return self.chrc.path
+
+    @dbus_property(access=PropertyAccess.READ, name='UUID')
+    def uuid_property(self) -> 's':
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> 'as':
+        return self.flags
+
+    @method()
+    def ReadValue(self, options: 'a{sv}') -> 'ay':
+        return call(self, 'ReadValue', self.read, unwrap(options))
+
+    @method()
+    def WriteValue(self, value: 'ay', options: 'a{sv}'):
+        call(self, 'WriteValue', self.write_value, bytes(value), unwrap(options))
+
+
+class ServiceNameChrcAio(ServiceNameValue, Characteristic):
+    def __init__(self, index, service):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.add_descriptor(ServiceNameDescriptorAio(0, self))
+
+
+class ServiceNameDescriptorAio(ServiceNameDescriptorValue, Descriptor):
+    def __init__(self, index, chrc):
+        super().__init__(index, self.UUID, self.FLAGS, chrc)
+
+
+class DeviceModelChrcAio(DeviceModelValue, Characteristic):
+    def __init__(self, index, service):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.add_descriptor(DeviceModelDescriptorAio(0, self))
+
+
+class DeviceModelDescriptorAio(DeviceModelDescriptorValue, Descriptor):
+    def __init__(self, index, chrc):
+        super().__init__(index, self.UUID, self.FLAGS, chrc)
+
+
+class WifiNameChrcAio(WifiNameValue, Characteristic):
+    def __init__(self, index, service, net_state):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.net_state = net_state
+        net_state.add_listener(self.on_state_changed)
+
+
+class IPAddressChrcAio(IPAddressValue, Characteristic):
+    def __init__(self, index, service, net_state):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.net_state = net_state
+        net_state.add_listener(self.on_state_changed)
+
+
+class InputChrcAio(InputValue, Characteristic):
+    def __init__(self, index, service, key, sessions):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.key = key
+        self.sessions = sessions
+
+
+class InputSepChrcAio(InputSepValue, Characteristic):
+    def __init__(self, index, service, key, sessions):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.key = key
+        self.sessions = sessions
+
+
+class InputNotifyMessageChrcAio(InputNotifyMessageValue, Characteristic):
+    NOTIFY_WINDOW = 0
+    NOTIFY_DEDUPE = False
+
+    def __init__(self, index, service, sessions):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        sessions.add_listener(self.on_status)
+
+    def on_status(self, session, message):
+        self.notify_value(message.encode())
+
+
+class ProvisioningStatsChrcAio(ProvisioningStatsValue, Characteristic):
+    def __init__(self, index, service, tracker):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.tracker = tracker
+
+
+class CommandChrcAio(CommandValue, Characteristic):
+    """
+    Output streamed as frames while the command runs, see CommandRun.
+    Each command is a task; cancelling it kills the command. At most
+    COMMAND_WORKERS run at once and COMMAND_QUEUE wait, as in
+    CommandExecutor. COMMAND_SHELL is not supported.
+    """
+    NOTIFY_WINDOW = 0
+    NOTIFY_DEDUPE = False
+    NOTIFY_INTERVAL = 0.005
+
+    def __init__(self, index, service, sessions):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        self.tasks = {}
+        self.next_id = 0
+        self.slots = asyncio.Semaphore(self.COMMAND_WORKERS)
+        self.waiting = 0
+        self.stats = CommandStats()
+        self.stats.register()
+
+    def cancel(self, cmd_id):
+        for task_id, task in list(self.tasks.items()):
+            if cmd_id in (None, task_id):
+                print('Cancel command %d' % task_id)
+                task.cancel()
+
+    def submit(self, cmd, chunk):
+        cmd_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xff
+        if self.waiting >= self.COMMAND_QUEUE:
+            self.stats.reject()
+            print('Command queue full, reject command %d' % cmd_id)
+            self.send_notify(frame(cmd_id, 0, FRAME_END, END_PAYLOAD.pack(-1, END_REJECTED)))
+            return
+        self.waiting += 1
+        self.tasks[cmd_id] = asyncio.ensure_future(self.run_command(cmd_id, cmd, chunk))
+
+    async def run_command(self, cmd_id, cmd, chunk):
+        queued_at = time.monotonic()
+        try:
+            await self.slots.acquire()
+        except asyncio.CancelledError:
+            self.send_notify(frame(cmd_id, 0, FRAME_END, END_PAYLOAD.pack(-1, END_CANCELLED)))
+            self.tasks.pop(cmd_id, None)
+            return
+        finally:
+            self.waiting -= 1
+        started_at = time.monotonic()
+        try:
+            await self.execute(cmd_id, cmd, chunk)
+        finally:
+            self.slots.release()
+        self.stats.add(cmd_id, started_at - queued_at, time.monotonic() - started_at)
+
+    async def execute(self, cmd_id, cmd, chunk):
+        seq = [0]
+
+        def send(frame_type, payload=b''):
+            self.send_notify(frame(cmd_id, seq[0], frame_type, payload))
+            seq[0] += 1
+
+        async def pump(stream, frame_type):
+            while True:
+                data = await stream.read(chunk)
+                if not data:
+                    return
+                send(frame_type, data)
+                await asyncio.sleep(self.NOTIFY_INTERVAL)
+
+        metrics.inc(subprocesses, 'command')
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                'bash', '-c', cmd, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=True)
+        except OSError as e:
+            print('Command failed: ' + str(e))
+            send(FRAME_END, END_PAYLOAD.pack(-1, END_FAILED))
+            self.tasks.pop(cmd_id, None)
+            return
+
+        reason = END_EXITED
+        pumps = asyncio.gather(pump(proc.stdout, FRAME_STDOUT),
+                               pump(proc.stderr, FRAME_STDERR))
+        timeout = self.COMMAND_TIMEOUT if self.COMMAND_TIMEOUT > 0 else None
+        try:
+            await asyncio.wait_for(asyncio.shield(pumps), timeout)
+        except asyncio.TimeoutError:
+            print('Command timeout: ' + cmd)
+            reason = END_TIMEOUT
+        except asyncio.CancelledError:
+            reason = END_CANCELLED
+        if reason != END_EXITED:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            await pumps
+        returncode = await proc.wait()
+        send(FRAME_END, END_PAYLOAD.pack(returncode, reason))
+        self.tasks.pop(cmd_id, None)
+
+
+class ScanChrcAio(ScanValue, Characteristic):
+    """
+    Scans run in the default executor, frames are sent from a task while
+    notifying.
+    """
+    NOTIFY_WINDOW = 0
+    NOTIFY_DEDUPE = False
+    NOTIFY_INTERVAL = 0.005
+
+    def __init__(self, index, service, sessions, scanner):
+        super().__init__(index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        self.scanner = scanner
+        self.stream = ScanStream()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start_notify(self):
+        if self.notifying:
+            print("Already notifying, nothing to do")
+            return
+        self.notifying = True
+        self.stream.reset()
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop_notify(self):
+        self.notifying = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while self.notifying:
+            self.wakeup.clear()
+            entries = await loop.run_in_executor(None, self.scanner.get)
+            for value in self.stream.update(entries, scan_chunk_size(self.sessions.min_mtu())):
+                self.send_notify(value)
+                await asyncio.sleep(self.NOTIFY_INTERVAL)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.scanner.ttl)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Advertisement(ServiceInterface):
+    """
+    org.bluez.LEAdvertisement1 interface implementation
+    """
+    PATH_BASE = '/com/pisugar/wifi/advertisement'
+
+    def __init__(self, index, service_uuid, local_name):
+        super().__init__(LE_ADVERTISEMENT_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.service_uuid = service_uuid
+        self.local_name = local_name
+        self.interval = FAST_INTERVAL
+        self.status = encode_status(None)
+
+    def set_interval(self, interval):
+        self.interval = interval
+
+    def set_status(self, data):
+        self.status = data
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> 's':
+        return 'peripheral'
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceUUIDs(self) -> 'as':
+        return [self.service_uuid]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LocalName(self) -> 's':
+        return self.local_name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ManufacturerData(self) -> 'a{qv}':
+        return {MANUFACTURER_ID: Variant('ay', self.status)}
+
+    @dbus_property(access=PropertyAccess.READ)
+    def MinInterval(self) -> 'u':
+        return self.interval
+
+    @dbus_property(access=PropertyAccess.READ)
+    def MaxInterval(self) -> 'u':
+        return self.interval
+
+    @method()
+    def Release(self):
+        print('%s: Released!' % self.path)
+
+
+def build_service(key, net_state, sessions, scanner):
+    service = Service(0, SERVICE_ID, True)
+    chrcs = [
+        ServiceNameChrcAio(0, service),
+        DeviceModelChrcAio(1, service),
+        WifiNameChrcAio(2, service, net_state),
+        IPAddressChrcAio(3, service, net_state),
+        InputChrcAio(4, service, key, sessions),
+        InputSepChrcAio(5, service, key, sessions),
+        InputNotifyMessageChrcAio(6, service, sessions),
+        CommandChrcAio(7, service, sessions),
+        ProvisioningStatsChrcAio(8, service, provisioning),
+        ScanChrcAio(9, service, sessions, scanner),
+    ]
+    for chrc in chrcs:
+        service.add_characteristic(chrc)
+    return service
+
+
+def export_service(bus, service):
+    bus.export(service.path, service)
+    for chrc in service.characteristics:
+        bus.export(chrc.path, chrc)
+        for desc in chrc.descriptors:
+            bus.export(desc.path, desc)
+
+
+class AdapterManagerAio(object):
+    """
+    AdapterManager on dbus-next: the same adapter tracking and retries,
+    with BlueZ called through plain messages and the signals taken from a
+    message handler.
+    """
+    RETRY_DELAY = RETRY_DELAY
+    RETRY_MAX = RETRY_MAX
+
+    def __init__(self, bus, app_path, adv_path, all_adapters=False):
+        self.bus = bus
+        self.app_path = app_path
+        self.adv_path = adv_path
+        self.all_adapters = all_adapters
+        self.adapters = {}
+        self.advertising = True
+        self.retry_handle = None
+        self.retry_delay = self.RETRY_DELAY
+        self.scanning = None
+        self.changing = None
+
+    async def start(self):
+        self.bus.add_message_handler(self.on_message)
+        for rule in ("type='signal',sender='%s',interface='%s'" % (BLUEZ_SERVICE_NAME, DBUS_OM_IFACE),
+                     "type='signal',sender='org.freedesktop.DBus',member='NameOwnerChanged',"
+                     "arg0='%s'" % BLUEZ_SERVICE_NAME):
+            await self.call('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+                            'AddMatch', 's', [rule])
+        self.scan()
+
+    async def call(self, destination, path, interface, member, signature='', body=()):
+        reply = await self.bus.call(Message(destination=destination, path=path,
+                                            interface=interface, member=member,
+                                            signature=signature, body=list(body)))
+        if reply.message_type == MessageType.ERROR:
+            raise DBusError(reply.error_name, reply.body[0] if reply.body else '')
+        return reply.body
+
+    def on_message(self, msg):
+        if msg.message_type != MessageType.SIGNAL:
+            return None
+        if msg.member == 'NameOwnerChanged' and msg.body and msg.body[0] == BLUEZ_SERVICE_NAME:
+            self.owner_changed(msg.body[2])
+        elif msg.interface == DBUS_OM_IFACE and msg.member == 'InterfacesAdded':
+            path, interfaces = msg.body
+            if path not in self.adapters and (GATT_MANAGER_IFACE in interfaces or
+                                              LE_ADVERTISING_MANAGER_IFACE in interfaces):
+                self.scan()
+        elif msg.interface == DBUS_OM_IFACE and msg.member == 'InterfacesRemoved':
+            path, interfaces = msg.body
+            if path in self.adapters and (ADAPTER_IFACE in interfaces or
+                                          GATT_MANAGER_IFACE in interfaces):
+                print('Adapter removed: ' + path)
+                del self.adapters[path]
+                self.scan()
+        return None
+
+    def owner_changed(self, owner):
+        self.adapters.clear()
+        if not owner:
+            print('bluetoothd left the bus')
+            sd_notify('STATUS=Waiting for bluetoothd')
+            return
+        print('bluetoothd on the bus as ' + owner)
+        self.scan()
+
+    def scan(self):
+        if self.scanning is None or self.scanning.done():
+            self.scanning = asyncio.ensure_future(self.do_scan())
+
+    async def do_scan(self):
+        try:
+            objects = (await self.call(BLUEZ_SERVICE_NAME, '/', DBUS_OM_IFACE,
+                                       'GetManagedObjects'))[0]
+        except DBusError as e:
+            print('Failed to list adapters: ' + str(e))
+            self.retry()
+            return
+        adapters = sorted(path for path, interfaces in objects.items() if is_adapter(interfaces))
+        if not adapters:
+            print('BLE adapter not found')
+            sd_notify('STATUS=Waiting for a BLE adapter')
+        for path in adapters:
+            if path in self.adapters:
+                continue
+            if self.adapters and not self.all_adapters:
+                break
+            await self.register(path)
+
+    async def register(self, path):
+        print('Adapter: ' + path)
+        done = self.adapters[path] = set()
+        steps = [('adapter', DBUS_PROP_IFACE, 'Set', 'ssv',
+                  [ADAPTER_IFACE, 'Powered', Variant('b', True)]),
+                 ('application', GATT_MANAGER_IFACE, 'RegisterApplication', 'oa{sv}',
+                  [self.app_path, {}])]
+        for what, interface, member, signature, body in steps:
+            try:
+                await self.call(BLUEZ_SERVICE_NAME, path, interface, member, signature, body)
+            except DBusError as e:
+                if e.type != 'org.bluez.Error.AlreadyExists':
+                    print('Failed to register %s on %s: %s' % (what, path, e))
+                    if self.adapters.get(path) is done:
+                        del self.adapters[path]
+                        self.retry()
+                    return
+            if self.adapters.get(path) is not done:
+                return
+            done.add(what)
+            if what == 'adapter':
+                startup.mark('adapter', 'Adapter ' + path + ' powered')
+            else:
+                print('GATT application registered on ' + path)
+                startup.mark('registered', 'GATT application registered')
+        self.retry_delay = self.RETRY_DELAY
+        if self.advertising:
+            await self.advertise(path)
+
+    async def advertise(self, path):
+        done = self.adapters.get(path)
+        if done is None or 'advertisement' in done or 'advertising' in done:
+            return
+        done.add('advertising')
+        try:
+            await self.call(BLUEZ_SERVICE_NAME, path, LE_ADVERTISING_MANAGER_IFACE,
+                            'RegisterAdvertisement', 'oa{sv}', [self.adv_path, {}])
+        except DBusError as e:
+            done.discard('advertising')
+            if e.type != 'org.bluez.Error.AlreadyExists':
+                print('Failed to register advertisement on %s: %s' % (path, e))
+                if self.adapters.get(path) is done:
+                    del self.adapters[path]
+                    self.retry()
+                return
+        done.discard('advertising')
+        if self.adapters.get(path) is not done:
+            return
+        done.add('advertisement')
+        if not self.advertising:
+            # stopped while registering
+            await self.unadvertise(path)
+            return
+        if 'stale' in done:
+            done.discard('stale')
+            await self.unadvertise(path)
+            await self.advertise(path)
+            return
+        print('Advertisement registered on ' + path)
+        startup.mark('advertising', 'Advertisement registered')
+
+    async def unadvertise(self, path):
+        self.adapters[path].discard('advertisement')
+        try:
+            await self.call(BLUEZ_SERVICE_NAME, path, LE_ADVERTISING_MANAGER_IFACE,
+                            'UnregisterAdvertisement', 'o', [self.adv_path])
+        except DBusError as e:
+            print(str(e))
+
+    def retry(self):
+        if self.retry_handle is not None:
+            return
+        print('Retrying in %.1f s' % self.retry_delay)
+        self.retry_handle = asyncio.get_event_loop().call_later(self.retry_delay, self.retry_scan)
+        self.retry_delay = min(self.retry_delay * 2, self.RETRY_MAX)
+
+    def retry_scan(self):
+        self.retry_handle = None
+        self.scan()
+
+    def queue(self, change, *args):
+        """
+        Run advertising changes, coroutine functions, one after the other.
+        """
+        previous = self.changing
+        self.changing = asyncio.ensure_future(self.after(previous, change, *args))
+        return self.changing
+
+    async def after(self, previous, change, *args):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await change(*args)
+
+    async def start_advertising(self):
+        self.advertising = True
+        if self.adapters:
+            # otherwise the status still says what it waits for
+            sd_notify('STATUS=Advertising')
+        await self.refresh_advertising()
+        for path in list(self.adapters):
+            await self.advertise(path)
+
+    async def refresh_advertising(self):
+        if not self.advertising:
+            return
+        for path, done in list(self.adapters.items()):
+            if 'advertising' in done:
+                done.add('stale')
+            elif 'advertisement' in done:
+                await self.unadvertise(path)
+                await self.advertise(path)
+
+    async def stop_advertising(self):
+        if not self.advertising:
+            return
+        self.advertising = False
+        print('Stop advertising...')
+        sd_notify('STATUS=Advertising stopped')
+        for path, done in list(self.adapters.items()):
+            if 'advertisement' in done:
+                await self.unadvertise(path)
+
+
+class AdvertisingSchedulerAio(AdvertisingScheduler):
+    """
+    AdvertisingScheduler driven by an asyncio event loop, changes queued
+    on the AdapterManagerAio.
+    """
+    def __init__(self, plan, adapters, adv, loop):
+        super().__init__(plan, self.schedule)
+        self.adapters = adapters
+        self.adv = adv
+        self.loop = loop
+
+    def schedule(self, phase, interval):
+        self.adapters.queue(self.change, phase, interval)
+
+    async def change(self, phase, interval):
+        if phase == STOPPED:
+            await self.adapters.stop_advertising()
+            return
+        self.adv.set_interval(interval)
+        await self.adapters.start_advertising()
+
+    def call_later(self, ms, callback, *args):
+        return self.loop.call_later(ms / 1000.0, callback, *args)
+
+    def cancel(self, source):
+        source.cancel()
+
+
+class StatusBroadcastAio(StatusBroadcast):
+    """
+    StatusBroadcast on an asyncio event loop; pisugar-server is read in
+    the default executor and the advertisement refreshed through the
+    AdapterManagerAio queue.
+    """
+    def __init__(self, adv, net_state, adapters, loop, battery_address=PISUGAR_SERVER):
+        super().__init__(adv, net_state, self.refresh, battery_address)
+        self.adapters = adapters
+        self.loop = loop
+
+    def refresh(self):
+        self.adapters.queue(self.adapters.refresh_advertising)
+
+    def poll_battery(self):
+        future = self.loop.run_in_executor(None, read_battery, self.battery_address)
+        future.add_done_callback(lambda f: self.set_battery(f.result()))
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def call_every(self, seconds, callback):
+        def tick():
+            callback()
+            self.loop.call_later(seconds, tick)
+        self.loop.call_later(seconds, tick)
+
+
+async def serve(args, stop):
+    loop = asyncio.get_event_loop()
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+    net_state = NetworkStateCache(WIFI_IFACE, ttl=args.state_ttl)
+    net_monitor = AsyncioNetlinkMonitor(WIFI_IFACE, loop)
+    net_monitor.add_listener(net_state.refresh)
+    net_state.add_listener(provisioning.on_state_changed)
+
+    sessions = SessionTable(new_reassembler, idle_timeout=args.session_timeout)
+    scanner = ScanResults(WIFI_IFACE, ttl=args.scan_ttl)
+    service = build_service(args.key, net_state, sessions, scanner)
+    export_service(bus, service)
+    Application(bus, [service]).start()
+    adv = Advertisement(0, SERVICE_ID, 'pisugar')
+    bus.export(adv.path, adv)
+    startup.mark('objects')
+
+    adapters = AdapterManagerAio(bus, '/', adv.path, args.all_adapters)
+    status = StatusBroadcastAio(adv, net_state, adapters, loop,
+                                battery_address=None if args.no_battery else PISUGAR_SERVER)
+    status.start()
+    scheduler = AdvertisingSchedulerAio(advertising_plan(args), adapters, adv, loop)
+    scheduler.arm()
+    loop.add_signal_handler(signal.SIGUSR1, scheduler.arm)
+    # the loop runs: READY=1 before waiting for bluetoothd, see StartupTimer
+    startup.running()
+    await adapters.start()
+
+    net_monitor.start()
+
+    await stop.wait()
+
+    net_monitor.stop()
+    try:
+        await asyncio.wait_for(adapters.stop_advertising(), STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        print('bluetoothd did not answer UnregisterAdvertisement')
+    bus.disconnect()
+
+
+def run(args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        loop.run_until_complete(serve(args, stop))
+    finally:
+        loop.close()
@@ -0,0 +1,373 @@
+import binascii
+import collections
+import os
+import selectors
+import shlex
+import signal
+import struct
+import subprocess
+import threading
+import time
+
+from .metrics import metrics, subprocesses
+
+FRAME_STDOUT =                 0x01
+FRAME_STDERR =                 0x02
+FRAME_END =                    0x03
+
+END_EXITED =                   0x00
+END_TIMEOUT =                  0x01
+END_CANCELLED =                0x02
+END_FAILED =                   0x03
+END_REJECTED =                 0x04
+
+CANCEL =                       0x18
+
+# command id, sequence number, frame type
+FRAME_HEADER = struct.Struct('>BHB')
+# exit code, END_* reason
+END_PAYLOAD = struct.Struct('>iB')
+
+ATT_HEADER_SIZE = 3
+# pipe reads, whatever the notification size
+READ_SIZE = 4096
+
+
+def frame(cmd_id, seq, frame_type, payload=b''):
+    return FRAME_HEADER.pack(cmd_id, seq & 0xffff, frame_type) + payload
+
+
+def chunk_size(mtu):
+    """
+    Output bytes that fit in one notification after the frame header.
+    """
+    return max(1, mtu - ATT_HEADER_SIZE - FRAME_HEADER.size)
+
+
+def parse_cancel(value):
+    """
+    Return (True, command id or None) for a cancel request, (False, None)
+    for a command. A cancel is CANCEL alone (all commands) or followed by
+    one command id byte.
+    """
+    if len(value) in (1, 2) and value[0] == CANCEL:
+        return True, value[1] if len(value) == 2 else None
+    return False, None
+
+
+class MarkerFilter(object):
+    """
+    Pass through the output of a command run in a WorkerShell, up to the
+    end marker the shell prints after it. A tail as long as the marker is
+    held back, since the marker may be split across reads. With `end` the
+    output is done once the trailer after the marker holds it.
+    """
+    def __init__(self, marker, end=None):
+        self.marker = marker
+        self.end = end
+        self.buf = b''
+        self.found = False
+        self.trailer = b''
+
+    @property
+    def done(self):
+        return self.found and (self.end is None or self.end in self.trailer)
+
+    def feed(self, data):
+        if self.found:
+            self.trailer += data
+            return b''
+        self.buf += data
+        index = self.buf.find(self.marker)
+        if index >= 0:
+            self.found = True
+            self.trailer = self.buf[index + len(self.marker):]
+            out, self.buf = self.buf[:index], b''
+            return out
+        keep = min(len(self.marker) - 1, len(self.buf))
+        out, self.buf = self.buf[:len(self.buf) - keep], self.buf[len(self.buf) - keep:]
+        return out
+
+    def flush(self):
+        out, self.buf = self.buf, b''
+        return out
+
+
+class WorkerShell(object):
+    """
+    Long-lived bash that runs commands in a subshell, which is a cheap fork
+    instead of a fork+exec of a new interpreter. It is killed with the
+    command on timeout or cancel and started again for the next one.
+    """
+    def __init__(self):
+        self.proc = None
+
+    def ensure(self):
+        if self.proc is None or self.proc.poll() is not None:
+            metrics.inc(subprocesses, 'shell')
+            self.proc = subprocess.Popen(['bash', '--noprofile', '--norc'],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         start_new_session=True)
+        return self.proc
+
+    def submit(self, cmd, token):
+        # eval reports syntax errors of `cmd` without eating the markers
+        script = "( eval %s ) </dev/null; printf '\\n%s %%d\\n' \"$?\"; printf '%s' >&2\n" % (
+            shlex.quote(cmd), token, token)
+        proc = self.ensure()
+        proc.stdin.write(script.encode())
+        proc.stdin.flush()
+        return proc
+
+    def close(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
+
+class CommandRun(object):
+    """
+    One `bash -c` command whose stdout/stderr are streamed as frames of at
+    most `chunk` bytes while it runs, followed by an END frame carrying the
+    exit code. `emit(value, block)` may block: then the pipes fill up and
+    the command is paused, so memory stays bounded however much it prints.
+    """
+    def __init__(self, cmd_id, cmd, emit, chunk, timeout):
+        self.cmd_id = cmd_id
+        self.cmd = cmd
+        self.emit = emit
+        self.chunk = chunk
+        self.timeout = timeout
+        self.seq = 0
+        self.proc = None
+        self.reason = END_EXITED
+        self.cancelled = threading.Event()
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+
+    def send(self, frame_type, payload=b''):
+        self.emit(frame(self.cmd_id, self.seq, frame_type, payload))
+        self.seq += 1
+
+    def end(self, returncode, reason):
+        self.finished_at = time.monotonic()
+        self.send(FRAME_END, END_PAYLOAD.pack(returncode, reason))
+
+    def reject(self):
+        # called on the submitting thread, which may be the one draining
+        # the notifications: never wait for room
+        self.finished_at = time.monotonic()
+        self.emit(frame(self.cmd_id, self.seq, FRAME_END, END_PAYLOAD.pack(-1, END_REJECTED)),
+                  block=False)
+        self.seq += 1
+
+    def cancel(self):
+        self.cancelled.set()
+        self.kill(END_CANCELLED)
+
+    def kill(self, reason):
+        proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return
+        self.reason = reason
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run(self, shell=None):
+        self.started_at = time.monotonic()
+        if self.cancelled.is_set():
+            self.end(-1, END_CANCELLED)
+            return
+        filters = {}
+        try:
+            if shell is None:
+                metrics.inc(subprocesses, 'command')
+                self.proc = subprocess.Popen(['bash', '-c', self.cmd],
+                                             stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE,
+                                             start_new_session=True)
+            else:
+                token = 'END-' + binascii.hexlify(os.urandom(8)).decode()
+                self.proc = shell.submit(self.cmd, token)
+                filters[FRAME_STDOUT] = MarkerFilter(('\n%s ' % token).encode(), b'\n')
+                filters[FRAME_STDERR] = MarkerFilter(token.encode())
+        except OSError as e:
+            print('Command failed: ' + str(e))
+            self.end(-1, END_FAILED)
+            return
+        if self.cancelled.is_set():
+            self.kill(END_CANCELLED)
+
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        sel = selectors.DefaultSelector()
+        sel.register(self.proc.stdout, selectors.EVENT_READ, FRAME_STDOUT)
+        sel.register(self.proc.stderr, selectors.EVENT_READ, FRAME_STDERR)
+        try:
+            while sel.get_map():
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        print('Command timeout: ' + self.cmd)
+                        self.kill(END_TIMEOUT)
+                        deadline = None
+                        wait = None
+                for key, _ in sel.select(wait):
+                    data = os.read(key.fileobj.fileno(), READ_SIZE)
+                    f = filters.get(key.data)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        if f is not None:
+                            data = f.flush()
+                    elif f is not None:
+                        data = f.feed(data)
+                        if f.done:
+                            sel.unregister(key.fileobj)
+                    # filtered output may exceed one chunk
+                    for i in range(0, len(data), self.chunk):
+                        self.send(key.data, data[i:i + self.chunk])
+        finally:
+            sel.close()
+            if shell is None:
+                self.proc.stdout.close()
+                self.proc.stderr.close()
+
+        if shell is None:
+            returncode = self.proc.wait()
+        elif filters[FRAME_STDOUT].done:
+            returncode = int(filters[FRAME_STDOUT].trailer.split(b'\n')[0] or 0)
+        else:
+            # the shell died with the command, start a new one next time
+            returncode = self.proc.wait()
+            shell.close()
+        self.end(returncode, self.reason)
+
+
+class CommandStats(object):
+    """
+    Queue wait and run time of recent commands, in seconds.
+    """
+    def __init__(self, size=64):
+        self.lock = threading.Lock()
+        self.recent = collections.deque(maxlen=size)
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.wait_max = 0.0
+        self.run_max = 0.0
+
+    def record(self, run):
+        self.add(run.cmd_id, run.started_at - run.queued_at, run.finished_at - run.started_at)
+
+    def add(self, cmd_id, wait, elapsed):
+        with self.lock:
+            self.recent.append((wait, elapsed))
+            self.completed += 1
+            self.wait_total += wait
+            self.run_total += elapsed
+            self.wait_max = max(self.wait_max, wait)
+            self.run_max = max(self.run_max, elapsed)
+        print('Command %d done: waited %.3fs, ran %.3fs' % (cmd_id, wait, elapsed))
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self.lock:
+            completed = max(self.completed, 1)
+            return {
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_avg': self.wait_total / completed,
+                'wait_max': self.wait_max,
+                'run_avg': self.run_total / completed,
+                'run_max': self.run_max,
+                'recent': list(self.recent),
+            }
+
+    def register(self, registry=metrics):
+        """
+        Export the counts, average and max times as metrics collectors.
+        """
+        registry.add_collector(self.commands_collector)
+        registry.add_collector(lambda: self.time_collector('wait', 'Seconds commands waited '
+                                                           'for a worker'))
+        registry.add_collector(lambda: self.time_collector('run', 'Seconds commands ran'))
+
+    def commands_collector(self):
+        stats = self.snapshot()
+        return ('pisugar_commands_total', 'counter', 'Custom commands by outcome',
+                [({'outcome': 'completed'}, stats['completed']),
+                 ({'outcome': 'rejected'}, stats['rejected'])])
+
+    def time_collector(self, name, help):
+        stats = self.snapshot()
+        return ('pisugar_command_%s_seconds' % name, 'gauge', help,
+                [({'stat': 'avg'}, stats[name + '_avg']), ({'stat': 'max'}, stats[name + '_max'])])
+
+
+class CommandExecutor(object):
+    """
+    Run CommandRuns on at most `workers` threads, fed by a FIFO of at most
+    `max_queue` waiting commands; commands beyond that are rejected with
+    an END_REJECTED frame. Workers are started on demand. With
+    `persistent_shell` each worker keeps a WorkerShell.
+    """
+    def __init__(self, workers=2, max_queue=8, persistent_shell=False):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.persistent_shell = persistent_shell
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.threads = []
+        self.idle = 0
+        self.stats = CommandStats()
+
+    def submit(self, run, done=None):
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                accepted = False
+            else:
+                run.queued_at = time.monotonic()
+                self.queue.append((run, done))
+                # idle workers may not have woken up for earlier commands yet
+                if len(self.queue) > self.idle and len(self.threads) < self.workers:
+                    t = threading.Thread(target=self.worker, daemon=True)
+                    self.threads.append(t)
+                    t.start()
+                self.not_empty.notify()
+                accepted = True
+        if not accepted:
+            self.stats.reject()
+            print('Command queue full, reject command %d' % run.cmd_id)
+            run.reject()
+            if done is not None:
+                done(run)
+        return accepted
+
+    def worker(self):
+        shell = WorkerShell() if self.persistent_shell else None
+        while True:
+            with self.lock:
+                self.idle += 1
+                self.not_empty.wait_for(lambda: self.queue)
+                self.idle -= 1
+                run, done = self.queue.popleft()
+            try:
+                run.run(shell)
+                self.stats.record(run)
+            except Exception as e:
+                print('Command failed: ' + str(e))
+            finally:
+                if done is not None:
+                    done(run)
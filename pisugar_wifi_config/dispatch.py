@@ -0,0 +1,149 @@
+import collections
+import threading
+import time
+
+from .metrics import metrics, notifications_dropped
+
+
+def idle_add(fn):
+    # imported on first use, the asyncio engine runs without GLib
+    from gi.repository import GLib
+    return GLib.idle_add(fn)
+
+
+class MainLoopDispatcher(object):
+    """
+    Run callables posted from any thread on the GLib main loop.
+
+    Worker threads must not talk to dbus-python while the main loop is
+    servicing BlueZ, so they post here instead. Items are queued under a
+    lock and one idle source drains them in batches of `batch_size`,
+    rescheduling itself while items remain. `schedule(fn)` defaults to
+    GLib.idle_add.
+    """
+    def __init__(self, batch_size=32, schedule=None):
+        self.batch_size = batch_size
+        self.schedule = schedule or idle_add
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.posted = 0
+        self.dispatched = 0
+
+    def post(self, fn, *args):
+        with self.lock:
+            self.queue.append((fn, args))
+            self.posted += 1
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.schedule(self.drain)
+
+    def call(self, fn, *args):
+        """
+        Run `fn` now when on the main thread, otherwise post it.
+        """
+        if threading.current_thread() is threading.main_thread():
+            fn(*args)
+        else:
+            self.post(fn, *args)
+
+    def drain(self):
+        for _ in range(self.batch_size):
+            with self.lock:
+                if not self.queue:
+                    self.scheduled = False
+                    return False
+                fn, args = self.queue.popleft()
+                self.dispatched += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                print('Dispatch failed: ' + str(e))
+        with self.lock:
+            if self.queue:
+                return True
+            self.scheduled = False
+            return False
+
+
+main_dispatcher = MainLoopDispatcher()
+
+
+class NotificationQueue(object):
+    """
+    Bounded FIFO of notification values for one characteristic.
+
+    put() is thread safe and wakes the main loop right away. Values are
+    sent in order, at most one every `interval` seconds so that a slow
+    central is not flooded. When `maxlen` values are already waiting the
+    oldest one is dropped and counted, and put() returns False, unless
+    `block` is set: then a producer thread waits for room instead. Only
+    the main loop makes room, so it never waits there.
+    """
+    def __init__(self, send, maxlen=32, interval=0.02, dispatcher=None):
+        self.send = send
+        self.maxlen = maxlen
+        self.interval = interval
+        self.dispatcher = dispatcher or main_dispatcher
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+        self.timer = None
+        self.sent_at = 0
+        self.sent = 0
+        self.dropped = 0
+        # metrics label, the characteristic owning `send`
+        self.name = type(getattr(send, '__self__', send)).__name__
+
+    def put(self, value, block=False, timeout=None):
+        accepted = True
+        if block and threading.current_thread() is threading.main_thread():
+            # waiting here would keep drain() from ever running
+            print('Notification queue: blocking put() on the main loop')
+            block = False
+        with self.lock:
+            if block:
+                self.not_full.wait_for(lambda: len(self.queue) < self.maxlen, timeout)
+            if len(self.queue) >= self.maxlen:
+                self.queue.popleft()
+                self.dropped += 1
+                accepted = False
+            self.queue.append(value)
+        if not accepted:
+            metrics.inc(notifications_dropped, self.name)
+            print('Notification queue full, %d dropped' % self.dropped)
+        self.dispatcher.post(self.drain)
+        return accepted
+
+    def clear(self):
+        with self.lock:
+            self.queue.clear()
+            self.not_full.notify_all()
+
+    def drain(self):
+        if self.timer is not None:
+            return
+        while True:
+            wait = self.interval - (time.monotonic() - self.sent_at)
+            with self.lock:
+                if not self.queue:
+                    return
+                if wait <= 0:
+                    value = self.queue.popleft()
+                    self.not_full.notify()
+            if wait > 0:
+                from gi.repository import GLib
+                self.timer = GLib.timeout_add(int(wait * 1000) + 1, self.on_timer)
+                return
+            self.sent_at = time.monotonic()
+            self.sent += 1
+            try:
+                self.send(value)
+            except Exception as e:
+                print('Notify failed: ' + str(e))
+
+    def on_timer(self):
+        self.timer = None
+        self.drain()
+        return False
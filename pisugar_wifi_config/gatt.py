@@ -0,0 +1,519 @@
+"""
+Engine neutral parts of the GATT server: BlueZ names and UUIDs, what each
+characteristic reads, writes and notifies, and applying wifi credentials.
+The GLib (glib.py) and asyncio (aio.py) engines bind these to D-Bus, so
+nothing here imports dbus-python, dbus-next or GLib.
+"""
+import json
+import subprocess
+import time
+
+from .advertising import AdvertisingPlan
+from .commands import chunk_size, parse_cancel
+from .metrics import metrics, notifications_sent, subprocesses
+from .protocol import (VERSIONS as PROTOCOL_VERSIONS, ProtocolError, UnsupportedVersion,
+                       WifiRequest, decode_request, is_binary)
+from .provisioning import (APPLIED, DERIVED, OUTCOME_INVALID_CONFIG, OUTCOME_INVALID_KEY,
+                           OUTCOME_REJECTED, VALIDATED, provisioning)
+from .psk import psk_deriver
+from .reassembly import InvalidOffset, MessageReassembler, MessageTooLong
+from .scan import REQUEST_SNAPSHOT, encode_snapshot
+from .wpa_conf import WpaConfig
+from .wpa_ctrl import WpaCtrlError, WpaCtrlUnavailable, WpaSupplicant
+
+BLUEZ_SERVICE_NAME =           'org.bluez'
+DBUS_OM_IFACE =                'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE =              'org.freedesktop.DBus.Properties'
+
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE =       'org.bluez.LEAdvertisement1'
+
+ADAPTER_IFACE =                'org.bluez.Adapter1'
+GATT_MANAGER_IFACE =           'org.bluez.GattManager1'
+GATT_SERVICE_IFACE =           'org.bluez.GattService1'
+GATT_CHRC_IFACE =              'org.bluez.GattCharacteristic1'
+GATT_DESC_IFACE =              'org.bluez.GattDescriptor1'
+
+LOCAL_NAME =                   'rpi-gatt-server'
+
+SERVICE_ID = 'fd2b4448-aa0f-4a15-a62f-eb0be77a0000'
+SERVICE_NAME= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0001'
+DEVICE_MODEL= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0002'
+WIFI_NAME= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0003'
+IP_ADDRESS= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0004'
+INPUT= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0005'
+NOTIFY_MESSAGE= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0006'
+INPUT_SEP= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0007'
+CUSTOM_COMMAND_INPUT= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0008'
+CUSTOM_COMMAND_NOTIFY= 'fd2b4448-aa0f-4a15-a62f-eb0be77a0009'
+PROVISIONING_STATS= 'fd2b4448-aa0f-4a15-a62f-eb0be77a000a'
+SCAN_RESULTS= 'fd2b4448-aa0f-4a15-a62f-eb0be77a000b'
+CUSTOM_INFO_LABEL= 'FD2BCCCA'
+CUSTOM_INFO_COUNT= 'FD2BCCAA0000'
+CUSTOM_INFO= 'FD2BCCCB'
+CUSTOM_COMMAND_LABEL= 'FD2BCCCC'
+CUSTOM_COMMAND_COUNT= 'FD2BCCAC0000'
+
+SSH_CHRC='fd2b4448-aa0f-4a15-a62f-eb0be77a0020'
+
+WPA_CONFIG = '/etc/wpa_supplicant/wpa_supplicant.conf'
+DEVICE_TREE_MODEL = '/proc/device-tree/model'
+WIFI_IFACE = 'wlan0'
+
+SEP = '%&%'
+END = '&#&'
+
+# adapter registration retries, in seconds
+RETRY_DELAY = 0.5
+RETRY_MAX = 10
+
+
+class NotSupported(Exception):
+    """
+    Raised by the values below for a GATT operation they do not serve;
+    the engines answer org.bluez.Error.NotSupported.
+    """
+
+
+# errors of the values below -> BlueZ errors returned by the engines,
+# anything else fails the call
+ERRORS = ((NotSupported, 'org.bluez.Error.NotSupported'),
+          (InvalidOffset, 'org.bluez.Error.InvalidOffset'),
+          (MessageTooLong, 'org.bluez.Error.InvalidValueLength'))
+FAILED = 'org.bluez.Error.Failed'
+
+
+def error_name(e):
+    for cls, name in ERRORS:
+        if isinstance(e, cls):
+            return name
+    return FAILED
+
+
+class Attribute(object):
+    """
+    What characteristics and descriptors have in common on both engines.
+    ReadValue returns read(options): the part of read_value() asked for by
+    the `offset` and `mtu` options, sliced from a ReadBuffer the engine
+    sets as `read_buffer`.
+    """
+    def read(self, options):
+        return self.read_buffer.read(self.read_value(options), int(options.get('offset', 0)),
+                                     int(options.get('mtu', 0)))
+
+    def read_value(self, options):
+        """
+        Current value, str or bytes.
+        """
+        raise NotSupported('read')
+
+    def write_value(self, value, options):
+        raise NotSupported('write')
+
+
+class Notifier(Attribute):
+    """
+    Notification policy of a characteristic, shared by both engines: a
+    value identical to the last one sent is dropped (NOTIFY_DEDUPE), and
+    values produced within NOTIFY_WINDOW seconds of the last notification
+    are coalesced so that only the latest one is sent when the window
+    closes. Engines call coalesce_notify() on their event loop and provide
+    the hooks call_later(seconds, callback) and emit_value(value).
+    """
+    NOTIFY_WINDOW = 0.1
+    NOTIFY_DEDUPE = True
+
+    notifying = False
+    last_notified = None
+    last_notified_at = 0
+    pending_value = None
+    pending_source = None
+
+    def coalesce_notify(self, value):
+        if not self.notifying:
+            return
+        if self.pending_source is not None:
+            self.pending_value = value
+            return
+        if self.NOTIFY_DEDUPE and value == self.last_notified:
+            return
+        elapsed = time.monotonic() - self.last_notified_at
+        if self.NOTIFY_WINDOW > 0 and elapsed < self.NOTIFY_WINDOW:
+            self.pending_value = value
+            self.pending_source = self.call_later(self.NOTIFY_WINDOW - elapsed,
+                                                  self.flush_notify)
+            return
+        self.send_notify(value)
+
+    def flush_notify(self):
+        self.pending_source = None
+        value = self.pending_value
+        self.pending_value = None
+        if value is None or not self.notifying:
+            return
+        if self.NOTIFY_DEDUPE and value == self.last_notified:
+            return
+        self.send_notify(value)
+
+    def send_notify(self, value):
+        self.last_notified = value
+        self.last_notified_at = time.monotonic()
+        metrics.inc(notifications_sent, type(self).__name__)
+        self.emit_value(value)
+
+    def reset_notify(self):
+        """
+        Forget the last value sent, so that a new subscriber gets the next one.
+        """
+        self.last_notified = None
+
+    def start_notify(self):
+        raise NotSupported('notify')
+
+    def stop_notify(self):
+        self.notifying = False
+
+
+# What the characteristics and descriptors do, mixed into the engines'
+# Characteristic and Descriptor classes. The attributes used beyond the
+# class ones (net_state, sessions, key, ...) are set by the engines.
+
+class ServiceNameValue(object):
+    UUID = SERVICE_NAME
+    FLAGS = ['read']
+    NAME = 'PiSugar BLE Wifi Config'
+
+    def read_value(self, options):
+        return self.NAME
+
+
+class ServiceNameDescriptorValue(object):
+    UUID = '2001'
+    FLAGS = ['read']
+    VALUE = 'PiSugar BLE Wifi Config'
+
+    def read_value(self, options):
+        return self.VALUE
+
+
+class DeviceModelValue(object):
+    UUID = DEVICE_MODEL
+    FLAGS = ['read']
+    model = None
+
+    def read_value(self, options):
+        if self.model is None:
+            self.model = read_model()
+        return self.model
+
+
+class DeviceModelDescriptorValue(object):
+    UUID = '2002'
+    FLAGS = ['read']
+    VALUE = 'Raspberry Hardware Model'
+
+    def read_value(self, options):
+        return self.VALUE
+
+
+class NetworkStateValue(object):
+    """
+    FIELD of the shared NetworkStateCache, notified when it changes.
+    """
+    FLAGS = ['read', 'notify']
+    FIELD = None
+
+    def read_value(self, options):
+        return getattr(self.net_state.get(), self.FIELD) or ''
+
+    def start_notify(self):
+        if self.notifying:
+            print("Already notifying, nothing to do")
+            return
+        self.notifying = True
+        self.reset_notify()
+        self.on_state_changed(self.net_state.get(), None)
+
+    def on_state_changed(self, state, old_state):
+        # '' once unset, as a read returns
+        self.notify_value((getattr(state, self.FIELD) or '').encode())
+
+
+class WifiNameValue(NetworkStateValue):
+    UUID = WIFI_NAME
+    FIELD = 'ssid'
+
+
+class IPAddressValue(NetworkStateValue):
+    UUID = IP_ADDRESS
+    FIELD = 'ip_addr'
+
+
+class WifiInputValue(object):
+    def apply(self, session, msg):
+        if not set_wifi_message(msg, self.key, session.post, provisioning.start()):
+            session.post('Invalid key')
+
+
+class InputValue(WifiInputValue):
+    """
+    Set wifi SSID and password, one message per write, binary or legacy
+    text, see set_wifi_message().
+    """
+    UUID = INPUT
+    FLAGS = ['write', 'write-without-response']
+
+    def write_value(self, value, options):
+        session = self.sessions.get(options)
+        try:
+            self.apply(session, bytes(value))
+        except Exception as e:
+            print('%s: %s' % (type(self).__name__, e))
+
+
+class InputSepValue(WifiInputValue):
+    """
+    Set wifi SSID and password, written in chunks, see MessageReassembler.
+    A read returns the binary protocol versions supported, for apps to
+    pick one; older apps keep writing the legacy text.
+    """
+    UUID = INPUT_SEP
+    FLAGS = ['read', 'write', 'write-without-response']
+    WRITE_TIMEOUT = 5.0
+
+    def read_value(self, options):
+        return bytes(PROTOCOL_VERSIONS)
+
+    def write_value(self, value, options):
+        session = self.sessions.get(options)
+        for msg in session.reassembler.feed(value, options.get('offset')):
+            print('%s: %d bytes message' % (type(self).__name__, len(msg)))
+            self.apply(session, msg)
+
+
+def new_reassembler():
+    return MessageReassembler(END.encode(), timeout=InputSepValue.WRITE_TIMEOUT)
+
+
+class InputNotifyMessageValue(object):
+    """
+    Status messages. Every message posted to a session is notified in
+    order as soon as it is produced (on_status). A read returns the oldest
+    message pending for the reading central only; notifications are sent
+    by BlueZ to every subscribed central.
+    """
+    UUID = NOTIFY_MESSAGE
+    FLAGS = ['read', 'notify']
+
+    def read_value(self, options):
+        return self.sessions.get(options).read_message(options)
+
+    def start_notify(self):
+        self.notifying = True
+
+
+class CommandValue(object):
+    """
+    Run a shell command. Output is streamed while the command runs as
+    MTU-sized notifications: command id, sequence number, frame type and
+    data, ending with an END frame carrying the exit code. Writing CANCEL
+    (optionally followed by a command id) kills running commands.
+
+    At most COMMAND_WORKERS commands run at once and COMMAND_QUEUE more
+    wait, others end right away with END_REJECTED. Engines implement
+    submit(cmd, chunk) and cancel(cmd_id).
+    """
+    UUID = SSH_CHRC
+    FLAGS = ['write', 'write-without-response', 'notify']
+    COMMAND_TIMEOUT = 60
+    COMMAND_WORKERS = 2
+    COMMAND_QUEUE = 8
+    COMMAND_SHELL = False
+
+    def start_notify(self):
+        self.notifying = True
+
+    def write_value(self, value, options):
+        session = self.sessions.get(options)
+        cancel, cmd_id = parse_cancel(value)
+        if cancel:
+            self.cancel(cmd_id)
+            return
+        try:
+            cmd = bytes(value).decode('utf8')
+        except UnicodeDecodeError as e:
+            print(str(e))
+            return
+        self.submit(cmd, chunk_size(session.mtu))
+
+
+class ProvisioningStatsValue(object):
+    """
+    Phases of the latest provisioning run as JSON, see ProvisioningTracker.
+    """
+    UUID = PROVISIONING_STATS
+    FLAGS = ['read']
+
+    def read_value(self, options):
+        return json.dumps(self.tracker.latest() or {}, separators=(',', ':'))
+
+
+class ScanValue(object):
+    """
+    Wifi networks around, from wpa_supplicant scans, as binary records,
+    see scan.py. A read returns the latest results, every BSS as an OP_ADD
+    record, and starts a scan if they are older than the ScanResults ttl;
+    blob reads of a long value are served from the same results.
+
+    While notifying the interface is scanned every ttl seconds and only
+    the BSSes added, changed or removed are notified, in MTU-sized frames
+    (ScanStream). Writing REQUEST_SNAPSHOT has the whole table sent again,
+    for a central that subscribed after another one. Engines run the
+    scans and set `wakeup` (an Event) to have one done right away.
+    """
+    UUID = SCAN_RESULTS
+    FLAGS = ['read', 'write', 'notify']
+
+    def read_value(self, options):
+        return self.sessions.get(options).read_scan(options, self.snapshot)
+
+    def snapshot(self):
+        self.scanner.refresh()
+        return encode_snapshot(self.scanner.latest())
+
+    def write_value(self, value, options):
+        self.sessions.get(options)
+        if bytes(value) != bytes([REQUEST_SNAPSHOT]):
+            raise NotSupported('Unknown request')
+        self.stream.reset()
+        self.wakeup.set()
+
+
+def set_wifi(ssid, password, report=None, run=None, fields=None):
+    """
+    Connect to a wifi network. The PSK is derived from the passphrase on
+    the psk_deriver thread first, which then applies it, so this returns
+    right away. SAE authenticates with the passphrase itself, which is
+    then passed on as is.
+    """
+    def derived(psk):
+        if run is not None:
+            run.mark(DERIVED)
+        apply_wifi(ssid, psk, report, run, fields)
+
+    sae = 'SAE' in (fields or {}).get('key_mgmt', '')
+    psk_deriver.submit(ssid, password, derived, derive=not sae)
+
+
+def apply_wifi(ssid, psk, report=None, run=None, fields=None):
+    """
+    Connect to a wifi network through the running wpa_supplicant. Only
+    when its control socket is not available is the network saved to
+    the config file and wpa_supplicant restarted; a network it refuses
+    fails the run.
+    """
+    done = None
+    if run is not None:
+        done = lambda connected: provisioning.associated(run, connected)
+    try:
+        WpaSupplicant(WIFI_IFACE).connect(ssid, psk, report, done, fields)
+        if run is not None:
+            run.mark(APPLIED)
+        return
+    except WpaCtrlUnavailable as e:
+        print('wpa_supplicant control interface: ' + str(e))
+    except WpaCtrlError as e:
+        print('wpa_supplicant rejected the network: ' + str(e))
+        if report is not None:
+            report('Wifi ' + ssid + ' failed')
+        if run is not None:
+            run.finish(OUTCOME_REJECTED)
+        return
+
+    try:
+        path = WpaSupplicant.CONFIG or WPA_CONFIG
+        config = WpaConfig(path)
+        config.set_global('ctrl_interface', 'DIR=' + WpaSupplicant.CTRL_DIR)
+        config.upsert(ssid, psk, **dict({'scan_ssid': '1'}, **(fields or {})))
+        config.save()
+        metrics.inc(subprocesses, 'wpa_supplicant')
+        subprocess.run(['killall', 'wpa_supplicant'])
+        metrics.inc(subprocesses, 'wpa_supplicant')
+        subprocess.run(['wpa_supplicant', '-B', '-i', WIFI_IFACE, '-c', path])
+        if run is not None:
+            # association is not watched after a restart, wait for the IP
+            run.mark(APPLIED)
+            provisioning.associated(run, True)
+    except Exception as e:
+        print(str(e))
+
+def parse_and_set_wifi(msg, key, report=None, run=None):
+    configs = msg.split(SEP)
+    if len(configs) != 3:
+        print('Error config')
+        if run is not None:
+            run.finish(OUTCOME_INVALID_CONFIG)
+        return True
+    return set_wifi_request(WifiRequest(configs[0], configs[1], configs[2], None, None, None),
+                            key, report, run)
+
+
+def set_wifi_request(request, key, report=None, run=None):
+    """
+    Check the key of a WifiRequest and apply it; False if the key is wrong.
+    """
+    if request.key != key:
+        if run is not None:
+            run.finish(OUTCOME_INVALID_KEY)
+        return False
+    if run is not None:
+        run.ssid = request.ssid
+        run.mark(VALIDATED)
+    set_wifi(request.ssid, request.password, report, run, request.network_fields())
+    return True
+
+
+def set_wifi_message(msg, key, report=None, run=None):
+    """
+    Apply a credentials message (bytes): binary, see protocol.py, or the
+    legacy 'key%&%ssid%&%password' text. False if the key is wrong.
+    """
+    if not is_binary(msg):
+        try:
+            text = bytes(msg).decode('utf8')
+        except UnicodeDecodeError as e:
+            print('Decode error: ' + str(e))
+            if run is not None:
+                run.finish(OUTCOME_INVALID_CONFIG)
+            return True
+        return parse_and_set_wifi(text, key, report, run)
+    try:
+        request = decode_request(msg)
+    except ProtocolError as e:
+        print('Error config: ' + str(e))
+        if isinstance(e, UnsupportedVersion) and report is not None:
+            report('Unsupported version')
+        if run is not None:
+            run.finish(OUTCOME_INVALID_CONFIG)
+        return True
+    return set_wifi_request(request, key, report, run)
+
+
+def read_model():
+    """
+    Raspberry Pi model, read on first use rather than at startup.
+    """
+    try:
+        with open(DEVICE_TREE_MODEL) as f:
+            return f.read()
+    except FileNotFoundError:
+        print('Failed to open model raspberry pi model file')
+        return ''
+
+
+def advertising_plan(args):
+    return AdvertisingPlan(args.fast_time, args.fast_interval, args.slow_interval, args.time)
+
+
+def is_adapter(interfaces):
+    return LE_ADVERTISING_MANAGER_IFACE in interfaces and GATT_MANAGER_IFACE in interfaces
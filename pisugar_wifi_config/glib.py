@@ -0,0 +1,949 @@
+"""
+GLib engine: the GATT tree on dbus-python, served from a GLib main loop.
+Commands, scans and status notifications are fed by worker threads
+through NotificationQueues. What the characteristics do is in gatt.py.
+"""
+import signal
+import threading
+import time
+
+import dbus
+import dbus.exceptions
+import dbus.mainloop.glib
+import dbus.service
+from gi.repository import GLib
+
+from .advertising import STOPPED, AdvertisingScheduler
+from .commands import CommandExecutor, CommandRun
+from .dispatch import NotificationQueue, main_dispatcher
+from .gatt import (ADAPTER_IFACE, BLUEZ_SERVICE_NAME, DBUS_OM_IFACE, DBUS_PROP_IFACE,
+                   GATT_CHRC_IFACE, GATT_DESC_IFACE, GATT_MANAGER_IFACE, GATT_SERVICE_IFACE,
+                   LE_ADVERTISEMENT_IFACE, LE_ADVERTISING_MANAGER_IFACE, RETRY_DELAY, RETRY_MAX,
+                   SERVICE_ID, WIFI_IFACE, Attribute, CommandValue, DeviceModelDescriptorValue,
+                   DeviceModelValue, InputNotifyMessageValue, InputSepValue, InputValue,
+                   IPAddressValue, NotSupported, Notifier, ProvisioningStatsValue, ScanValue,
+                   ServiceNameDescriptorValue, ServiceNameValue, WifiNameValue, advertising_plan,
+                   error_name, is_adapter, new_reassembler)
+from .metrics import metrics, observe, timed
+from .netinfo import NetworkStateCache
+from .netlink import NetlinkMonitor
+from .provisioning import provisioning
+from .reassembly import FrameError
+from .scan import ScanResults, ScanStream, chunk_size as scan_chunk_size
+from .sessions import SessionTable
+from .startup import sd_notify, startup
+from .status import MANUFACTURER_ID, PISUGAR_SERVER, StatusBroadcast, encode_status
+from .values import ReadBuffer
+
+mainloop = None
+
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
+
+
+class NotSupportedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotSupported'
+
+
+class NotPermittedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.NotPermitted'
+
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidValueLength'
+
+
+class FailedException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Failed'
+
+
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.InvalidOffset'
+
+
+def call(obj, method, fn, *args):
+    """
+    Run a GATT method of `obj`, timed in pisugar_gatt_call_seconds; errors
+    of the values are returned to BlueZ as its own, see gatt.ERRORS.
+    """
+    started = time.perf_counter()
+    failed = True
+    try:
+        result = fn(*args)
+        failed = False
+        return result
+    except (NotSupported, FrameError) as e:
+        print('%s: %s' % (type(obj).__name__, e))
+        raise dbus.exceptions.DBusException(str(e), name=error_name(e))
+    finally:
+        if metrics.enabled:
+            observe(method, type(obj).__name__, started, failed)
+
+
+class Advertisement(dbus.service.Object):
+    PATH_BASE = '/com/pisugar/wifi/advertisement'
+
+    def __init__(self, bus, index, advertising_type):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.ad_type = advertising_type
+        self.service_uuids = None
+        self.manufacturer_data = None
+        self.solicit_uuids = None
+        self.service_data = None
+        self.local_name = None
+        self.include_tx_power = None
+        self.data = None
+        self.min_interval = None
+        self.max_interval = None
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
+        properties = dict()
+        properties['Type'] = self.ad_type
+        if self.service_uuids is not None:
+            properties['ServiceUUIDs'] = dbus.Array(self.service_uuids,
+                                                    signature='s')
+        if self.solicit_uuids is not None:
+            properties['SolicitUUIDs'] = dbus.Array(self.solicit_uuids,
+                                                    signature='s')
+        if self.manufacturer_data is not None:
+            properties['ManufacturerData'] = dbus.Dictionary(
+                self.manufacturer_data, signature='qv')
+        if self.service_data is not None:
+            properties['ServiceData'] = dbus.Dictionary(self.service_data,
+                                                        signature='sv')
+        if self.local_name is not None:
+            properties['LocalName'] = dbus.String(self.local_name)
+        if self.include_tx_power is not None:
+            properties['IncludeTxPower'] = dbus.Boolean(self.include_tx_power)
+        if self.min_interval is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval)
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval)
+
+        if self.data is not None:
+            properties['Data'] = dbus.Dictionary(
+                self.data, signature='yv')
+        return {LE_ADVERTISEMENT_IFACE: dbus.Dictionary(properties, signature='sv')}
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_service_uuid(self, uuid):
+        if not self.service_uuids:
+            self.service_uuids = []
+        self.service_uuids.append(uuid)
+        self.properties = None
+
+    def add_solicit_uuid(self, uuid):
+        if not self.solicit_uuids:
+            self.solicit_uuids = []
+        self.solicit_uuids.append(uuid)
+        self.properties = None
+
+    def add_manufacturer_data(self, manuf_code, data):
+        if not self.manufacturer_data:
+            self.manufacturer_data = dbus.Dictionary({}, signature='qv')
+        self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
+        self.properties = None
+
+    def add_service_data(self, uuid, data):
+        if not self.service_data:
+            self.service_data = dbus.Dictionary({}, signature='sv')
+        self.service_data[uuid] = dbus.Array(data, signature='y')
+        self.properties = None
+
+    def add_local_name(self, name):
+        if not self.local_name:
+            self.local_name = ""
+        self.local_name = dbus.String(name)
+        self.properties = None
+
+    def set_interval(self, min_interval, max_interval=None):
+        """
+        Advertising interval hint in ms, read by BlueZ when the
+        advertisement is registered.
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval or min_interval
+        self.properties = None
+
+    def add_data(self, ad_type, data):
+        if not self.data:
+            self.data = dbus.Dictionary({}, signature='yv')
+        self.data[ad_type] = dbus.Array(data, signature='y')
+        self.properties = None
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        print('GetAll')
+        if interface != LE_ADVERTISEMENT_IFACE:
+            raise InvalidArgsException()
+        print('returning props')
+        return self.get_properties()[LE_ADVERTISEMENT_IFACE]
+
+    @dbus.service.method(LE_ADVERTISEMENT_IFACE,
+                         in_signature='',
+                         out_signature='')
+    def Release(self):
+        print('%s: Released!' % self.path)
+
+
+
+class Application(dbus.service.Object):
+    """
+    org.bluez.GattApplication1 interface implementation
+    """
+    def __init__(self, bus):
+        self.path = '/'
+        self.services = []
+        self.managed_objects = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_service(self, service):
+        self.services.append(service)
+        service.application = self
+        self.invalidate()
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        service.application = None
+        self.invalidate()
+
+    def invalidate(self):
+        self.managed_objects = None
+
+    @timed('GetManagedObjects', 'Application')
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        print('GetManagedObjects')
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+        return self.managed_objects
+
+    def build_managed_objects(self):
+        """
+        The object tree, built once and served until a service,
+        characteristic or descriptor is added or removed. Properties are
+        typed up front so dbus-python does not guess signatures on every
+        reply; the result is shared and must not be modified.
+        """
+        response = {}
+        for service in self.services:
+            response[service.get_path()] = service.get_properties()
+            chrcs = service.get_characteristics()
+            for chrc in chrcs:
+                response[chrc.get_path()] = chrc.get_properties()
+                descs = chrc.get_descriptors()
+                for desc in descs:
+                    response[desc.get_path()] = desc.get_properties()
+
+        return dbus.Dictionary(response, signature='oa{sa{sv}}')
+
+
+class Service(dbus.service.Object):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+    PATH_BASE = '/com/pisugar/wifi/service'
+
+    def __init__(self, bus, index, uuid, primary):
+        self.path = self.PATH_BASE + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.application = None
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_SERVICE_IFACE: dbus.Dictionary({
+                            'UUID': dbus.String(self.uuid),
+                            'Primary': dbus.Boolean(self.primary),
+                            'Characteristics': dbus.Array(
+                                    self.get_characteristic_paths(),
+                                    signature='o')
+                    }, signature='sv')
+            }
+        return self.properties
+
+    def invalidate(self):
+        self.properties = None
+        if self.application is not None:
+            self.application.invalidate()
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def remove_characteristic(self, characteristic):
+        self.characteristics.remove(characteristic)
+        self.invalidate()
+
+    def get_characteristic_paths(self):
+        result = []
+        for chrc in self.characteristics:
+            result.append(chrc.get_path())
+        return result
+
+    def get_characteristics(self):
+        return self.characteristics
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != GATT_SERVICE_IFACE:
+            raise InvalidArgsException()
+
+        return self.get_properties()[GATT_SERVICE_IFACE]
+
+class Characteristic(Notifier, dbus.service.Object):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+
+    Notifications go through notify_value(), from any thread, see
+    gatt.Notifier for the coalescing.
+    """
+    def __init__(self, bus, index, uuid, flags, service):
+        self.path = service.path + '/char' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.notifying = False
+        self.read_buffer = ReadBuffer()
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_CHRC_IFACE: dbus.Dictionary({
+                            'Service': self.service.get_path(),
+                            'UUID': dbus.String(self.uuid),
+                            'Flags': dbus.Array(self.flags, signature='s'),
+                            'Descriptors': dbus.Array(
+                                    self.get_descriptor_paths(),
+                                    signature='o')
+                    }, signature='sv')
+            }
+        return self.properties
+
+    def invalidate(self):
+        self.properties = None
+        self.service.invalidate()
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+        self.invalidate()
+
+    def get_descriptor_paths(self):
+        result = []
+        for desc in self.descriptors:
+            result.append(desc.get_path())
+        return result
+
+    def get_descriptors(self):
+        return self.descriptors
+
+    def notify_value(self, value):
+        """
+        Thread safe: from worker threads the value is marshalled onto the
+        main loop before any D-Bus signal is emitted.
+        """
+        main_dispatcher.call(self.coalesce_notify, bytes(value))
+
+    def call_later(self, seconds, callback):
+        def on_timeout():
+            callback()
+            return False
+        return GLib.timeout_add(int(seconds * 1000), on_timeout)
+
+    def emit_value(self, value):
+        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': dbus.ByteArray(value)}, [])
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != GATT_CHRC_IFACE:
+            raise InvalidArgsException()
+
+        return self.get_properties()[GATT_CHRC_IFACE]
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay')
+    def ReadValue(self, options):
+        return dbus.ByteArray(call(self, 'ReadValue', self.read, options))
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}', byte_arrays=True)
+    def WriteValue(self, value, options):
+        call(self, 'WriteValue', self.write_value, value, options)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StartNotify(self):
+        call(self, 'StartNotify', self.start_notify)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StopNotify(self):
+        call(self, 'StopNotify', self.stop_notify)
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+class Descriptor(Attribute, dbus.service.Object):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+    """
+    def __init__(self, bus, index, uuid, flags, characteristic):
+        self.path = characteristic.path + '/desc' + str(index)
+        self.bus = bus
+        self.uuid = uuid
+        self.flags = flags
+        self.chrc = characteristic
+        self.read_buffer = ReadBuffer()
+        self.properties = None
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        if self.properties is None:
+            self.properties = {
+                    GATT_DESC_IFACE: dbus.Dictionary({
+                            'Characteristic': self.chrc.get_path(),
+                            'UUID': dbus.String(self.uuid),
+                            'Flags': dbus.Array(self.flags, signature='s'),
+                    }, signature='sv')
+            }
+        return self.properties
+
+    def get_path(self):
+        return dbus.ObjectPath(self.path)
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != GATT_DESC_IFACE:
+            raise InvalidArgsException()
+
+        return self.get_properties()[GATT_DESC_IFACE]
+
+    @dbus.service.method(GATT_DESC_IFACE,
+                        in_signature='a{sv}',
+                        out_signature='ay')
+    def ReadValue(self, options):
+        return dbus.ByteArray(call(self, 'ReadValue', self.read, options))
+
+    @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}', byte_arrays=True)
+    def WriteValue(self, value, options):
+        call(self, 'WriteValue', self.write_value, value, options)
+
+
+class ServiceNameChrc(ServiceNameValue, Characteristic):
+    """
+    Service Name Characteristic.
+    """
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.add_descriptor(ServiceNameDescriptor(bus, 0, self))
+
+
+class ServiceNameDescriptor(ServiceNameDescriptorValue, Descriptor):
+    """
+    Service Name Descriptor.
+    """
+    def __init__(self, bus, index, chrc):
+        super().__init__(bus, index, self.UUID, self.FLAGS, chrc)
+
+
+class DeviceModelChrc(DeviceModelValue, Characteristic):
+    """
+    Device Model Charateristic.
+    """
+    def __init__(self, bus, index, service):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.add_descriptor(DeviceModelDescriptor(bus, 0, self))
+
+
+class DeviceModelDescriptor(DeviceModelDescriptorValue, Descriptor):
+    """
+    Device Model Descriptor.
+    """
+    def __init__(self, bus, index, chrc):
+        super().__init__(bus, index, self.UUID, self.FLAGS, chrc)
+
+
+class WifiNameChrc(WifiNameValue, Characteristic):
+    """
+    Wifi Name Characteristic.
+    """
+    def __init__(self, bus, index, service, net_state):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.net_state = net_state
+        net_state.add_listener(self.on_state_changed)
+
+
+class IPAddressChrc(IPAddressValue, Characteristic):
+    """
+    IP Address Characteristic.
+    """
+    def __init__(self, bus, index, service, net_state):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.net_state = net_state
+        net_state.add_listener(self.on_state_changed)
+
+
+class InputChrc(InputValue, Characteristic):
+    def __init__(self, bus, index, service, key, sessions):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.key = key
+        self.sessions = sessions
+
+
+class InputNotifyMessageChrc(InputNotifyMessageValue, Characteristic):
+    """
+    Status messages go through a bounded NotificationQueue, in order.
+    """
+    def __init__(self, bus, index, service, sessions):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        self.queue = NotificationQueue(self.send_notify)
+        sessions.add_listener(self.on_status)
+
+    def stop_notify(self):
+        self.notifying = False
+        self.queue.clear()
+
+    def on_status(self, session, message):
+        if self.notifying:
+            self.queue.put(message.encode())
+
+
+class InputSepChrc(InputSepValue, Characteristic):
+    def __init__(self, bus, index, service, key, sessions):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.key = key
+        self.sessions = sessions
+
+
+class CommandChrc(CommandValue, Characteristic):
+    """
+    Commands run on a CommandExecutor, a pool of COMMAND_WORKERS threads.
+    """
+    def __init__(self, bus, index, service, sessions):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        self.queue = NotificationQueue(self.send_notify, maxlen=64, interval=0.005)
+        self.executor = CommandExecutor(self.COMMAND_WORKERS, self.COMMAND_QUEUE,
+                                        self.COMMAND_SHELL)
+        self.executor.stats.register()
+        self.runs = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def cancel(self, cmd_id):
+        with self.lock:
+            runs = [run for run in self.runs.values() if cmd_id in (None, run.cmd_id)]
+        for run in runs:
+            print('Cancel command %d' % run.cmd_id)
+            run.cancel()
+
+    def submit(self, cmd, chunk):
+        with self.lock:
+            cmd_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xff
+            run = CommandRun(cmd_id, cmd, self.emit, chunk, self.COMMAND_TIMEOUT)
+            self.runs[cmd_id] = run
+        self.executor.submit(run, self.finished)
+
+    def emit(self, value, block=True):
+        self.queue.put(value, block=block)
+
+    def finished(self, run):
+        with self.lock:
+            if self.runs.get(run.cmd_id) is run:
+                del self.runs[run.cmd_id]
+
+
+class ProvisioningStatsChrc(ProvisioningStatsValue, Characteristic):
+    def __init__(self, bus, index, service, tracker):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.tracker = tracker
+
+
+class ScanChrc(ScanValue, Characteristic):
+    """
+    Scans run on a thread while notifying, frames go through a
+    NotificationQueue.
+    """
+    def __init__(self, bus, index, service, sessions, scanner):
+        super().__init__(bus, index, self.UUID, self.FLAGS, service)
+        self.sessions = sessions
+        self.scanner = scanner
+        self.stream = ScanStream()
+        self.queue = NotificationQueue(self.send_notify, maxlen=64, interval=0.005)
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start_notify(self):
+        if self.notifying:
+            print("Already notifying, nothing to do")
+            return
+        self.notifying = True
+        self.stream.reset()
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop_notify(self):
+        self.notifying = False
+        self.wakeup.set()
+        self.queue.clear()
+
+    def run(self):
+        while self.notifying:
+            self.wakeup.clear()
+            entries = self.scanner.get()
+            if not self.notifying:
+                break
+            for value in self.stream.update(entries, scan_chunk_size(self.sessions.min_mtu())):
+                self.queue.put(value, block=True)
+            self.wakeup.wait(self.scanner.ttl)
+
+
+class PiSugarWifiConfigService(Service):
+    """
+    PiSugar Wifi Config Service.
+    """
+    UUID = SERVICE_ID
+
+    def __init__(self, bus, index, net_state, key, sessions, scanner):
+        super().__init__(bus, index, self.UUID, True)
+
+        self.add_characteristic(ServiceNameChrc(bus, 0, self))
+        self.add_characteristic(DeviceModelChrc(bus, 1, self))
+        self.add_characteristic(WifiNameChrc(bus, 2, self, net_state))
+        self.add_characteristic(IPAddressChrc(bus, 3, self, net_state))
+        self.add_characteristic(InputChrc(bus, 4, self, key, sessions))
+        self.add_characteristic(InputSepChrc(bus, 5, self, key, sessions))
+        self.add_characteristic(InputNotifyMessageChrc(bus, 6, self, sessions))
+        self.add_characteristic(CommandChrc(bus, 7, self, sessions))
+        self.add_characteristic(ProvisioningStatsChrc(bus, 8, self, provisioning))
+        self.add_characteristic(ScanChrc(bus, 9, self, sessions, scanner))
+
+
+class PiSugarWifiConfigApplication(Application):
+    def __init__(self, bus, net_state, key, sessions, scanner):
+        super().__init__(bus)
+        self.add_service(PiSugarWifiConfigService(bus, 0, net_state, key, sessions, scanner))
+
+
+class PiSugarWifiConfigAdvertisement(Advertisement):
+    def __init__(self, bus, index):
+        super().__init__(bus, index, 'peripheral')
+        self.add_service_uuid(PiSugarWifiConfigService.UUID)
+        self.add_local_name('pisugar')
+        # no room left for IncludeTxPower in the 31 bytes next to the
+        # 128-bit service UUID and the status
+        self.set_status(encode_status(None))
+
+    def set_status(self, data):
+        self.add_manufacturer_data(MANUFACTURER_ID, data)
+
+
+class AdapterManager(object):
+    """
+    Keep the application and advertisement registered on the BLE adapters
+    as they come and go. Adapters are listed with GetManagedObjects when
+    bluetoothd appears on the bus, which is also the case after a restart,
+    and followed with InterfacesAdded/InterfacesRemoved. A failed
+    registration is retried after RETRY_DELAY seconds, doubled up to
+    RETRY_MAX.
+
+    Only the first capable adapter is served, or every one with
+    `all_adapters`; when the served adapter goes away another one is
+    taken. start_advertising() and stop_advertising() are driven by the
+    AdvertisingScheduler.
+    """
+    RETRY_DELAY = RETRY_DELAY
+    RETRY_MAX = RETRY_MAX
+
+    def __init__(self, bus, app, adv, all_adapters=False):
+        self.bus = bus
+        self.app = app
+        self.adv = adv
+        self.all_adapters = all_adapters
+        # adapter path -> set of 'application', 'advertisement' registered,
+        # 'advertising' while RegisterAdvertisement is on its way, 'stale'
+        # if the advertisement changed meanwhile
+        self.adapters = {}
+        self.advertising = True
+        self.retry_source = None
+        self.retry_delay = self.RETRY_DELAY
+
+    def start(self):
+        self.bus.add_signal_receiver(self.interfaces_added, signal_name='InterfacesAdded',
+                                     dbus_interface=DBUS_OM_IFACE, bus_name=BLUEZ_SERVICE_NAME)
+        self.bus.add_signal_receiver(self.interfaces_removed, signal_name='InterfacesRemoved',
+                                     dbus_interface=DBUS_OM_IFACE, bus_name=BLUEZ_SERVICE_NAME)
+        # called once with the current owner, then on every change
+        self.bus.watch_name_owner(BLUEZ_SERVICE_NAME, self.owner_changed)
+
+    def owner_changed(self, owner):
+        self.adapters.clear()
+        if not owner:
+            print('bluetoothd left the bus')
+            sd_notify('STATUS=Waiting for bluetoothd')
+            return
+        print('bluetoothd on the bus as ' + owner)
+        self.scan()
+
+    def scan(self):
+        try:
+            objects = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, '/'),
+                                     DBUS_OM_IFACE).GetManagedObjects()
+        except dbus.exceptions.DBusException as e:
+            print('Failed to list adapters: ' + str(e))
+            self.retry()
+            return
+        adapters = sorted(path for path, interfaces in objects.items() if is_adapter(interfaces))
+        if not adapters:
+            print('BLE adapter not found')
+            sd_notify('STATUS=Waiting for a BLE adapter')
+        for path in adapters:
+            if path in self.adapters:
+                continue
+            if self.adapters and not self.all_adapters:
+                break
+            self.register(path)
+
+    def register(self, path):
+        print('Adapter: ' + str(path))
+        self.adapters[path] = set()
+        adapter = self.bus.get_object(BLUEZ_SERVICE_NAME, path)
+        try:
+            dbus.Interface(adapter, DBUS_PROP_IFACE).Set(ADAPTER_IFACE, 'Powered',
+                                                         dbus.Boolean(1))
+        except dbus.exceptions.DBusException as e:
+            self.register_failed(path, 'adapter', e)
+            return
+        startup.mark('adapter', 'Adapter ' + str(path) + ' powered')
+        dbus.Interface(adapter, GATT_MANAGER_IFACE).RegisterApplication(
+            self.app.get_path(), {},
+            reply_handler=lambda: self.registered(path, 'application'),
+            error_handler=lambda e: self.register_failed(path, 'application', e))
+        if self.advertising:
+            self.advertise(path)
+
+    def advertise(self, path):
+        done = self.adapters.get(path)
+        if done is None or 'advertisement' in done or 'advertising' in done:
+            return
+        done.add('advertising')
+        dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, path),
+                       LE_ADVERTISING_MANAGER_IFACE).RegisterAdvertisement(
+            self.adv.get_path(), {},
+            reply_handler=lambda: self.registered(path, 'advertisement'),
+            error_handler=lambda e: self.register_failed(path, 'advertisement', e))
+
+    def unadvertise(self, path):
+        done = self.adapters[path]
+        done.discard('advertisement')
+        try:
+            dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, path),
+                           LE_ADVERTISING_MANAGER_IFACE).UnregisterAdvertisement(
+                               self.adv.get_path())
+        except dbus.exceptions.DBusException as e:
+            print(str(e))
+
+    def registered(self, path, what):
+        if path not in self.adapters:
+            return
+        self.adapters[path].discard('advertising')
+        self.adapters[path].add(what)
+        self.retry_delay = self.RETRY_DELAY
+        if what == 'advertisement' and not self.advertising:
+            # stopped while registering
+            self.unadvertise(path)
+        elif what == 'advertisement' and 'stale' in self.adapters[path]:
+            self.adapters[path].discard('stale')
+            self.unadvertise(path)
+            self.advertise(path)
+        elif what == 'application':
+            print('GATT application registered on ' + str(path))
+            startup.mark('registered', 'GATT application registered')
+        else:
+            print('Advertisement registered on ' + str(path))
+            startup.mark('advertising', 'Advertisement registered')
+
+    def register_failed(self, path, what, error):
+        if isinstance(error, dbus.exceptions.DBusException) and \
+                error.get_dbus_name() == 'org.bluez.Error.AlreadyExists':
+            # left over from an attempt that failed half way
+            self.registered(path, what)
+            return
+        print('Failed to register %s on %s: %s' % (what, path, error))
+        if self.adapters.pop(path, None) is not None:
+            self.retry()
+
+    def retry(self):
+        if self.retry_source is not None:
+            return
+        print('Retrying in %.1f s' % self.retry_delay)
+        self.retry_source = GLib.timeout_add(int(self.retry_delay * 1000), self.retry_scan)
+        self.retry_delay = min(self.retry_delay * 2, self.RETRY_MAX)
+
+    def retry_scan(self):
+        self.retry_source = None
+        self.scan()
+        return False
+
+    def interfaces_added(self, path, interfaces):
+        if path not in self.adapters and (GATT_MANAGER_IFACE in interfaces or
+                                          LE_ADVERTISING_MANAGER_IFACE in interfaces):
+            self.scan()
+
+    def interfaces_removed(self, path, interfaces):
+        if path in self.adapters and (ADAPTER_IFACE in interfaces or
+                                      GATT_MANAGER_IFACE in interfaces):
+            print('Adapter removed: ' + str(path))
+            del self.adapters[path]
+            self.scan()
+
+    def start_advertising(self):
+        """
+        Advertise on every adapter; where the advertisement is registered
+        already it is registered again, for BlueZ to read its changed
+        properties.
+        """
+        self.advertising = True
+        if self.adapters:
+            # otherwise the status still says what it waits for
+            sd_notify('STATUS=Advertising')
+        self.refresh_advertising()
+        for path in list(self.adapters):
+            self.advertise(path)
+
+    def refresh_advertising(self):
+        """
+        Register the advertisement again where it is registered, after its
+        properties changed.
+        """
+        if not self.advertising:
+            return
+        for path, done in list(self.adapters.items()):
+            if 'advertising' in done:
+                done.add('stale')
+            elif 'advertisement' in done:
+                self.unadvertise(path)
+                self.advertise(path)
+
+    def stop_advertising(self):
+        if not self.advertising:
+            return
+        self.advertising = False
+        print('Stop advertising...')
+        sd_notify('STATUS=Advertising stopped')
+        for path, done in list(self.adapters.items()):
+            if 'advertisement' in done:
+                self.unadvertise(path)
+
+
+def advertise(adapters, adv, phase, interval):
+    if phase == STOPPED:
+        adapters.stop_advertising()
+        return
+    adv.set_interval(interval)
+    adapters.start_advertising()
+
+
+def handle_signal(signum, frame):
+    global mainloop
+    print("Signal: " + str(signum))
+    mainloop.quit()
+
+
+def run(args):
+    global mainloop
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+
+    # glib mainloop
+    mainloop = GLib.MainLoop()
+
+    # wifi name/ip address, refreshed on netlink events
+    net_state = NetworkStateCache(WIFI_IFACE, ttl=args.state_ttl)
+    net_monitor = NetlinkMonitor(WIFI_IFACE)
+    net_monitor.add_listener(net_state.refresh)
+    net_state.add_listener(provisioning.on_state_changed)
+
+    # per central state
+    sessions = SessionTable(new_reassembler, idle_timeout=args.session_timeout)
+
+    # wifi scan results, shared by readers and subscribers
+    scanner = ScanResults(WIFI_IFACE, ttl=args.scan_ttl)
+
+    app = PiSugarWifiConfigApplication(bus, net_state, args.key, sessions, scanner)
+    adv = PiSugarWifiConfigAdvertisement(bus, 0)
+    startup.mark('objects')
+
+    # register on the adapters as bluetoothd shows them
+    adapters = AdapterManager(bus, app, adv, args.all_adapters)
+
+    # network state and battery in the advertisement
+    status = StatusBroadcast(adv, net_state, adapters.refresh_advertising,
+                             battery_address=None if args.no_battery else PISUGAR_SERVER)
+    status.start()
+
+    # fast burst, slower interval, stop after n seconds; again on SIGUSR1
+    scheduler = AdvertisingScheduler(advertising_plan(args),
+                                     lambda phase, interval: advertise(adapters, adv, phase,
+                                                                       interval))
+    scheduler.arm()
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, scheduler.arm)
+    adapters.start()
+
+    # handle SIGINT
+    #signal.signal(signal.SIGINT, handle_signal)
+
+    net_monitor.start()
+
+    # READY=1 once the loop runs, see StartupTimer
+    GLib.idle_add(startup.running)
+
+    # run mainloop
+    try:
+        mainloop.run()
+    except Exception as e:
+        print(str(e))
+    net_monitor.stop()
+
+    # stop advertising
+    adapters.stop_advertising()
@@ -0,0 +1,230 @@
+import bisect
+import functools
+import os
+import socket
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+METRICS_SOCKET = '/run/pisugar-wifi-config/metrics.sock'
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for n, v in zip(names, values)) + '}'
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, n=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + n
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for values, count in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, values), count))
+        return lines
+
+
+class Histogram(object):
+    """
+    Cumulative buckets are only summed up in render(); observe() does one
+    bisect and two additions under the lock.
+    """
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self.values.items())
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(
+                    self.labels + ('le',), values + (le,)), cumulative))
+            lines.append('%s_sum%s %.6f' % (self.name, format_labels(self.labels, values), total))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, values),
+                                            cumulative))
+        return lines
+
+
+class Registry(object):
+    """
+    Metrics of this process, rendered in the Prometheus text format.
+    Collectors are callables run at render time returning
+    (name, type, help, [(labels dict, value)]), for values that are
+    cheaper to read when asked for than to count.
+
+    With `enabled` off, counters and timers return right away.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def inc(self, counter, *label_values):
+        if self.enabled:
+            counter.inc(*label_values)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                name, kind, help, samples = collector()
+            except Exception as e:
+                print('Metrics collector failed: ' + str(e))
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, format_labels(tuple(labels), tuple(labels.values())),
+                                          value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
+
+gatt_calls = metrics.histogram('pisugar_gatt_call_seconds',
+                               'Latency of GATT and ObjectManager calls from BlueZ',
+                               ('method', 'object'))
+gatt_errors = metrics.counter('pisugar_gatt_call_errors_total',
+                              'GATT calls that raised an error', ('method', 'object'))
+notifications_sent = metrics.counter('pisugar_notifications_sent_total',
+                                     'Value notifications emitted', ('object',))
+notifications_dropped = metrics.counter('pisugar_notifications_dropped_total',
+                                        'Notifications dropped from a full queue', ('object',))
+subprocesses = metrics.counter('pisugar_subprocesses_total', 'Subprocesses spawned', ('kind',))
+messages_dropped = metrics.counter('pisugar_session_messages_dropped_total',
+                                   'Status messages dropped unread from a full session')
+
+
+def threads_collector():
+    return ('pisugar_threads', 'gauge', 'Live Python threads',
+            [({}, threading.active_count())])
+
+
+metrics.add_collector(threads_collector)
+
+
+def observe(method, obj, started, failed=False):
+    gatt_calls.observe(time.perf_counter() - started, method, obj)
+    if failed:
+        gatt_errors.inc(method, obj)
+
+
+def timed(method, obj):
+    """
+    Decorator recording the latency of `method` of `obj` in
+    pisugar_gatt_call_seconds. It copies the function's attributes, so it
+    can go on top of @dbus.service.method.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                observe(method, obj, started, True)
+                raise
+            observe(method, obj, started)
+            return result
+        return wrapper
+    return decorator
+
+
+class MetricsServer(object):
+    """
+    Serve metrics on a unix stream socket, one plain HTTP/1.0 response
+    per connection:
+
+        curl --unix-socket /run/pisugar-wifi-config/metrics.sock http://localhost/metrics
+    """
+    def __init__(self, path, registry=None):
+        self.path = path
+        self.registry = registry or metrics
+        self.sock = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(4)
+        t = threading.Thread(target=self.serve, daemon=True)
+        t.start()
+
+    def stop(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def serve(self):
+        while self.sock is not None:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                conn.settimeout(0.2)
+                try:
+                    conn.recv(1024)
+                except OSError:
+                    pass
+                body = self.registry.render().encode()
+                try:
+                    conn.sendall(b'HTTP/1.0 200 OK\r\n'
+                                 b'Content-Type: text/plain; version=0.0.4\r\n'
+                                 b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                except OSError:
+                    pass
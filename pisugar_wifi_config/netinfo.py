@@ -0,0 +1,206 @@
+import array
+import collections
+import fcntl
+import socket
+import struct
+import threading
+import time
+
+SIOCGIFADDR =                  0x8915
+SIOCGIWESSID =                 0x8B1B
+IW_ESSID_MAX_SIZE =            32
+
+IFNAMSIZ =                     16
+IFREQ_SIZE =                   40
+IWREQ_SIZE =                   32
+
+PROC_NET_WIRELESS =            '/proc/net/wireless'
+PROC_NET_IF_INET6 =            '/proc/net/if_inet6'
+SYS_CLASS_NET =                '/sys/class/net'
+
+IPV6_SCOPE_GLOBAL =            0x00
+IPV6_SCOPE_LINK =              0x20
+
+
+class NetworkState(collections.namedtuple('NetworkState',
+                                          ['ssid', 'ipv4', 'ipv6', 'link', 'signal'])):
+    """
+    Snapshot of one wireless interface.
+
+    ssid: associated SSID or None, ipv4: dotted address or None,
+    ipv6: list of addresses (global first), link: sysfs operstate,
+    signal: level in dBm or None.
+    """
+    __slots__ = ()
+
+    @property
+    def ip_addr(self):
+        if self.ipv4:
+            return self.ipv4
+        if self.ipv6:
+            return self.ipv6[0]
+        return None
+
+
+def _ifname(ifname):
+    return ifname.encode()[:IFNAMSIZ - 1]
+
+
+def read_ssid(ifname, sock=None):
+    """
+    SSID via the wireless extensions SIOCGIWESSID ioctl, None if not associated.
+    """
+    buf = array.array('B', bytes(IW_ESSID_MAX_SIZE + 1))
+    addr, _ = buf.buffer_info()
+    req = struct.pack('16sPHH', _ifname(ifname), addr, len(buf), 0)
+    req += bytes(IWREQ_SIZE - len(req))
+
+    own = sock is None
+    if own:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        res = fcntl.ioctl(sock.fileno(), SIOCGIWESSID, req)
+    except OSError:
+        return None
+    finally:
+        if own:
+            sock.close()
+
+    length = struct.unpack_from('16sPHH', res)[2]
+    length = min(length, IW_ESSID_MAX_SIZE)
+    if length == 0:
+        return None
+    return buf.tobytes()[:length].decode('utf-8', 'replace')
+
+
+def read_ipv4(ifname, sock=None):
+    req = struct.pack('16s', _ifname(ifname)) + bytes(IFREQ_SIZE - IFNAMSIZ)
+
+    own = sock is None
+    if own:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        res = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, req)
+    except OSError:
+        return None
+    finally:
+        if own:
+            sock.close()
+
+    # struct sockaddr_in: family(2) port(2) addr(4)
+    return socket.inet_ntoa(res[IFNAMSIZ + 4:IFNAMSIZ + 8])
+
+
+def read_ipv6(ifname):
+    addrs = []
+    try:
+        with open(PROC_NET_IF_INET6) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6 or fields[5] != ifname:
+                    continue
+                packed = bytes.fromhex(fields[0])
+                scope = int(fields[3], 16)
+                addrs.append((scope != IPV6_SCOPE_GLOBAL,
+                              socket.inet_ntop(socket.AF_INET6, packed)))
+    except (OSError, ValueError):
+        return []
+    addrs.sort(key=lambda a: a[0])
+    return [addr for _, addr in addrs]
+
+
+def read_link(ifname):
+    try:
+        with open('%s/%s/operstate' % (SYS_CLASS_NET, ifname)) as f:
+            return f.read().strip()
+    except OSError:
+        return 'absent'
+
+
+def read_signal(ifname):
+    """
+    Signal level in dBm from /proc/net/wireless, None if unknown.
+    """
+    try:
+        with open(PROC_NET_WIRELESS) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    # Inter-| sta-|   Quality        |   Discarded packets ...
+    #  face | tus | link level noise |  nwid  crypt ...
+    #  wlan0: 0000   70.  -40.  -256        0 ...
+    for line in lines[2:]:
+        name, _, rest = line.partition(':')
+        if name.strip() != ifname:
+            continue
+        fields = rest.split()
+        if len(fields) < 3:
+            return None
+        try:
+            level = int(float(fields[2].rstrip('.')))
+        except ValueError:
+            return None
+        # Some drivers report unsigned levels
+        if level > 63:
+            level -= 256
+        return level
+    return None
+
+
+def read_network_state(ifname):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ssid = read_ssid(ifname, sock)
+        ipv4 = read_ipv4(ifname, sock)
+    finally:
+        sock.close()
+    return NetworkState(ssid, ipv4, read_ipv6(ifname), read_link(ifname),
+                        read_signal(ifname))
+
+
+class NetworkStateCache(object):
+    """
+    NetworkState of one interface shared by readers and notifiers.
+
+    `get` serves the cached snapshot while it is younger than `ttl` seconds
+    and re-samples otherwise. `refresh` is called by the sampler (netlink
+    events); listeners are called with (state, old_state) when it changed.
+    """
+    def __init__(self, ifname, ttl=2.0, reader=read_network_state):
+        self.ifname = ifname
+        self.ttl = ttl
+        self.reader = reader
+        self.state = None
+        self.updated_at = 0
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def get(self):
+        with self.lock:
+            state = self.state
+            fresh = time.monotonic() - self.updated_at < self.ttl
+        if state is not None and fresh:
+            return state
+        return self.refresh()
+
+    def refresh(self):
+        state = self.reader(self.ifname)
+        with self.lock:
+            old_state = self.state
+            self.state = state
+            self.updated_at = time.monotonic()
+        if state != old_state:
+            for listener in list(self.listeners):
+                try:
+                    listener(state, old_state)
+                except Exception as e:
+                    print('Network state listener failed: ' + str(e))
+        return state
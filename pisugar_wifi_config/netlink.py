@@ -0,0 +1,263 @@
+import socket
+import struct
+
+NETLINK_ROUTE =                0
+NETLINK_GENERIC =              16
+
+SOL_NETLINK =                  270
+NETLINK_ADD_MEMBERSHIP =       1
+
+NLM_F_REQUEST =                0x1
+
+NLMSG_ERROR =                  2
+NLMSG_DONE =                   3
+
+RTMGRP_LINK =                  0x1
+RTMGRP_IPV4_IFADDR =           0x10
+RTMGRP_IPV6_IFADDR =           0x100
+
+RTM_NEWLINK =                  16
+RTM_DELLINK =                  17
+RTM_NEWADDR =                  20
+RTM_DELADDR =                  21
+
+GENL_ID_CTRL =                 0x10
+CTRL_CMD_GETFAMILY =           3
+CTRL_ATTR_FAMILY_ID =          1
+CTRL_ATTR_FAMILY_NAME =        2
+CTRL_ATTR_MCAST_GROUPS =       7
+CTRL_ATTR_MCAST_GRP_NAME =     1
+CTRL_ATTR_MCAST_GRP_ID =       2
+
+NL80211_ATTR_IFINDEX =         3
+NL80211_CMD_ASSOCIATE =        38
+NL80211_CMD_DISASSOCIATE =     40
+NL80211_CMD_CONNECT =          46
+NL80211_CMD_ROAM =             47
+NL80211_CMD_DISCONNECT =       48
+
+NL80211_EVENTS = (NL80211_CMD_ASSOCIATE, NL80211_CMD_DISASSOCIATE,
+                  NL80211_CMD_CONNECT, NL80211_CMD_ROAM, NL80211_CMD_DISCONNECT)
+
+NLMSG_HDR = struct.Struct('=IHHII')
+GENL_HDR = struct.Struct('=BBH')
+NLA_HDR = struct.Struct('=HH')
+IFINFO_HDR = struct.Struct('=BxHiII')
+IFADDR_HDR = struct.Struct('=BBBBI')
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def iter_messages(data):
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, seq, pid = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size:
+            break
+        yield msg_type, data[offset + NLMSG_HDR.size:offset + length]
+        offset += _align(length)
+
+
+def iter_attrs(data, offset=0):
+    while offset + NLA_HDR.size <= len(data):
+        length, attr_type = NLA_HDR.unpack_from(data, offset)
+        if length < NLA_HDR.size:
+            break
+        yield attr_type & 0x3fff, data[offset + NLA_HDR.size:offset + length]
+        offset += _align(length)
+
+
+def _nla(attr_type, payload):
+    attr = NLA_HDR.pack(NLA_HDR.size + len(payload), attr_type) + payload
+    return attr + b'\0' * (_align(len(attr)) - len(attr))
+
+
+def resolve_genl_group(family, group):
+    """
+    Return the multicast group id of a generic netlink family, or None.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+    try:
+        sock.bind((0, 0))
+        body = GENL_HDR.pack(CTRL_CMD_GETFAMILY, 1, 0) + \
+            _nla(CTRL_ATTR_FAMILY_NAME, family.encode() + b'\0')
+        sock.send(NLMSG_HDR.pack(NLMSG_HDR.size + len(body), GENL_ID_CTRL,
+                                 NLM_F_REQUEST, 1, 0) + body)
+        data = sock.recv(65536)
+    finally:
+        sock.close()
+
+    for msg_type, payload in iter_messages(data):
+        if msg_type != GENL_ID_CTRL:
+            continue
+        for attr_type, attr in iter_attrs(payload, GENL_HDR.size):
+            if attr_type != CTRL_ATTR_MCAST_GROUPS:
+                continue
+            for _, grp in iter_attrs(attr):
+                grp_attrs = dict(iter_attrs(grp))
+                name = grp_attrs.get(CTRL_ATTR_MCAST_GRP_NAME, b'').rstrip(b'\0')
+                if name.decode() == group and CTRL_ATTR_MCAST_GRP_ID in grp_attrs:
+                    return struct.unpack('=I', grp_attrs[CTRL_ATTR_MCAST_GRP_ID][:4])[0]
+    return None
+
+
+class NetlinkMonitor(object):
+    """
+    Watch rtnetlink link/address events and nl80211 association events of
+    one interface from the main loop, and call listeners on change. The
+    event loop hooks default to GLib and can be overridden for asyncio.
+
+    Events come in bursts (association, then link up, then addresses), so
+    listeners are called once after `settle_ms` of quiet. If netlink is
+    not available, fall back to polling every `poll_interval` seconds.
+    """
+    def __init__(self, ifname, settle_ms=200, poll_interval=3):
+        self.ifname = ifname
+        self.settle_ms = settle_ms
+        self.poll_interval = poll_interval
+        self.listeners = []
+        self.sockets = []
+        self.sources = []
+        self.pending = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def ifindex(self):
+        try:
+            return socket.if_nametoindex(self.ifname)
+        except OSError:
+            return None
+
+    def start(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+            self._watch(sock, self._is_route_event)
+        except OSError as e:
+            print('rtnetlink not available: ' + str(e))
+
+        try:
+            group = resolve_genl_group('nl80211', 'mlme')
+            if group is not None:
+                sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+                sock.bind((0, 0))
+                sock.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, group)
+                self._watch(sock, self._is_nl80211_event)
+        except OSError as e:
+            print('nl80211 events not available: ' + str(e))
+
+        if not self.sockets:
+            print('Netlink not available, polling every %ds' % self.poll_interval)
+            self.sources.append(self.call_every(self.poll_interval, self._poll))
+
+    def stop(self):
+        for source in self.sources:
+            self.cancel(source)
+        for sock in self.sockets:
+            sock.close()
+        if self.pending is not None:
+            self.cancel(self.pending)
+        self.sources = []
+        self.sockets = []
+        self.pending = None
+
+    # Event loop hooks, GLib by default. GLib is imported in them, the
+    # asyncio engine runs without it.
+
+    def add_reader(self, sock, callback):
+        from gi.repository import GLib
+
+        def on_readable(fd, condition):
+            callback()
+            return True
+        return GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                                 on_readable)
+
+    def call_later(self, ms, callback):
+        from gi.repository import GLib
+
+        def on_timeout():
+            callback()
+            return False
+        return GLib.timeout_add(ms, on_timeout)
+
+    def call_every(self, seconds, callback):
+        from gi.repository import GLib
+
+        def on_timeout():
+            callback()
+            return True
+        return GLib.timeout_add_seconds(seconds, on_timeout)
+
+    def cancel(self, source):
+        from gi.repository import GLib
+        GLib.source_remove(source)
+
+    def _watch(self, sock, matcher):
+        sock.setblocking(False)
+        self.sockets.append(sock)
+        self.sources.append(self.add_reader(sock, lambda: self._on_readable(sock, matcher)))
+
+    def _on_readable(self, sock, matcher):
+        ifindex = self.ifindex()
+        changed = False
+        while True:
+            try:
+                data = sock.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # ENOBUFS: events were lost, so re-read everything
+                print('Netlink recv error: ' + str(e))
+                changed = True
+                break
+            for msg_type, payload in iter_messages(data):
+                if matcher(msg_type, payload, ifindex):
+                    changed = True
+        if changed:
+            self._schedule()
+
+    def _is_route_event(self, msg_type, payload, ifindex):
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK) and len(payload) >= IFINFO_HDR.size:
+            index = IFINFO_HDR.unpack_from(payload)[2]
+        elif msg_type in (RTM_NEWADDR, RTM_DELADDR) and len(payload) >= IFADDR_HDR.size:
+            index = IFADDR_HDR.unpack_from(payload)[4]
+        else:
+            return False
+        return ifindex is None or index == ifindex
+
+    def _is_nl80211_event(self, msg_type, payload, ifindex):
+        if msg_type in (NLMSG_ERROR, NLMSG_DONE) or len(payload) < GENL_HDR.size:
+            return False
+        cmd = GENL_HDR.unpack_from(payload)[0]
+        if cmd not in NL80211_EVENTS:
+            return False
+        for attr_type, attr in iter_attrs(payload, GENL_HDR.size):
+            if attr_type == NL80211_ATTR_IFINDEX:
+                return ifindex is None or struct.unpack('=I', attr[:4])[0] == ifindex
+        return True
+
+    def _schedule(self):
+        if self.pending is None:
+            self.pending = self.call_later(self.settle_ms, self._fire)
+
+    def _fire(self):
+        self.pending = None
+        self.notify()
+
+    def _poll(self):
+        self.notify()
+
+    def notify(self):
+        for listener in list(self.listeners):
+            try:
+                listener()
+            except Exception as e:
+                print('Network listener failed: ' + str(e))
@@ -0,0 +1,160 @@
+import collections
+import struct
+
+from .psk import is_passphrase
+
+# A binary message is a version byte followed by TLVs: type, length (1
+# byte each) and value. Legacy messages are text starting with the key,
+# so a first byte below 0x20 tells them apart.
+VERSION_1 =                    0x01
+VERSIONS =                     (VERSION_1,)
+
+TLV_KEY =                      0x01
+TLV_SSID =                     0x02
+TLV_PASSPHRASE =               0x03
+TLV_PSK =                      0x04
+TLV_SECURITY =                 0x05
+TLV_HIDDEN =                   0x06
+TLV_PRIORITY =                 0x07
+
+SECURITY_OPEN =                0x00
+SECURITY_WPA_PSK =             0x01
+SECURITY_SAE =                 0x02
+SECURITY_WPA_PSK_SAE =         0x03
+
+# wpa_supplicant key_mgmt and ieee80211w (PMF) per security type
+KEY_MGMT = {
+    SECURITY_OPEN: ('NONE', None),
+    SECURITY_WPA_PSK: ('WPA-PSK', None),
+    SECURITY_SAE: ('SAE', '2'),
+    SECURITY_WPA_PSK_SAE: ('WPA-PSK SAE', '1'),
+}
+
+TLV_HEADER = struct.Struct('>BB')
+SSID_MAX = 32
+PSK_SIZE = 32
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class UnsupportedVersion(ProtocolError):
+    pass
+
+
+class WifiRequest(collections.namedtuple('WifiRequest', ['key', 'ssid', 'password', 'security',
+                                                         'hidden', 'priority'])):
+    """
+    Credentials of one provisioning message. password is a passphrase, a
+    64 hex digit PSK or '' for an open network; security (SECURITY_*),
+    hidden and priority are None when not given, leaving wpa_supplicant's
+    settings as the legacy format has them.
+    """
+    __slots__ = ()
+
+    def network_fields(self):
+        """
+        wpa_supplicant network fields beyond ssid and psk. Every field a
+        message may set is given, so none is left over from an earlier
+        provisioning of the SSID: None removes it, or for priority picks
+        one above the other networks. key_mgmt follows the psk unless a
+        security type is given.
+        """
+        fields = {
+            'ieee80211w': None,
+            # scanned for unless told otherwise, as legacy messages are
+            'scan_ssid': '0' if self.hidden is False else '1',
+            'priority': self.priority,
+        }
+        if self.security is not None:
+            fields['key_mgmt'], fields['ieee80211w'] = KEY_MGMT[self.security]
+        return fields
+
+
+def is_binary(msg):
+    return len(msg) > 0 and msg[0] < 0x20
+
+
+def decode_request(msg):
+    """
+    WifiRequest of a binary message; unknown TLV types are skipped. A
+    passphrase must be 8 to 63 bytes of UTF-8 and fit the security type,
+    as wpa_supplicant would not take it otherwise. A message has either a
+    passphrase or a PSK.
+    """
+    msg = bytes(msg)
+    if not msg or msg[0] not in VERSIONS:
+        raise UnsupportedVersion('version %d' % (msg[0] if msg else -1))
+    values = {}
+    pos = 1
+    while pos < len(msg):
+        if pos + TLV_HEADER.size > len(msg):
+            raise ProtocolError('truncated TLV at %d' % pos)
+        tlv_type, length = TLV_HEADER.unpack_from(msg, pos)
+        pos += TLV_HEADER.size
+        if pos + length > len(msg):
+            raise ProtocolError('TLV %d longer than the message' % tlv_type)
+        values[tlv_type] = msg[pos:pos + length]
+        pos += length
+
+    try:
+        key = values[TLV_KEY].decode('utf8')
+        ssid = values[TLV_SSID].decode('utf8')
+        password = values.get(TLV_PASSPHRASE, b'').decode('utf8')
+    except KeyError as e:
+        raise ProtocolError('missing TLV %d' % e.args[0])
+    except UnicodeDecodeError as e:
+        raise ProtocolError(str(e))
+    if not ssid or len(values[TLV_SSID]) > SSID_MAX:
+        raise ProtocolError('SSID of %d bytes' % len(values[TLV_SSID]))
+    if TLV_PASSPHRASE in values and TLV_PSK in values:
+        raise ProtocolError('both a passphrase and a PSK')
+    if TLV_PSK in values:
+        if len(values[TLV_PSK]) != PSK_SIZE:
+            raise ProtocolError('PSK of %d bytes' % len(values[TLV_PSK]))
+        password = values[TLV_PSK].hex()
+
+    if TLV_PASSPHRASE in values and not is_passphrase(password):
+        raise ProtocolError('passphrase of %d bytes' % len(values[TLV_PASSPHRASE]))
+
+    security = byte_value(values, TLV_SECURITY)
+    if security is not None and security not in KEY_MGMT:
+        raise ProtocolError('security %d' % security)
+    if security == SECURITY_OPEN and password:
+        raise ProtocolError('password for an open network')
+    if security in (SECURITY_SAE, SECURITY_WPA_PSK_SAE) and TLV_PASSPHRASE not in values:
+        raise ProtocolError('SAE needs the passphrase')
+    if security == SECURITY_WPA_PSK and not password:
+        raise ProtocolError('WPA-PSK needs a passphrase or PSK')
+    hidden = byte_value(values, TLV_HIDDEN)
+    return WifiRequest(key, ssid, password, security,
+                       None if hidden is None else bool(hidden),
+                       byte_value(values, TLV_PRIORITY))
+
+
+def byte_value(values, tlv_type):
+    value = values.get(tlv_type)
+    if value is None:
+        return None
+    if len(value) != 1:
+        raise ProtocolError('TLV %d of %d bytes' % (tlv_type, len(value)))
+    return value[0]
+
+
+def encode_request(key, ssid, password='', psk=None, security=None, hidden=None,
+                   priority=None):
+    """
+    Binary VERSION_1 message, as an app builds it; `psk` is the 32 byte
+    raw PSK, sent instead of the passphrase.
+    """
+    tlvs = [(TLV_KEY, key.encode()), (TLV_SSID, ssid.encode())]
+    if psk is not None:
+        tlvs.append((TLV_PSK, bytes(psk)))
+    elif password:
+        tlvs.append((TLV_PASSPHRASE, password.encode()))
+    for tlv_type, value in ((TLV_SECURITY, security), (TLV_HIDDEN, hidden),
+                            (TLV_PRIORITY, priority)):
+        if value is not None:
+            tlvs.append((tlv_type, bytes([int(value)])))
+    return bytes([VERSION_1]) + b''.join(TLV_HEADER.pack(t, len(v)) + v for t, v in tlvs)
@@ -0,0 +1,166 @@
+import collections
+import json
+import os
+import threading
+import time
+
+RECEIVED =                     'received'
+VALIDATED =                    'validated'
+DERIVED =                      'derived'
+APPLIED =                      'applied'
+ASSOCIATED =                   'associated'
+IP_ACQUIRED =                  'ip_acquired'
+
+OUTCOME_OK =                   'ok'
+OUTCOME_INVALID_CONFIG =       'invalid_config'
+OUTCOME_INVALID_KEY =          'invalid_key'
+OUTCOME_NOT_CONNECTED =        'not_connected'
+OUTCOME_NO_IP =                'no_ip'
+OUTCOME_SUPERSEDED =           'superseded'
+OUTCOME_REJECTED =             'rejected'
+
+STATS_FILE = '/var/lib/pisugar-wifi-config/provisioning.json'
+
+
+class ProvisioningRun(object):
+    """
+    Phases of one credential write, in ms since the message was received.
+    Marked and finished from the wpa_supplicant, timer and main loop
+    threads: the first outcome wins and nothing is marked after it.
+    """
+    def __init__(self, tracker, run_id, ssid=None):
+        self.tracker = tracker
+        self.id = run_id
+        self.ssid = ssid
+        self.started = time.time()
+        self.started_at = time.monotonic()
+        self.phases = collections.OrderedDict()
+        self.outcome = None
+        self.timer = None
+        self.lock = threading.Lock()
+        self.mark(RECEIVED)
+
+    def mark(self, phase):
+        with self.lock:
+            if self.outcome is None:
+                self.phases[phase] = round((time.monotonic() - self.started_at) * 1000, 1)
+
+    def finish(self, outcome):
+        with self.lock:
+            if self.outcome is not None:
+                return
+            self.outcome = outcome
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+        self.tracker.finished(self)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'id': self.id,
+                'ssid': self.ssid,
+                'started': round(self.started, 3),
+                'phases': dict(self.phases),
+                'outcome': self.outcome,
+            }
+
+
+class ProvisioningTracker(object):
+    """
+    Ring buffer of the last `size` provisioning runs. The run waiting for
+    an IP address is finished by on_state_changed(), a NetworkStateCache
+    listener, or after `ip_timeout` seconds. Finished runs are written to
+    `stats_file` as JSON, replacing it atomically, one writer at a time.
+    """
+    def __init__(self, size=16, stats_file=None, ip_timeout=60):
+        self.runs = collections.deque(maxlen=size)
+        self.stats_file = stats_file
+        self.ip_timeout = ip_timeout
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.next_id = 1
+        self.active = None
+        self.state = None
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start(self):
+        with self.lock:
+            run = ProvisioningRun(self, self.next_id)
+            self.next_id += 1
+            previous, self.active = self.active, run
+            self.runs.append(run)
+        if previous is not None:
+            previous.finish(OUTCOME_SUPERSEDED)
+        return run
+
+    def latest(self):
+        with self.lock:
+            return self.runs[-1].to_dict() if self.runs else None
+
+    def recent(self):
+        with self.lock:
+            return [run.to_dict() for run in self.runs]
+
+    def associated(self, run, connected):
+        if not connected:
+            run.finish(OUTCOME_NOT_CONNECTED)
+            return
+        run.mark(ASSOCIATED)
+        state = self.state
+        if state is not None and state.ipv4 and state.ssid == run.ssid:
+            # same network again, the lease is kept and no change follows
+            run.mark(IP_ACQUIRED)
+            run.finish(OUTCOME_OK)
+            return
+        timer = threading.Timer(self.ip_timeout, run.finish, (OUTCOME_NO_IP,))
+        timer.daemon = True
+        with run.lock:
+            if run.outcome is not None:
+                return
+            run.timer = timer
+        timer.start()
+
+    def on_state_changed(self, state, old_state):
+        self.state = state
+        run = self.active
+        if run is None or ASSOCIATED not in run.phases or not state.ipv4:
+            return
+        if old_state is not None and state.ipv4 == old_state.ipv4:
+            return
+        run.mark(IP_ACQUIRED)
+        run.finish(OUTCOME_OK)
+
+    def finished(self, run):
+        with self.lock:
+            if self.active is run:
+                self.active = None
+        print('Provisioning %d %s: %s' % (run.id, run.outcome, json.dumps(run.phases)))
+        self.save()
+        for listener in self.listeners:
+            listener(run)
+
+    def save(self):
+        import tempfile
+        if not self.stats_file:
+            return
+        directory = os.path.dirname(os.path.abspath(self.stats_file))
+        # runs finishing at once must not replace the file with older data
+        with self.save_lock:
+            data = json.dumps({'runs': self.recent()}, indent=1)
+            try:
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(prefix='.provisioning.', dir=directory)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self.stats_file)
+            except OSError as e:
+                print('Failed to write provisioning stats: ' + str(e))
+
+
+provisioning = ProvisioningTracker()
@@ -0,0 +1,107 @@
+import collections
+import threading
+
+PBKDF2_ITERATIONS = 4096
+PSK_SIZE = 32
+
+
+def is_passphrase(password):
+    """
+    WPA passphrases are 8 to 63 bytes, here UTF-8 without control
+    characters, which a config file line could not hold; anything else
+    (a 64 hex digit PSK, an open network, a bad value) is passed on as is.
+    """
+    return (8 <= len(password.encode('utf8')) <= 63 and
+            not any(c < ' ' or c == '\x7f' for c in password))
+
+
+def derive_psk(ssid, passphrase):
+    """
+    The 256-bit WPA PSK as 64 hex digits, as wpa_passphrase prints it.
+    """
+    # hashlib loads OpenSSL, left out of startup until a PSK is needed
+    import hashlib
+    return hashlib.pbkdf2_hmac('sha1', passphrase.encode(), ssid.encode(),
+                               PBKDF2_ITERATIONS, PSK_SIZE).hex()
+
+
+class PskCache(object):
+    """
+    LRU of derived PSKs. Entries are keyed by a digest of (ssid,
+    passphrase), so the passphrase itself is not kept.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(ssid, passphrase):
+        import hashlib
+        return hashlib.sha256(ssid.encode() + b'\0' + passphrase.encode()).digest()
+
+    def get(self, ssid, passphrase):
+        key = self.key(ssid, passphrase)
+        with self.lock:
+            psk = self.entries.get(key)
+            if psk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return psk
+
+    def put(self, ssid, passphrase, psk):
+        with self.lock:
+            self.entries[self.key(ssid, passphrase)] = psk
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class PskDeriver(object):
+    """
+    Derive PSKs on one background thread, so that the 4096 PBKDF2
+    iterations (tens of ms on a Pi Zero) never run in a D-Bus handler.
+
+    submit() only queues; `callback(psk)` is called on the worker thread
+    with the hex PSK, or with the password unchanged when it is not a
+    passphrase or `derive` is False. Cached PSKs skip the derivation.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache or PskCache()
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.thread = None
+
+    def submit(self, ssid, password, callback, derive=True):
+        with self.lock:
+            self.queue.append((ssid, password, callback, derive))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.worker, daemon=True)
+                self.thread.start()
+            self.not_empty.notify()
+
+    def psk(self, ssid, password):
+        if not is_passphrase(password):
+            return password
+        psk = self.cache.get(ssid, password)
+        if psk is None:
+            psk = derive_psk(ssid, password)
+            self.cache.put(ssid, password, psk)
+        return psk
+
+    def worker(self):
+        while True:
+            with self.lock:
+                self.not_empty.wait_for(lambda: self.queue)
+                ssid, password, callback, derive = self.queue.popleft()
+            try:
+                callback(self.psk(ssid, password) if derive else password)
+            except Exception as e:
+                print('PSK callback failed: ' + str(e))
+
+
+psk_deriver = PskDeriver()
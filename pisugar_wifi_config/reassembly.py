@@ -0,0 +1,129 @@
+import time
+
+FRAME_MAGIC = 0xFE
+FRAME_HEADER_SIZE = 3
+# first bytes of binary messages (protocol.is_binary), which must be framed
+BINARY_BELOW = 0x20
+
+
+class FrameError(ValueError):
+    pass
+
+
+class MessageTooLong(FrameError):
+    pass
+
+
+class InvalidOffset(FrameError):
+    pass
+
+
+class UnframedMessage(FrameError):
+    pass
+
+
+class MessageReassembler(object):
+    """
+    Reassemble messages written in chunks to a characteristic.
+
+    Two framings are accepted:
+      - length prefixed: FRAME_MAGIC, payload length (uint16, big endian), payload
+      - legacy: payload terminated by `end`, e.g. 'key%&%ssid%&%password&#&'
+
+    Binary messages may hold `end`, so one that is not length prefixed is
+    rejected and dropped rather than cut at the marker.
+
+    Chunks are copied once into a preallocated buffer that only grows up to
+    `max_size`. The end marker is searched only in newly written bytes, and
+    nothing is decoded here, so multibyte characters may be split across
+    chunks. A chunk with an `offset` (BlueZ long writes) is placed at that
+    position of the write begun by the last chunk without one, whatever
+    messages were completed since. A partial message idle for more than
+    `timeout` seconds is discarded.
+    """
+    def __init__(self, end, capacity=512, max_size=4096, timeout=5.0):
+        self.end = end
+        self.max_size = max_size
+        self.timeout = timeout
+        self.buf = bytearray(capacity)
+        self.length = 0
+        self.scan_from = 0
+        # write offset of buf[0]
+        self.base = 0
+        self.updated_at = 0
+
+    def reset(self):
+        self.length = 0
+        self.scan_from = 0
+        self.base = 0
+
+    def feed(self, chunk, offset=None, now=None):
+        """
+        Add a chunk, return the list of completed message payloads.
+        """
+        if now is None:
+            now = time.monotonic()
+        if self.length and now - self.updated_at > self.timeout:
+            print('Discard %d bytes of stale partial message' % self.length)
+            self.reset()
+        self.updated_at = now
+
+        if not offset:
+            # a new write, its offsets count from here
+            self.base = -self.length
+            pos = self.length
+        else:
+            pos = offset - self.base
+            if pos < 0 or pos > self.length:
+                raise InvalidOffset('Offset %d outside the %d bytes received from %d' % (
+                    offset, self.length, self.base))
+        end_pos = pos + len(chunk)
+        if end_pos > self.max_size:
+            self.reset()
+            raise MessageTooLong('Message longer than %d bytes' % self.max_size)
+        if end_pos > len(self.buf):
+            self.buf.extend(bytes(min(max(end_pos, 2 * len(self.buf)), self.max_size) - len(self.buf)))
+
+        self.buf[pos:end_pos] = chunk
+        self.length = max(self.length, end_pos)
+        self.scan_from = min(self.scan_from, max(0, pos - len(self.end) + 1))
+
+        messages = []
+        while self.length:
+            if self.buf[0] == FRAME_MAGIC:
+                if self.length < FRAME_HEADER_SIZE:
+                    break
+                size = FRAME_HEADER_SIZE + ((self.buf[1] << 8) | self.buf[2])
+                if size > self.max_size:
+                    self.reset()
+                    raise MessageTooLong('Frame longer than %d bytes' % self.max_size)
+                if self.length < size:
+                    break
+                messages.append(bytes(self.buf[FRAME_HEADER_SIZE:size]))
+                self.consume(size)
+            elif self.buf[0] < BINARY_BELOW:
+                self.reset()
+                raise UnframedMessage('Binary message without a frame')
+            else:
+                index = self.buf.find(self.end, self.scan_from, self.length)
+                if index < 0:
+                    self.scan_from = max(0, self.length - len(self.end) + 1)
+                    break
+                messages.append(bytes(self.buf[:index]))
+                self.consume(index + len(self.end))
+        return messages
+
+    def consume(self, size):
+        remaining = self.length - size
+        if remaining:
+            self.buf[:remaining] = self.buf[size:self.length]
+        self.length = remaining
+        self.scan_from = 0
+        self.base += size
+
+
+def frame(payload):
+    """
+    Length prefixed frame of `payload`, see MessageReassembler.
+    """
+    return bytes([FRAME_MAGIC, len(payload) >> 8, len(payload) & 0xff]) + payload
@@ -0,0 +1,266 @@
+import binascii
+import collections
+import struct
+import threading
+import time
+
+from .wpa_ctrl import (EVENT_SCAN_FAILED, EVENT_SCAN_RESULTS, WpaCtrl, WpaCtrlError,
+                       WpaSupplicant, unescape_ssid)
+
+SEC_WEP =                      0x01
+SEC_WPA =                      0x02
+SEC_WPA2 =                     0x04
+SEC_SAE =                      0x08
+SEC_EAP =                      0x10
+BAND_5GHZ =                    0x40
+BAND_6GHZ =                    0x80
+
+OP_ADD =                       0x01
+OP_CHANGE =                    0x02
+OP_REMOVE =                    0x03
+
+FRAME_RESET =                  0x01
+FRAME_LAST =                   0x02
+
+REQUEST_SNAPSHOT =             0x01
+
+# sequence number, FRAME_* flags
+FRAME_HEADER = struct.Struct('>BB')
+# OP_ADD/OP_CHANGE: op, bssid, rssi, SEC_*/BAND_* flags, ssid length, then the ssid
+RECORD = struct.Struct('>B6sbBB')
+# OP_REMOVE: op, bssid
+REMOVED = struct.Struct('>B6s')
+
+ATT_HEADER_SIZE = 3
+SCAN_TTL = 10
+SCAN_TIMEOUT = 10
+# dB a BSS must move before its change is sent
+RSSI_STEP = 6
+
+
+class ScanEntry(collections.namedtuple('ScanEntry', ['bssid', 'rssi', 'flags', 'ssid'])):
+    """
+    One BSS: bssid (6 bytes), rssi in dBm, SEC_*/BAND_* flags and ssid
+    (bytes, up to 32).
+    """
+    __slots__ = ()
+
+
+def security_flags(flags, freq=0):
+    """
+    SEC_*/BAND_* flags from wpa_supplicant's '[WPA2-PSK-CCMP][ESS]' flags
+    and the frequency in MHz.
+    """
+    result = 0
+    if '[WEP' in flags:
+        result |= SEC_WEP
+    if '[WPA-' in flags:
+        result |= SEC_WPA
+    if '[WPA2-' in flags or '[RSN-' in flags:
+        result |= SEC_WPA2
+    if 'SAE' in flags:
+        result |= SEC_SAE
+    if 'EAP' in flags:
+        result |= SEC_EAP
+    if freq >= 5925:
+        result |= BAND_6GHZ
+    elif freq >= 5000:
+        result |= BAND_5GHZ
+    return result
+
+
+def scan_entry(bss):
+    """
+    ScanEntry from a WpaCtrl.bss_list() entry, None if incomplete.
+    """
+    try:
+        bssid = binascii.unhexlify(bss['bssid'].replace(':', ''))
+        rssi = max(-128, min(127, int(bss.get('level', -128))))
+        freq = int(bss.get('freq', 0))
+    except (KeyError, ValueError, binascii.Error):
+        return None
+    if len(bssid) != 6:
+        return None
+    ssid = unescape_ssid(bss.get('ssid', ''))[:32]
+    return ScanEntry(bssid, rssi, security_flags(bss.get('flags', ''), freq), ssid)
+
+
+def encode_entry(op, entry):
+    return RECORD.pack(op, entry.bssid, entry.rssi, entry.flags, len(entry.ssid)) + entry.ssid
+
+
+def encode_removed(bssid):
+    return REMOVED.pack(OP_REMOVE, bssid)
+
+
+def decode_records(data):
+    """
+    [(op, ScanEntry or bssid for OP_REMOVE)] of a reassembled update.
+    """
+    records = []
+    pos = 0
+    while pos < len(data):
+        if data[pos] == OP_REMOVE:
+            _, bssid = REMOVED.unpack_from(data, pos)
+            records.append((OP_REMOVE, bssid))
+            pos += REMOVED.size
+            continue
+        op, bssid, rssi, flags, length = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        records.append((op, ScanEntry(bssid, rssi, flags, bytes(data[pos:pos + length]))))
+        pos += length
+    return records
+
+
+def encode_snapshot(entries):
+    return b''.join(encode_entry(OP_ADD, entry) for entry in sorted(
+        entries.values(), key=lambda e: -e.rssi))
+
+
+def encode_diff(sent, entries, rssi_step=RSSI_STEP):
+    """
+    Records taking a central from `sent` to `entries` (both bssid ->
+    ScanEntry). `sent` is updated to what the central now has: a BSS whose
+    signal moved less than `rssi_step` keeps its old entry.
+    """
+    records = []
+    for bssid, entry in entries.items():
+        old = sent.get(bssid)
+        if old is None:
+            records.append(encode_entry(OP_ADD, entry))
+        elif old.ssid != entry.ssid or old.flags != entry.flags or \
+                abs(old.rssi - entry.rssi) >= rssi_step:
+            records.append(encode_entry(OP_CHANGE, entry))
+        else:
+            continue
+        sent[bssid] = entry
+    for bssid in [bssid for bssid in sent if bssid not in entries]:
+        records.append(encode_removed(bssid))
+        del sent[bssid]
+    return b''.join(records)
+
+
+def chunk_size(mtu):
+    """
+    Update bytes that fit in one notification after the frame header.
+    """
+    return max(1, mtu - ATT_HEADER_SIZE - FRAME_HEADER.size)
+
+
+class ScanStream(object):
+    """
+    Scan results as a stream of notification frames. The first update is
+    a snapshot, its first frame flagged FRAME_RESET for centrals to clear
+    their table; the following ones only carry the BSSes added, changed or
+    removed since. An update is cut into frames of `chunk` bytes, the last
+    flagged FRAME_LAST, so records may span frames.
+    """
+    def __init__(self, rssi_step=RSSI_STEP):
+        self.rssi_step = rssi_step
+        self.sent = None
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Send a snapshot again with the next update.
+        """
+        with self.lock:
+            self.sent = None
+
+    def update(self, entries, chunk):
+        """
+        Frames to send for `entries` (bssid -> ScanEntry), [] if nothing
+        changed.
+        """
+        with self.lock:
+            if self.sent is None:
+                self.sent = dict(entries)
+                data = encode_snapshot(entries)
+                flags = FRAME_RESET
+            else:
+                data = encode_diff(self.sent, entries, self.rssi_step)
+                if not data:
+                    return []
+                flags = 0
+            frames = []
+            for i in range(0, max(len(data), 1), chunk):
+                last = i + chunk >= len(data)
+                frames.append(FRAME_HEADER.pack(self.seq, flags | (FRAME_LAST if last else 0)) +
+                              data[i:i + chunk])
+                self.seq = (self.seq + 1) & 0xff
+                flags = 0
+            return frames
+
+
+class ScanResults(object):
+    """
+    Results of wpa_supplicant scans of one interface, kept for `ttl`
+    seconds. get() blocks while a scan runs, callers in the same window
+    share it; latest() returns what is there right away.
+    """
+    def __init__(self, ifname, ttl=SCAN_TTL, ctrl_dir=None, timeout=SCAN_TIMEOUT):
+        self.ifname = ifname
+        self.ttl = ttl
+        self.ctrl_dir = ctrl_dir
+        self.timeout = timeout
+        self.entries = {}
+        self.scanned_at = None
+        self.lock = threading.Lock()
+        self.scanning = threading.Lock()
+
+    def latest(self):
+        with self.lock:
+            return dict(self.entries)
+
+    def fresh(self):
+        with self.lock:
+            return self.scanned_at is not None and time.monotonic() - self.scanned_at < self.ttl
+
+    def get(self):
+        with self.scanning:
+            if not self.fresh():
+                self.scan()
+        return self.latest()
+
+    def refresh(self):
+        """
+        get() on a thread of its own unless the results are fresh or a
+        scan is running already.
+        """
+        if self.fresh() or self.scanning.locked():
+            return
+        threading.Thread(target=self.get, daemon=True).start()
+
+    def scan(self):
+        started = time.monotonic()
+        ctrl_dir = self.ctrl_dir or WpaSupplicant.CTRL_DIR
+        try:
+            with WpaCtrl(self.ifname, ctrl_dir) as ctrl:
+                ctrl.attach()
+                try:
+                    ctrl.scan()
+                    event = ctrl.wait_event((EVENT_SCAN_RESULTS, EVENT_SCAN_FAILED), self.timeout)
+                    if event is None or event.startswith(EVENT_SCAN_FAILED):
+                        # serve what wpa_supplicant has from earlier scans
+                        print('Scan: %s' % (event or 'timeout'))
+                    bss_list = ctrl.bss_list()
+                finally:
+                    try:
+                        ctrl.detach()
+                    except WpaCtrlError:
+                        pass
+        except WpaCtrlError as e:
+            print('Scan failed: ' + str(e))
+            bss_list = None
+        entries = {}
+        for bss in bss_list or []:
+            entry = scan_entry(bss)
+            if entry is not None:
+                entries[entry.bssid] = entry
+        with self.lock:
+            if bss_list is not None:
+                self.entries = entries
+            self.scanned_at = time.monotonic()
+        if bss_list is not None:
+            print('Scan: %d BSSes in %.3fs' % (len(entries), time.monotonic() - started))
@@ -0,0 +1,117 @@
+import collections
+import threading
+import time
+
+from .metrics import messages_dropped, metrics
+
+DEFAULT_MTU = 23
+PENDING_MAX = 16
+
+
+class Session(object):
+    """
+    State of one connected central: reassembly buffer, negotiated MTU,
+    status messages not yet read by it and the scan results it is reading.
+    """
+    def __init__(self, device, reassembler, listeners=()):
+        self.device = device
+        self.reassembler = reassembler
+        self.listeners = listeners
+        self.mtu = DEFAULT_MTU
+        self.pending = collections.deque(maxlen=PENDING_MAX)
+        self.reading = ''
+        self.scan = b''
+        self.last_seen = time.monotonic()
+
+    def post(self, message):
+        """
+        Post a status message for this central; listeners are called with
+        (session, message) so it can be notified as well. When PENDING_MAX
+        messages are unread the oldest one is dropped.
+        """
+        if len(self.pending) == self.pending.maxlen:
+            metrics.inc(messages_dropped)
+            print('Session %s: %d messages unread, dropped %r' % (
+                self.device or '<unknown device>', len(self.pending), self.pending[0]))
+        self.pending.append(message)
+        for listener in self.listeners:
+            listener(self, message)
+
+    def pop(self):
+        try:
+            return self.pending.popleft()
+        except IndexError:
+            return None
+
+    def read_message(self, options):
+        """
+        Pop the next message on a read at offset 0; the blob reads that
+        follow for a long message get the rest of the same one.
+        """
+        if not options.get('offset'):
+            self.reading = self.pop() or ''
+        return self.reading
+
+    def read_scan(self, options, snapshot):
+        """
+        Take a new `snapshot()` on a read at offset 0; the blob reads that
+        follow get the rest of the same one, even if a scan finished since.
+        """
+        if not options.get('offset'):
+            self.scan = snapshot()
+        return self.scan
+
+
+class SessionTable(object):
+    """
+    Sessions keyed by the BlueZ device object path passed as
+    options['device'] to ReadValue/WriteValue. Centrals talking through an
+    old BlueZ without that option share the '' session.
+
+    Sessions idle for more than `idle_timeout` seconds are evicted lazily,
+    at most every `idle_timeout / 2` seconds, so no timer is needed.
+    """
+    def __init__(self, reassembler_factory, idle_timeout=300):
+        self.reassembler_factory = reassembler_factory
+        self.idle_timeout = idle_timeout
+        self.sessions = {}
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.evicted_at = time.monotonic()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get(self, options):
+        device = str(options.get('device', ''))
+        now = time.monotonic()
+        with self.lock:
+            if now - self.evicted_at > self.idle_timeout / 2:
+                self.evict_idle(now)
+            session = self.sessions.get(device)
+            if session is None:
+                session = Session(device, self.reassembler_factory(), self.listeners)
+                self.sessions[device] = session
+        session.last_seen = now
+        if 'mtu' in options:
+            session.mtu = int(options['mtu'])
+        return session
+
+    def evict_idle(self, now):
+        self.evicted_at = now
+        for device, session in list(self.sessions.items()):
+            if now - session.last_seen > self.idle_timeout:
+                print('Evict idle session: ' + (device or '<unknown device>'))
+                del self.sessions[device]
+
+    def min_mtu(self):
+        """
+        Smallest MTU of the known centrals, for values notified to all of
+        them.
+        """
+        with self.lock:
+            return min((s.mtu for s in self.sessions.values()), default=DEFAULT_MTU)
+
+    def all(self):
+        with self.lock:
+            return list(self.sessions.values())
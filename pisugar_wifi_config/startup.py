@@ -0,0 +1,91 @@
+import os
+import socket
+import time
+
+
+def sd_notify(state):
+    """
+    Send `state` ('READY=1', 'STATUS=...', newline separated) to systemd
+    when run as a Type=notify service; does nothing otherwise.
+    """
+    path = os.environ.get('NOTIFY_SOCKET')
+    if not path:
+        return False
+    if path.startswith('@'):
+        path = '\0' + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+    try:
+        sock.connect(path)
+        sock.sendall(state.encode())
+        return True
+    except OSError as e:
+        print('sd_notify: ' + str(e))
+        return False
+    finally:
+        sock.close()
+
+
+def boottime():
+    return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+def process_started():
+    """
+    Boot time (seconds) at which this process was exec'd, from the
+    starttime field of /proc/self/stat; now if it cannot be read.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rpartition(')')[2].split()
+        return int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return boottime()
+
+
+class StartupTimer(object):
+    """
+    Startup steps in ms since exec. systemd is told READY=1 by running(),
+    as soon as the main loop runs: without an adapter, or stopped early,
+    the service is up all the same. Once every step in
+    `discoverable_after` is marked the STATUS= says so and the steps are
+    printed; the boot time at that point is the boot to discoverable time.
+    """
+    def __init__(self, discoverable_after=('registered', 'advertising')):
+        self.started = process_started()
+        self.discoverable_after = discoverable_after
+        self.marks = []
+        self.ready = False
+        self.discoverable = False
+
+    def running(self):
+        """
+        Tell systemd the service is up; a main loop idle callback.
+        """
+        if not self.ready:
+            self.ready = True
+            self.marks.append(('loop', boottime()))
+            sd_notify('READY=1')
+        return False
+
+    def mark(self, name, status=None):
+        if status is not None:
+            sd_notify('STATUS=' + status)
+        if self.discoverable:
+            # re-registrations after a bluetoothd restart
+            return
+        self.marks.append((name, boottime()))
+        if all(self.has(n) for n in self.discoverable_after):
+            self.discoverable = True
+            sd_notify('STATUS=Advertising')
+            print(self.report())
+
+    def has(self, name):
+        return any(n == name for n, _ in self.marks)
+
+    def report(self):
+        steps = ', '.join('%s %.1f ms' % (name, (at - self.started) * 1000)
+                          for name, at in self.marks)
+        return 'Startup: %s; discoverable %.2f s after boot' % (steps, self.marks[-1][1])
+
+
+startup = StartupTimer()
@@ -0,0 +1,160 @@
+import socket
+import struct
+import threading
+import zlib
+
+# Bluetooth SIG "reserved for testing" company identifier, PiSugar has none
+MANUFACTURER_ID =              0xFFFF
+STATUS_VERSION =               1
+
+# byte 0: version (2 bits) | link up | IPv4 | battery level (4 bits)
+# byte 1: low byte of the CRC-32 of the SSID (0 when not associated)
+# bytes 2-5: IPv4 address (0.0.0.0 when none)
+STATUS =                       struct.Struct('>BB4s')
+STATUS_LINK =                  0x20
+STATUS_IPV4 =                  0x10
+BATTERY_UNKNOWN =              0x0F
+BATTERY_LEVELS =               14
+
+PISUGAR_SERVER =               ('127.0.0.1', 8423)
+BATTERY_INTERVAL =             60
+
+
+def ssid_hash(ssid):
+    if not ssid:
+        return 0
+    return zlib.crc32(ssid.encode()) & 0xFF
+
+
+def battery_level(battery):
+    """
+    Battery percentage to 0 (empty) .. 14 (full), BATTERY_UNKNOWN if None.
+    """
+    if battery is None:
+        return BATTERY_UNKNOWN
+    return int(round(max(0.0, min(100.0, battery)) * BATTERY_LEVELS / 100))
+
+
+def encode_status(state, battery=None):
+    """
+    Status bytes for a NetworkState (or None) and battery percentage.
+    """
+    flags = STATUS_VERSION << 6 | battery_level(battery)
+    ssid = None
+    ipv4 = bytes(4)
+    if state is not None:
+        if state.link == 'up':
+            flags |= STATUS_LINK
+        if state.ipv4:
+            flags |= STATUS_IPV4
+            ipv4 = socket.inet_aton(state.ipv4)
+        ssid = state.ssid
+    return STATUS.pack(flags, ssid_hash(ssid), ipv4)
+
+
+def decode_status(data):
+    flags, ssid, ipv4 = STATUS.unpack(bytes(data[:STATUS.size]))
+    level = flags & 0x0F
+    return {
+        'version': flags >> 6,
+        'link': bool(flags & STATUS_LINK),
+        'ipv4': socket.inet_ntoa(ipv4) if flags & STATUS_IPV4 else None,
+        'ssid_hash': ssid,
+        'battery': None if level == BATTERY_UNKNOWN else level * 100.0 / BATTERY_LEVELS,
+    }
+
+
+def read_battery(address=PISUGAR_SERVER, timeout=0.5):
+    """
+    Battery percentage from pisugar-server, None when it is not running.
+    """
+    try:
+        with socket.create_connection(address, timeout) as sock:
+            sock.sendall(b'get battery\n')
+            reply = sock.recv(64).decode()
+    except OSError:
+        return None
+    # battery: 87.52
+    name, _, value = reply.partition(':')
+    if name.strip() != 'battery':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class StatusBroadcast(object):
+    """
+    Network state and battery level of the device in the advertisement's
+    manufacturer data, for scanners to see without connecting. `apply()`
+    is called when the bytes change, to register the advertisement
+    again. Event loop hooks default to GLib and can be overridden for
+    asyncio.
+    """
+    def __init__(self, adv, net_state, apply, battery_address=PISUGAR_SERVER,
+                 battery_interval=BATTERY_INTERVAL):
+        self.adv = adv
+        self.net_state = net_state
+        self.apply = apply
+        self.battery_address = battery_address
+        self.battery_interval = battery_interval
+        self.state = None
+        self.battery = None
+        self.data = None
+
+    def start(self):
+        self.state = self.net_state.get()
+        self.update()
+        self.net_state.add_listener(self.on_state_changed)
+        if self.battery_address:
+            self.poll_battery()
+            if self.battery_interval > 0:
+                self.call_every(self.battery_interval, self.poll_battery)
+
+    def on_state_changed(self, state, old_state):
+        # may be called from any thread
+        self.call_soon(self.set_state, state)
+
+    def set_state(self, state):
+        self.state = state
+        self.update()
+
+    def poll_battery(self):
+        # pisugar-server is read on a thread, a slow one must not stall
+        # the event loop
+        threading.Thread(target=self.read_battery, daemon=True).start()
+        return True
+
+    def read_battery(self):
+        self.call_soon(self.set_battery, read_battery(self.battery_address))
+
+    def set_battery(self, battery):
+        self.battery = battery
+        self.update()
+
+    def update(self):
+        data = encode_status(self.state, self.battery)
+        if data == self.data:
+            return
+        first = self.data is None
+        self.data = data
+        self.adv.set_status(data)
+        if not first:
+            print('Advertised status: %s' % decode_status(data))
+            self.apply()
+
+    # Event loop hooks, GLib by default. GLib is imported in them, the
+    # asyncio engine runs without it.
+
+    def call_soon(self, callback, *args):
+        from gi.repository import GLib
+
+        def on_idle():
+            callback(*args)
+            return False
+        GLib.idle_add(on_idle)
+
+    def call_every(self, seconds, callback):
+        from gi.repository import GLib
+        GLib.timeout_add_seconds(seconds, callback)
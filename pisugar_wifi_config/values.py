@@ -0,0 +1,31 @@
+from .reassembly import InvalidOffset
+
+ATT_READ_HEADER_SIZE = 1
+
+
+class ReadBuffer(object):
+    """
+    Encoded value of a readable characteristic.
+
+    The value is encoded once into an immutable bytes object and kept
+    until a read sees a different value, so the blob reads a central makes
+    for a long value on a small MTU only slice it. Each read returns the
+    bytes from `offset` that fit in one ATT read response, MTU - 1.
+    """
+    def __init__(self):
+        self.value = None
+        self.data = b''
+
+    def read(self, value, offset=0, mtu=None):
+        if value is not self.value and value != self.value:
+            self.data = value.encode() if isinstance(value, str) else bytes(value)
+            self.value = value
+        if offset > len(self.data):
+            raise InvalidOffset('offset %d beyond %d bytes' % (offset, len(self.data)))
+        if not mtu:
+            return self.data[offset:]
+        return self.data[offset:offset + mtu - ATT_READ_HEADER_SIZE]
+
+    def invalidate(self):
+        self.value = None
+        self.data = b''
@@ -0,0 +1,273 @@
+import binascii
+import os
+import re
+
+from .psk import is_passphrase
+
+NETWORK_START = re.compile(r'^\s*network\s*=\s*\{\s*$')
+NETWORK_END = re.compile(r'^\s*\}\s*$')
+FIELD = re.compile(r'^(\s*)([A-Za-z0-9_]+)=(.*?)\s*$')
+
+INDENT = '\t'
+
+
+def quote(value):
+    return '"' + value + '"'
+
+
+def is_hex_psk(value):
+    return len(value) == 64 and all(c in '0123456789abcdefABCDEF' for c in value)
+
+
+def ssid_value(ssid):
+    """
+    Config value of an SSID: quoted when it is printable ASCII without
+    quotes, hex otherwise, as wpa_supplicant writes it.
+    """
+    if all(' ' <= c <= '~' for c in ssid) and '"' not in ssid:
+        return quote(ssid)
+    return binascii.hexlify(ssid.encode()).decode()
+
+
+def psk_value(psk):
+    """
+    Config value of a psk: a 64 hex digit PSK as is, a passphrase quoted.
+    Anything else would not survive in the file and raises ValueError.
+    """
+    if is_hex_psk(psk):
+        return psk
+    if not is_passphrase(psk):
+        raise ValueError('Invalid psk, %d bytes' % len(psk.encode('utf8')))
+    return quote(psk)
+
+
+def decode_ssid(value):
+    """
+    SSID of a config value: "quoted" or hex. P"printf escaped" values
+    are returned with their escapes.
+    """
+    if value.startswith('"') and value.endswith('"') and len(value) >= 2:
+        return value[1:-1]
+    if value.startswith('P"') and value.endswith('"'):
+        return value[2:-1]
+    try:
+        return binascii.unhexlify(value).decode('utf8', 'replace')
+    except (binascii.Error, ValueError):
+        return value
+
+
+class NetworkBlock(object):
+    """
+    One network={...} block: its raw lines, kept as read, and an index
+    of field name to line number.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.index = {}
+        for i, line in enumerate(lines):
+            m = FIELD.match(line)
+            if m:
+                self.index[m.group(2)] = i
+
+    def get(self, name):
+        i = self.index.get(name)
+        if i is None:
+            return None
+        return FIELD.match(self.lines[i]).group(3)
+
+    @property
+    def ssid(self):
+        value = self.get('ssid')
+        return None if value is None else decode_ssid(value)
+
+    @property
+    def priority(self):
+        try:
+            return int(self.get('priority') or 0)
+        except ValueError:
+            return 0
+
+    def set(self, name, value):
+        """
+        Set a field, or remove it when `value` is None. Returns whether
+        the block changed; an unchanged field keeps its line as is.
+        """
+        i = self.index.get(name)
+        if value is None:
+            if i is None:
+                return False
+            del self.lines[i]
+            self.__init__(self.lines)
+            return True
+        if i is not None:
+            m = FIELD.match(self.lines[i])
+            if m.group(3) == value:
+                return False
+            self.lines[i] = '%s%s=%s\n' % (m.group(1), name, value)
+            return True
+        # before the closing brace
+        self.lines.insert(len(self.lines) - 1, '%s%s=%s\n' % (INDENT, name, value))
+        self.__init__(self.lines)
+        return True
+
+    @classmethod
+    def new(cls):
+        return cls(['\n', 'network={\n', '}\n'])
+
+
+class WpaConfig(object):
+    """
+    wpa_supplicant.conf as a list of segments: text outside network
+    blocks, kept verbatim, and NetworkBlocks. Networks are upserted or
+    removed by SSID, and save() writes the file back atomically, through
+    a temporary file in the same directory that is fsynced and renamed
+    over it, only when something changed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        self.changed = False
+        self.load()
+
+    def load(self):
+        self.segments = []
+        self.changed = False
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        text = []
+        block = None
+        for line in lines:
+            if block is not None:
+                block.append(line)
+                if NETWORK_END.match(line):
+                    self.segments.append(NetworkBlock(block))
+                    block = None
+            elif NETWORK_START.match(line):
+                if text:
+                    self.segments.append(''.join(text))
+                    text = []
+                block = [line]
+            else:
+                text.append(line)
+        if block is not None:
+            # unterminated block, keep it as text
+            text.extend(block)
+        if text:
+            self.segments.append(''.join(text))
+
+    def networks(self):
+        return [s for s in self.segments if isinstance(s, NetworkBlock)]
+
+    def find(self, ssid):
+        for network in self.networks():
+            if network.ssid == ssid:
+                return network
+        return None
+
+    def get_global(self, name):
+        for segment in self.segments:
+            if isinstance(segment, str):
+                for line in segment.splitlines():
+                    m = FIELD.match(line)
+                    if m and m.group(2) == name:
+                        return m.group(3)
+        return None
+
+    def set_global(self, name, value):
+        """
+        Add a global field when missing; existing ones are left alone.
+        """
+        if self.get_global(name) is not None:
+            return
+        self.segments.insert(0, '%s=%s\n' % (name, value))
+        self.changed = True
+
+    def upsert(self, ssid, psk, priority=None, **fields):
+        """
+        Add or update the network `ssid`. `psk` is a 64 hex digit PSK, a
+        passphrase (quoted here) or empty for an open network, ValueError
+        otherwise. Without a `priority` it gets one above every other
+        network, so the network provisioned last is preferred.
+        """
+        if psk:
+            psk = psk_value(psk)
+        network = self.find(ssid)
+        if network is None:
+            network = NetworkBlock.new()
+            self.segments.append(network)
+            self.changed = True
+        if priority is None:
+            top = max([n.priority for n in self.networks() if n is not network] or [0])
+            priority = network.priority if network.priority > top else top + 1
+        values = [('ssid', ssid_value(ssid))]
+        if psk:
+            values += [('key_mgmt', 'WPA-PSK'), ('psk', psk)]
+        else:
+            values += [('key_mgmt', 'NONE'), ('psk', None)]
+        values.append(('priority', str(priority)))
+        values += sorted(fields.items())
+        if network.ssid == ssid:
+            # keep the existing spelling of the ssid, hex or quoted
+            values = values[1:]
+        for name, value in values:
+            if network.set(name, value):
+                self.changed = True
+        return network
+
+    def remove(self, ssid):
+        network = self.find(ssid)
+        if network is None:
+            return False
+        i = self.segments.index(network)
+        del self.segments[i]
+        # drop the blank line that separated the block
+        if i > 0 and isinstance(self.segments[i - 1], str) and self.segments[i - 1].endswith('\n\n'):
+            self.segments[i - 1] = self.segments[i - 1][:-1]
+        self.changed = True
+        return True
+
+    def dumps(self):
+        return ''.join(s if isinstance(s, str) else ''.join(s.lines) for s in self.segments)
+
+    def save(self):
+        # imported here, it is not needed before the first save
+        import tempfile
+        if not self.changed:
+            return False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            mode = os.stat(self.path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o600
+        fd, tmp = tempfile.mkstemp(prefix='.wpa_supplicant.', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.dumps())
+                f.flush()
+                os.fchmod(f.fileno(), mode)
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.changed = False
+        return True
+
+
+def save_network(path, ssid, psk, **fields):
+    """
+    Upsert one network into the config file at `path` and save it.
+    """
+    config = WpaConfig(path)
+    config.upsert(ssid, psk, **fields)
+    return config.save()
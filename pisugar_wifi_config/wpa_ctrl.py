@@ -0,0 +1,401 @@
+import binascii
+import collections
+import itertools
+import os
+import socket
+import threading
+import time
+
+from .wpa_conf import save_network
+
+CTRL_DIR = '/var/run/wpa_supplicant'
+
+EVENT_CONNECTED =              'CTRL-EVENT-CONNECTED'
+EVENT_DISCONNECTED =           'CTRL-EVENT-DISCONNECTED'
+EVENT_SSID_TEMP_DISABLED =     'CTRL-EVENT-SSID-TEMP-DISABLED'
+EVENT_NETWORK_NOT_FOUND =      'CTRL-EVENT-NETWORK-NOT-FOUND'
+EVENT_SCAN_RESULTS =           'CTRL-EVENT-SCAN-RESULTS'
+EVENT_SCAN_FAILED =            'CTRL-EVENT-SCAN-FAILED'
+
+# WPA_BSS_MASK_* of wpa_ctrl.h, the BSS fields asked for
+BSS_MASK_ID =                  0x1
+BSS_MASK_BSSID =               0x2
+BSS_MASK_FREQ =                0x4
+BSS_MASK_LEVEL =               0x80
+BSS_MASK_FLAGS =               0x800
+BSS_MASK_SSID =                0x1000
+BSS_MASK_DELIM =               0x20000
+BSS_DELIM =                    '===='
+
+# printf_encode() escapes other than \xNN
+SSID_ESCAPES = {ord('n'): 10, ord('r'): 13, ord('t'): 9, ord('e'): 27,
+                ord('\\'): 92, ord('"'): 34}
+
+# events an attached client keeps while waiting for a reply
+EVENTS_MAX = 64
+
+_counter = itertools.count()
+
+
+class WpaCtrlError(Exception):
+    pass
+
+
+class WpaCtrlUnavailable(WpaCtrlError):
+    """
+    The control socket could not be reached or did not answer, as opposed
+    to a FAIL reply from wpa_supplicant.
+    """
+
+
+class WpaCtrl(object):
+    """
+    Client of the wpa_supplicant control interface, a unix datagram socket
+    named after the interface in the ctrl_interface directory. Like
+    wpa_ctrl.c the client binds its own socket so replies can reach it.
+
+    An attached client also receives unsolicited events, '<level>text';
+    request() keeps those that arrive before its reply for wait_event(),
+    which returns them.
+    """
+    def __init__(self, ifname, ctrl_dir=CTRL_DIR, timeout=3.0):
+        import tempfile
+        self.path = os.path.join(ctrl_dir, ifname)
+        self.local = os.path.join(tempfile.gettempdir(), 'pisugar_wpa_ctrl_%d-%d' % (
+            os.getpid(), next(_counter)))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(self.local)
+            self.sock.connect(self.path)
+        except OSError as e:
+            self.close()
+            raise WpaCtrlUnavailable('%s: %s' % (self.path, e))
+        self.sock.settimeout(timeout)
+        self.timeout = timeout
+        self.attached = False
+        self.events = collections.deque(maxlen=EVENTS_MAX)
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.local)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, cmd):
+        try:
+            self.sock.send(cmd.encode())
+            while True:
+                reply = self.sock.recv(4096).decode('utf8', 'replace')
+                if not reply.startswith('<'):
+                    return reply
+                self.events.append(reply[reply.find('>') + 1:])
+        except OSError as e:
+            raise WpaCtrlUnavailable('%s: %s' % (cmd.split(' ')[0], e))
+
+    def request_ok(self, cmd):
+        reply = self.request(cmd)
+        if reply.strip() != 'OK':
+            raise WpaCtrlError('%s: %s' % (cmd.split(' ')[0], reply.strip()))
+
+    def attach(self):
+        self.request_ok('ATTACH')
+        self.attached = True
+
+    def detach(self):
+        if self.attached:
+            self.request_ok('DETACH')
+            self.attached = False
+
+    def wait_event(self, prefixes, timeout):
+        """
+        Return the first event starting with one of `prefixes`, without its
+        level, or None after `timeout` seconds.
+        """
+        while self.events:
+            event = self.events.popleft()
+            if event.startswith(prefixes):
+                return event
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return None
+                self.sock.settimeout(wait)
+                try:
+                    event = self.sock.recv(4096).decode('utf8', 'replace')
+                except socket.timeout:
+                    return None
+                if event.startswith('<'):
+                    event = event[event.find('>') + 1:]
+                if event.startswith(prefixes):
+                    return event
+        except OSError as e:
+            raise WpaCtrlUnavailable(str(e))
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def add_network(self):
+        reply = self.request('ADD_NETWORK').strip()
+        try:
+            return int(reply)
+        except ValueError:
+            raise WpaCtrlError('ADD_NETWORK: ' + reply)
+
+    def get_network(self, network_id, name):
+        reply = self.request('GET_NETWORK %d %s' % (network_id, name)).strip()
+        if reply.startswith('FAIL'):
+            raise WpaCtrlError('GET_NETWORK: ' + reply)
+        return reply
+
+    def set_network(self, network_id, name, value):
+        self.request_ok('SET_NETWORK %d %s %s' % (network_id, name, value))
+
+    def select_network(self, network_id):
+        self.request_ok('SELECT_NETWORK %d' % network_id)
+
+    def enable_network(self, network_id='all'):
+        self.request_ok('ENABLE_NETWORK %s' % network_id)
+
+    def remove_network(self, network_id):
+        self.request_ok('REMOVE_NETWORK %s' % network_id)
+
+    def save_config(self):
+        self.request_ok('SAVE_CONFIG')
+
+    def scan(self):
+        """
+        Start a scan; a scan already running (FAIL-BUSY) will do as well.
+        CTRL-EVENT-SCAN-RESULTS tells attached clients when it is done.
+        """
+        reply = self.request('SCAN').strip()
+        if reply not in ('OK', 'FAIL-BUSY'):
+            raise WpaCtrlError('SCAN: ' + reply)
+
+    def bss_list(self):
+        """
+        [{'id', 'bssid', 'freq', 'level', 'flags', 'ssid'}] of every BSS
+        wpa_supplicant knows, the ssid printf-escaped. Asked for with BSS
+        RANGE page by page, each reply holding as many entries as fit in
+        its 4 kB buffer, where SCAN_RESULTS would be cut short.
+        """
+        mask = (BSS_MASK_ID | BSS_MASK_BSSID | BSS_MASK_FREQ | BSS_MASK_LEVEL |
+                BSS_MASK_FLAGS | BSS_MASK_SSID | BSS_MASK_DELIM)
+        entries = []
+        first = 0
+        while True:
+            page = parse_bss(self.request('BSS RANGE=%d- MASK=0x%x' % (first, mask)))
+            if not page:
+                return entries
+            entries.extend(page)
+            try:
+                first = int(page[-1]['id']) + 1
+            except (KeyError, ValueError):
+                raise WpaCtrlError('BSS: no id')
+
+    def list_networks(self):
+        """
+        [(network id, ssid as printed by wpa_supplicant, flags)]
+        """
+        networks = []
+        for line in self.request('LIST_NETWORKS').splitlines()[1:]:
+            fields = line.split('\t')
+            if len(fields) >= 4:
+                networks.append((int(fields[0]), fields[1], fields[3]))
+        return networks
+
+
+def parse_bss(reply):
+    entries = []
+    entry = {}
+    for line in reply.splitlines():
+        if line == BSS_DELIM:
+            if entry:
+                entries.append(entry)
+            entry = {}
+            continue
+        name, sep, value = line.partition('=')
+        if sep:
+            entry[name] = value
+    if entry:
+        entries.append(entry)
+    return entries
+
+
+def unescape_ssid(text):
+    """
+    SSID bytes from wpa_supplicant's printf_encode()d text.
+    """
+    out = bytearray()
+    i = 0
+    data = text.encode('utf8', 'surrogateescape')
+    while i < len(data):
+        c = data[i]
+        if c == 92 and i + 1 < len(data):
+            n = data[i + 1]
+            if n == ord('x') and i + 3 < len(data):
+                try:
+                    out.append(int(data[i + 2:i + 4], 16))
+                    i += 4
+                    continue
+                except ValueError:
+                    pass
+            elif n in SSID_ESCAPES:
+                out.append(SSID_ESCAPES[n])
+                i += 2
+                continue
+        out.append(c)
+        i += 1
+    return bytes(out)
+
+
+def ssid_bytes(value):
+    """
+    SSID bytes of a GET_NETWORK ssid value: a quoted string, or hex digits
+    when the SSID is not printable.
+    """
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].encode('utf8', 'surrogateescape')
+    try:
+        return binascii.unhexlify(value)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def hex_string(value):
+    return binascii.hexlify(value.encode()).decode()
+
+
+def psk_value(password):
+    """
+    SET_NETWORK value for psk: a raw 64 hex digit PSK as is, a passphrase
+    quoted.
+    """
+    if len(password) == 64 and all(c in '0123456789abcdefABCDEF' for c in password):
+        return password
+    return '"' + password + '"'
+
+
+class WpaSupplicant(object):
+    """
+    Apply wifi credentials to the running wpa_supplicant, without
+    restarting it.
+
+    The network is added and selected right away. SELECT_NETWORK disables
+    every other network, so a thread waits up to CONNECT_TIMEOUT seconds
+    for the association, then enables them again. The configuration is
+    saved only once the new network is associated, so a wrong password
+    does not end up in the config file. With a `config` path only that
+    network is written to it, see WpaConfig, instead of SAVE_CONFIG
+    rewriting the whole file.
+    """
+    CTRL_DIR = CTRL_DIR
+    CONFIG = None
+    CONNECT_TIMEOUT = 15.0
+
+    def __init__(self, ifname, ctrl_dir=None, config=None):
+        self.ifname = ifname
+        self.ctrl_dir = ctrl_dir or self.CTRL_DIR
+        self.config = config or self.CONFIG
+
+    def connect(self, ssid, password, report=None, done=None, fields=None):
+        """
+        Add and select the network, returning its id. `fields` are network
+        fields set over the defaults, e.g. key_mgmt or priority; None ones
+        are removed from the saved network. From the waiting thread
+        `done(connected)` is called as soon as the outcome is known, and
+        `report(message)` once the configuration is saved.
+        """
+        events = WpaCtrl(self.ifname, self.ctrl_dir)
+        try:
+            # attach first, a fast association must not be missed
+            events.attach()
+            with WpaCtrl(self.ifname, self.ctrl_dir) as ctrl:
+                network_id = self.add_network(ctrl, ssid, password, fields)
+                ctrl.select_network(network_id)
+        except WpaCtrlError:
+            events.close()
+            raise
+        t = threading.Thread(target=self.wait_connected,
+                             args=(events, network_id, ssid, password, report, done, fields),
+                             daemon=True)
+        t.start()
+        return network_id
+
+    def add_network(self, ctrl, ssid, password, fields=None):
+        # same SSID added again: replace it once the new one is set up.
+        # LIST_NETWORKS escapes SSIDs, GET_NETWORK gives the bytes.
+        replaced = [network_id for network_id, _, _ in ctrl.list_networks()
+                    if ssid_bytes(ctrl.get_network(network_id, 'ssid')) == ssid.encode()]
+        network_id = ctrl.add_network()
+        try:
+            ctrl.set_network(network_id, 'ssid', hex_string(ssid))
+            ctrl.set_network(network_id, 'scan_ssid', '1')
+            if password:
+                ctrl.set_network(network_id, 'key_mgmt', 'WPA-PSK')
+                ctrl.set_network(network_id, 'psk', psk_value(password))
+            else:
+                ctrl.set_network(network_id, 'key_mgmt', 'NONE')
+            for name, value in sorted((fields or {}).items()):
+                # a new network has no field to remove
+                if value is not None:
+                    ctrl.set_network(network_id, name, str(value))
+        except WpaCtrlError:
+            ctrl.remove_network(network_id)
+            raise
+        for old_id in replaced:
+            ctrl.remove_network(old_id)
+        return network_id
+
+    def wait_connected(self, events, network_id, ssid, password, report, done, fields=None):
+        started = time.monotonic()
+        deadline = started + self.CONNECT_TIMEOUT
+        message = 'Wifi ' + ssid + ' not connected'
+        connected = False
+        try:
+            while True:
+                event = events.wait_event((EVENT_CONNECTED, EVENT_SSID_TEMP_DISABLED),
+                                          deadline - time.monotonic())
+                if event is None:
+                    break
+                if event.startswith(EVENT_CONNECTED):
+                    message = 'Wifi ' + ssid + ' connected'
+                    connected = True
+                    break
+                if 'id=%d ' % network_id in event and 'reason=WRONG_KEY' in event:
+                    message = 'Wifi ' + ssid + ' wrong password'
+                    break
+            if done is not None:
+                done(connected)
+            with WpaCtrl(self.ifname, self.ctrl_dir) as ctrl:
+                ctrl.enable_network('all')
+                if connected:
+                    self.save(ctrl, ssid, password, fields)
+            print('%s in %.3fs' % (message, time.monotonic() - started))
+        except WpaCtrlError as e:
+            print('wpa_supplicant: ' + str(e))
+            message = 'Wifi ' + ssid + ' failed'
+        finally:
+            try:
+                events.detach()
+            except WpaCtrlError:
+                pass
+            events.close()
+        if report is not None:
+            report(message)
+
+    def save(self, ctrl, ssid, password, fields=None):
+        if self.config is None:
+            ctrl.save_config()
+            return
+        try:
+            save_network(self.config, ssid, password, **dict({'scan_ssid': '1'}, **(fields or {})))
+        except (OSError, ValueError) as e:
+            raise WpaCtrlError('%s: %s' % (self.config, e))
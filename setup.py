@@ -17,6 +17,9 @@ def main():
         author_email = "pisugar.zero@gmail.com",
         platforms = ["all"],
         packages = ['pisugar_wifi_config'],
+        extras_require = {
+            'asyncio': ['dbus-next'],
+        },
 
         entry_points={
             'console_scripts': [
@@ -0,0 +1,98 @@
+import unittest
+
+from pisugar_wifi_config.protocol import (SECURITY_OPEN, SECURITY_SAE, SECURITY_WPA_PSK,
+                                          TLV_HEADER, TLV_KEY, TLV_PASSPHRASE, TLV_PSK, TLV_SSID,
+                                          VERSION_1,
+                                          ProtocolError, UnsupportedVersion, decode_request,
+                                          encode_request, is_binary)
+
+PSK = bytes(range(32))
+
+
+def tlvs(*items):
+    return bytes([VERSION_1]) + b''.join(TLV_HEADER.pack(t, len(v)) + v for t, v in items)
+
+
+class DecodeRequestTest(unittest.TestCase):
+    def test_round_trip(self):
+        request = decode_request(encode_request('pisugar', 'PiSugar', 'password', hidden=True,
+                                                priority=5))
+        self.assertEqual(request.key, 'pisugar')
+        self.assertEqual(request.ssid, 'PiSugar')
+        self.assertEqual(request.password, 'password')
+        self.assertIsNone(request.security)
+        self.assertIs(request.hidden, True)
+        self.assertEqual(request.priority, 5)
+
+    def test_psk(self):
+        request = decode_request(encode_request('pisugar', 'PiSugar', psk=PSK))
+        self.assertEqual(request.password, PSK.hex())
+
+    def test_open_network(self):
+        request = decode_request(encode_request('pisugar', 'PiSugar', security=SECURITY_OPEN))
+        self.assertEqual(request.password, '')
+        self.assertEqual(request.network_fields()['key_mgmt'], 'NONE')
+
+    def test_network_fields(self):
+        fields = decode_request(encode_request('pisugar', 'PiSugar', 'password',
+                                               security=SECURITY_SAE)).network_fields()
+        self.assertEqual(fields['key_mgmt'], 'SAE')
+        self.assertEqual(fields['ieee80211w'], '2')
+        self.assertEqual(fields['scan_ssid'], '1')
+        self.assertIsNone(fields['priority'])
+
+    def test_unknown_tlv_skipped(self):
+        msg = encode_request('pisugar', 'PiSugar', 'password') + bytes([0x7f, 2, 1, 2])
+        self.assertEqual(decode_request(msg).ssid, 'PiSugar')
+
+    def test_unsupported_version(self):
+        with self.assertRaises(UnsupportedVersion):
+            decode_request(bytes([0x02]) + encode_request('pisugar', 'PiSugar')[1:])
+
+    def test_truncated(self):
+        msg = encode_request('pisugar', 'PiSugar', 'password')
+        for size in (len(msg) - 1, len(msg) - 9):
+            with self.assertRaises(ProtocolError):
+                decode_request(msg[:size])
+
+    def test_missing_ssid(self):
+        with self.assertRaises(ProtocolError):
+            decode_request(tlvs((TLV_KEY, b'pisugar')))
+
+    def test_ssid_too_long(self):
+        with self.assertRaises(ProtocolError):
+            decode_request(tlvs((TLV_KEY, b'pisugar'), (TLV_SSID, b'x' * 33)))
+
+    def test_short_passphrase(self):
+        with self.assertRaises(ProtocolError):
+            decode_request(encode_request('pisugar', 'PiSugar', 'short'))
+
+    def test_utf8_passphrase(self):
+        request = decode_request(encode_request('pisugar', 'PiSugar', 'pässwörd'))
+        self.assertEqual(request.password, 'pässwörd')
+
+    def test_passphrase_and_psk(self):
+        with self.assertRaises(ProtocolError):
+            decode_request(tlvs((TLV_KEY, b'pisugar'), (TLV_SSID, b'PiSugar'),
+                                (TLV_PASSPHRASE, b'password'), (TLV_PSK, PSK)))
+
+    def test_short_psk(self):
+        with self.assertRaises(ProtocolError):
+            decode_request(encode_request('pisugar', 'PiSugar', psk=PSK[:31]))
+
+    def test_security_checks(self):
+        for kwargs in ({'password': 'password', 'security': SECURITY_OPEN},
+                       {'psk': PSK, 'security': SECURITY_SAE},
+                       {'security': SECURITY_WPA_PSK},
+                       {'password': 'password', 'security': 9}):
+            with self.assertRaises(ProtocolError):
+                decode_request(encode_request('pisugar', 'PiSugar', **kwargs))
+
+    def test_is_binary(self):
+        self.assertTrue(is_binary(encode_request('pisugar', 'PiSugar')))
+        self.assertFalse(is_binary(b'pisugar%&%PiSugar%&%password'))
+        self.assertFalse(is_binary(b''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import threading
+import unittest
+
+from pisugar_wifi_config.psk import PskCache, PskDeriver, derive_psk, is_passphrase
+
+# IEEE 802.11i-2004 annex H.4 test vectors
+VECTORS = [
+    ('IEEE', 'password', 'f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e'),
+    ('ThisIsASSID', 'ThisIsAPassword',
+     '0dc0d6eb90555ed6419756b9a15ec3e3209b63df707dd508d14581f8982721af'),
+]
+
+
+class DerivePskTest(unittest.TestCase):
+    def test_vectors(self):
+        for ssid, passphrase, psk in VECTORS:
+            self.assertEqual(derive_psk(ssid, passphrase), psk)
+
+    def test_utf8_passphrase(self):
+        psk = derive_psk('PiSugar', 'pässwörd')
+        self.assertEqual(len(psk), 64)
+        self.assertNotEqual(psk, derive_psk('PiSugar', 'passwort'))
+
+
+class IsPassphraseTest(unittest.TestCase):
+    def test_lengths(self):
+        self.assertFalse(is_passphrase('x' * 7))
+        self.assertTrue(is_passphrase('x' * 8))
+        self.assertTrue(is_passphrase('x' * 63))
+        self.assertFalse(is_passphrase('x' * 64))
+        self.assertFalse(is_passphrase(''))
+
+    def test_utf8_byte_length(self):
+        self.assertTrue(is_passphrase('wörter!!'))
+        # 21 characters, 63 bytes
+        self.assertTrue(is_passphrase('€' * 21))
+        self.assertFalse(is_passphrase('€' * 22))
+        # 4 characters, 8 bytes
+        self.assertTrue(is_passphrase('ää' * 2))
+        self.assertFalse(is_passphrase('äää'))
+
+    def test_control_characters(self):
+        self.assertFalse(is_passphrase('pass\nword'))
+        self.assertFalse(is_passphrase('pass\x7fword'))
+
+
+class PskDeriverTest(unittest.TestCase):
+    def derive(self, deriver, ssid, password, derive=True):
+        done = threading.Event()
+        result = []
+
+        def callback(psk):
+            result.append(psk)
+            done.set()
+        deriver.submit(ssid, password, callback, derive)
+        self.assertTrue(done.wait(5))
+        return result[0]
+
+    def test_derives_and_caches(self):
+        cache = PskCache()
+        deriver = PskDeriver(cache)
+        ssid, passphrase, psk = VECTORS[0]
+        self.assertEqual(self.derive(deriver, ssid, passphrase), psk)
+        self.assertEqual(self.derive(deriver, ssid, passphrase), psk)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_passes_other_values(self):
+        deriver = PskDeriver()
+        hex_psk = VECTORS[0][2]
+        self.assertEqual(self.derive(deriver, 'IEEE', hex_psk), hex_psk)
+        self.assertEqual(self.derive(deriver, 'IEEE', ''), '')
+        self.assertEqual(self.derive(deriver, 'IEEE', 'password', derive=False), 'password')
+
+
+class PskCacheTest(unittest.TestCase):
+    def test_lru(self):
+        cache = PskCache(maxsize=2)
+        cache.put('a', 'password', '1')
+        cache.put('b', 'password', '2')
+        cache.get('a', 'password')
+        cache.put('c', 'password', '3')
+        self.assertEqual(cache.get('a', 'password'), '1')
+        self.assertIsNone(cache.get('b', 'password'))
+
+    def test_passphrase_not_kept(self):
+        cache = PskCache()
+        cache.put('ssid', 'secret passphrase', 'psk')
+        self.assertNotIn(b'secret', b''.join(cache.entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from pisugar_wifi_config.protocol import encode_request
+from pisugar_wifi_config.reassembly import (InvalidOffset, MessageReassembler, MessageTooLong,
+                                            UnframedMessage, frame)
+
+END = b'&#&'
+
+
+class MessageReassemblerTest(unittest.TestCase):
+    def setUp(self):
+        self.reassembler = MessageReassembler(END, capacity=8, max_size=64)
+
+    def test_legacy_chunks(self):
+        self.assertEqual(self.reassembler.feed(b'key%&%'), [])
+        self.assertEqual(self.reassembler.feed(b'ssid%&%pw&'), [])
+        self.assertEqual(self.reassembler.feed(b'#&'), [b'key%&%ssid%&%pw'])
+
+    def test_end_split_across_chunks(self):
+        for chunk in (b'abc&', b'#', b'&'):
+            messages = self.reassembler.feed(chunk)
+        self.assertEqual(messages, [b'abc'])
+
+    def test_several_messages_in_one_chunk(self):
+        self.assertEqual(self.reassembler.feed(b'a&#&b&#&c'), [b'a', b'b'])
+        self.assertEqual(self.reassembler.feed(b'&#&'), [b'c'])
+
+    def test_framed(self):
+        payload = b'\x01\x02\x03&#&'
+        data = frame(payload)
+        self.assertEqual(self.reassembler.feed(data[:2]), [])
+        self.assertEqual(self.reassembler.feed(data[2:]), [payload])
+
+    def test_framed_then_legacy(self):
+        self.assertEqual(self.reassembler.feed(frame(b'xy') + b'ab&#&'), [b'xy', b'ab'])
+
+    def test_unframed_binary(self):
+        msg = encode_request('key', 'a&#&b', 'password')
+        with self.assertRaises(UnframedMessage):
+            self.reassembler.feed(msg)
+        self.assertEqual(self.reassembler.feed(frame(msg)), [msg])
+
+    def test_offsets(self):
+        self.assertEqual(self.reassembler.feed(b'abc'), [])
+        self.assertEqual(self.reassembler.feed(b'def', offset=3), [])
+        self.assertEqual(self.reassembler.feed(b'&#&', offset=6), [b'abcdef'])
+
+    def test_offsets_after_a_completed_message(self):
+        self.assertEqual(self.reassembler.feed(b'a&#&b'), [b'a'])
+        self.assertEqual(self.reassembler.feed(b'cd&#&', offset=5), [b'bcd'])
+
+    def test_offset_rewrite(self):
+        self.reassembler.feed(b'abX')
+        self.assertEqual(self.reassembler.feed(b'c&#&', offset=2), [b'abc'])
+
+    def test_offset_beyond_received(self):
+        self.reassembler.feed(b'abc')
+        with self.assertRaises(InvalidOffset):
+            self.reassembler.feed(b'x', offset=4)
+
+    def test_offset_before_buffer(self):
+        self.reassembler.feed(b'ab&#&c')
+        with self.assertRaises(InvalidOffset):
+            self.reassembler.feed(b'x', offset=1)
+
+    def test_too_long(self):
+        with self.assertRaises(MessageTooLong):
+            self.reassembler.feed(b'x' * 65)
+        self.assertEqual(self.reassembler.feed(b'a&#&'), [b'a'])
+
+    def test_frame_too_long(self):
+        with self.assertRaises(MessageTooLong):
+            self.reassembler.feed(bytes([0xfe, 0x01, 0x00]))
+
+    def test_stale_partial_message(self):
+        self.reassembler.feed(b'old', now=0)
+        self.assertEqual(self.reassembler.feed(b'new&#&', now=10), [b'new'])
+
+    def test_grows_buffer(self):
+        data = b'y' * 40
+        self.assertEqual(self.reassembler.feed(data + END), [data])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+
+from pisugar_wifi_config.scan import (BAND_5GHZ, BAND_6GHZ, FRAME_HEADER, FRAME_LAST, FRAME_RESET,
+                                      OP_ADD, OP_CHANGE, OP_REMOVE, RECORD, SEC_SAE, SEC_WPA,
+                                      SEC_WPA2, ScanEntry, ScanStream, chunk_size, decode_records,
+                                      encode_diff, encode_snapshot, scan_entry, security_flags)
+
+
+def entry(n, rssi=-50, flags=SEC_WPA2, ssid=None):
+    return ScanEntry(bytes([0x02, 0, 0, 0, 0, n]), rssi,
+                     flags, b'net%d' % n if ssid is None else ssid)
+
+
+def table(*entries):
+    return dict((e.bssid, e) for e in entries)
+
+
+class ScanEntryTest(unittest.TestCase):
+    def test_security_flags(self):
+        self.assertEqual(security_flags('[WPA2-PSK-CCMP][ESS]'), SEC_WPA2)
+        self.assertEqual(security_flags('[WPA-PSK-TKIP][WPA2-PSK-CCMP][ESS]', 5180),
+                         SEC_WPA | SEC_WPA2 | BAND_5GHZ)
+        self.assertEqual(security_flags('[RSN-SAE-CCMP][ESS]', 5955),
+                         SEC_WPA2 | SEC_SAE | BAND_6GHZ)
+        self.assertEqual(security_flags('[ESS]', 2412), 0)
+
+    def test_scan_entry(self):
+        e = scan_entry({'bssid': '02:00:00:00:00:01', 'level': '-200', 'freq': '2412',
+                        'flags': '[WPA2-PSK-CCMP]', 'ssid': 'PiSugar'})
+        self.assertEqual(e, ScanEntry(b'\x02\x00\x00\x00\x00\x01', -128, SEC_WPA2, b'PiSugar'))
+        self.assertIsNone(scan_entry({'bssid': '02:00'}))
+        self.assertIsNone(scan_entry({'level': '-50'}))
+
+
+class EncodingTest(unittest.TestCase):
+    def test_record_layout(self):
+        data = encode_snapshot(table(entry(1, -40, ssid=b'ab')))
+        self.assertEqual(data, bytes([OP_ADD, 2, 0, 0, 0, 0, 1, 0xd8, SEC_WPA2, 2]) + b'ab')
+
+    def test_snapshot_strongest_first(self):
+        entries = table(entry(1, -70), entry(2, -30), entry(3, -50))
+        records = decode_records(encode_snapshot(entries))
+        self.assertEqual([op for op, _ in records], [OP_ADD] * 3)
+        self.assertEqual([e.rssi for _, e in records], [-30, -50, -70])
+        self.assertEqual(dict((e.bssid, e) for _, e in records), entries)
+
+    def test_diff(self):
+        sent = table(entry(1), entry(2), entry(3))
+        entries = table(entry(1), entry(2, ssid=b'renamed'), entry(4))
+        records = decode_records(encode_diff(sent, entries))
+        self.assertEqual(records, [(OP_CHANGE, entry(2, ssid=b'renamed')), (OP_ADD, entry(4)),
+                                   (OP_REMOVE, entry(3).bssid)])
+        self.assertEqual(sent, entries)
+        self.assertEqual(encode_diff(sent, entries), b'')
+
+    def test_diff_rssi_step(self):
+        sent = table(entry(1, -50))
+        self.assertEqual(encode_diff(sent, table(entry(1, -55)), rssi_step=6), b'')
+        # the central keeps the entry it was sent
+        self.assertEqual(sent[entry(1).bssid].rssi, -50)
+        records = decode_records(encode_diff(sent, table(entry(1, -56)), rssi_step=6))
+        self.assertEqual(records, [(OP_CHANGE, entry(1, -56))])
+
+
+class ScanStreamTest(unittest.TestCase):
+    def frames(self, frames):
+        headers = [FRAME_HEADER.unpack(f[:FRAME_HEADER.size]) for f in frames]
+        return headers, b''.join(f[FRAME_HEADER.size:] for f in frames)
+
+    def test_snapshot_then_diffs(self):
+        stream = ScanStream()
+        entries = table(*[entry(n, -40 - n) for n in range(8)])
+        chunk = chunk_size(23)
+        self.assertEqual(chunk, 18)
+        frames = stream.update(entries, chunk)
+        headers, data = self.frames(frames)
+        self.assertTrue(all(len(f) <= 20 for f in frames))
+        self.assertEqual(headers[0], (0, FRAME_RESET))
+        self.assertEqual(headers[-1], (len(frames) - 1, FRAME_LAST))
+        self.assertEqual(data, encode_snapshot(entries))
+
+        self.assertEqual(stream.update(entries, chunk), [])
+
+        del entries[entry(0).bssid]
+        headers, data = self.frames(stream.update(entries, chunk))
+        self.assertEqual(headers, [(len(frames), FRAME_LAST)])
+        self.assertEqual(decode_records(data), [(OP_REMOVE, entry(0).bssid)])
+
+    def test_reset(self):
+        stream = ScanStream()
+        entries = table(entry(1))
+        stream.update(entries, 100)
+        stream.reset()
+        headers, data = self.frames(stream.update(entries, 100))
+        self.assertEqual(headers, [(1, FRAME_RESET | FRAME_LAST)])
+        self.assertEqual(data, encode_snapshot(entries))
+
+    def test_empty_snapshot(self):
+        self.assertEqual(ScanStream().update({}, 100),
+                         [FRAME_HEADER.pack(0, FRAME_RESET | FRAME_LAST)])
+
+    def test_records_span_frames(self):
+        entries = table(entry(1, ssid=b'x' * 32))
+        frames = ScanStream().update(entries, 10)
+        self.assertEqual(len(frames), (RECORD.size + 32 + 9) // 10)
+        self.assertEqual(self.frames(frames)[1], encode_snapshot(entries))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import socket
+import threading
+import unittest
+import zlib
+
+from pisugar_wifi_config.netinfo import NetworkState
+from pisugar_wifi_config.status import (BATTERY_UNKNOWN, STATUS, STATUS_IPV4, STATUS_LINK,
+                                        StatusBroadcast, battery_level, decode_status,
+                                        encode_status, read_battery)
+
+
+def state(ssid='PiSugar', ipv4='192.168.1.23', link='up'):
+    return NetworkState(ssid, ipv4, [], link, None)
+
+
+class EncodeStatusTest(unittest.TestCase):
+    def test_layout(self):
+        data = encode_status(state(), 100)
+        self.assertEqual(len(data), STATUS.size)
+        self.assertEqual(len(data), 6)
+        self.assertEqual(data[0], 1 << 6 | STATUS_LINK | STATUS_IPV4 | 14)
+        self.assertEqual(data[1], zlib.crc32(b'PiSugar') & 0xff)
+        self.assertEqual(data[2:], bytes([192, 168, 1, 23]))
+
+    def test_no_state(self):
+        self.assertEqual(encode_status(None), bytes([1 << 6 | BATTERY_UNKNOWN, 0, 0, 0, 0, 0]))
+
+    def test_associated_without_address(self):
+        data = encode_status(state(ipv4=None), 50)
+        self.assertEqual(data[0], 1 << 6 | STATUS_LINK | 7)
+        self.assertEqual(data[2:], bytes(4))
+
+    def test_round_trip(self):
+        self.assertEqual(decode_status(encode_status(state(), 50)), {
+            'version': 1,
+            'link': True,
+            'ipv4': '192.168.1.23',
+            'ssid_hash': zlib.crc32(b'PiSugar') & 0xff,
+            'battery': 50.0,
+        })
+        status = decode_status(encode_status(state(ssid=None, ipv4=None, link='down')))
+        self.assertEqual((status['link'], status['ipv4'], status['ssid_hash'], status['battery']),
+                         (False, None, 0, None))
+
+    def test_battery_level(self):
+        self.assertEqual(battery_level(None), BATTERY_UNKNOWN)
+        self.assertEqual(battery_level(0), 0)
+        self.assertEqual(battery_level(100), 14)
+        self.assertEqual(battery_level(150), 14)
+        self.assertEqual(battery_level(-5), 0)
+        self.assertEqual(battery_level(52), 7)
+
+
+class Advertisement(object):
+    def __init__(self):
+        self.status = None
+
+    def set_status(self, data):
+        self.status = data
+
+
+class NetworkStateCache(object):
+    def __init__(self, state):
+        self.state = state
+        self.listeners = []
+
+    def get(self):
+        return self.state
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class SyncStatusBroadcast(StatusBroadcast):
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+
+class StatusBroadcastTest(unittest.TestCase):
+    def test_applies_changes_only(self):
+        adv = Advertisement()
+        net_state = NetworkStateCache(state(ipv4=None))
+        applied = []
+        broadcast = SyncStatusBroadcast(adv, net_state, lambda: applied.append(adv.status),
+                                        battery_address=None)
+        broadcast.start()
+        # the first status is set before the advertisement is registered
+        self.assertEqual(adv.status, encode_status(state(ipv4=None)))
+        self.assertEqual(applied, [])
+
+        for listener in net_state.listeners:
+            listener(state(ipv4=None), None)
+        self.assertEqual(applied, [])
+
+        for listener in net_state.listeners:
+            listener(state(), None)
+        broadcast.set_battery(80)
+        self.assertEqual(applied, [encode_status(state()), encode_status(state(), 80)])
+
+
+class ReadBatteryTest(unittest.TestCase):
+    def serve(self, reply):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+
+        def answer():
+            conn, _ = server.accept()
+            with conn:
+                conn.recv(64)
+                conn.sendall(reply)
+            server.close()
+        threading.Thread(target=answer, daemon=True).start()
+        return server.getsockname()
+
+    def test_battery(self):
+        self.assertEqual(read_battery(self.serve(b'battery: 87.5\n')), 87.5)
+
+    def test_unexpected_reply(self):
+        self.assertIsNone(read_battery(self.serve(b'model: PiSugar 3\n')))
+
+    def test_not_running(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        address = sock.getsockname()
+        sock.close()
+        self.assertIsNone(read_battery(address))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from pisugar_wifi_config.wpa_conf import (WpaConfig, decode_ssid, psk_value, save_network,
+                                          ssid_value)
+
+PSK = 'f42c6fc52df0ebef9ebb4b90b38a5f902e83fe1b135a70e23aed762e9710a12e'
+
+CONFIG = '''ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev
+update_config=1
+country=GB
+
+# home
+network={
+\tssid="Home"
+\tpsk="homepassword"
+\tkey_mgmt=WPA-PSK
+\tpriority=3
+}
+
+network={
+    ssid=4f6666696365
+    psk="officepassword"
+    id_str="office"
+}
+'''
+
+
+class EscapingTest(unittest.TestCase):
+    def test_ssid_quoted(self):
+        self.assertEqual(ssid_value('PiSugar'), '"PiSugar"')
+        self.assertEqual(ssid_value('my wifi'), '"my wifi"')
+
+    def test_ssid_hex(self):
+        self.assertEqual(ssid_value('a"b'), '612262')
+        self.assertEqual(ssid_value('café'), '636166c3a9')
+        self.assertEqual(ssid_value('tab\t'), '74616209')
+
+    def test_decode_ssid(self):
+        for ssid in ('PiSugar', 'a"b', 'café'):
+            self.assertEqual(decode_ssid(ssid_value(ssid)), ssid)
+        self.assertEqual(decode_ssid('P"esc\\n"'), 'esc\\n')
+
+    def test_psk_value(self):
+        self.assertEqual(psk_value(PSK), PSK)
+        self.assertEqual(psk_value('password'), '"password"')
+        self.assertEqual(psk_value('pässwörd'), '"pässwörd"')
+
+    def test_psk_value_invalid(self):
+        for psk in ('short', 'x' * 64, 'new\nline!'):
+            with self.assertRaises(ValueError):
+                psk_value(psk)
+
+
+class WpaConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'wpa_supplicant.conf')
+        with open(self.path, 'w') as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_round_trip(self):
+        config = WpaConfig(self.path)
+        self.assertEqual(config.dumps(), CONFIG)
+        self.assertEqual([n.ssid for n in config.networks()], ['Home', 'Office'])
+        self.assertFalse(config.save())
+
+    def test_update_in_place(self):
+        config = WpaConfig(self.path)
+        config.upsert('Office', 'newpassword')
+        self.assertTrue(config.save())
+        text = self.read()
+        # the hex ssid, indentation and other fields are kept
+        self.assertIn('    ssid=4f6666696365\n    psk="newpassword"\n', text)
+        self.assertIn('    id_str="office"\n', text)
+        self.assertIn('\tpriority=4\n', text)
+        self.assertTrue(text.startswith(CONFIG.split('network={')[0]))
+        self.assertEqual(len(WpaConfig(self.path).networks()), 2)
+
+    def test_unchanged_network_not_saved(self):
+        config = WpaConfig(self.path)
+        config.upsert('Home', 'homepassword', priority=3)
+        self.assertFalse(config.save())
+
+    def test_add_network(self):
+        config = WpaConfig(self.path)
+        config.upsert('a"b', PSK, scan_ssid='1')
+        config.save()
+        network = WpaConfig(self.path).find('a"b')
+        self.assertEqual(network.get('ssid'), '612262')
+        self.assertEqual(network.get('psk'), PSK)
+        self.assertEqual(network.get('scan_ssid'), '1')
+        self.assertEqual(network.priority, 4)
+
+    def test_open_network(self):
+        config = WpaConfig(self.path)
+        config.upsert('Home', '')
+        network = config.find('Home')
+        self.assertEqual(network.get('key_mgmt'), 'NONE')
+        self.assertIsNone(network.get('psk'))
+
+    def test_remove(self):
+        config = WpaConfig(self.path)
+        self.assertTrue(config.remove('Home'))
+        self.assertFalse(config.remove('Home'))
+        config.save()
+        text = self.read()
+        self.assertNotIn('Home', text)
+        self.assertIn('country=GB\n\n# home\n\nnetwork={\n    ssid=4f6666696365', text)
+
+    def test_set_global(self):
+        config = WpaConfig(self.path)
+        config.set_global('update_config', '0')
+        self.assertFalse(config.changed)
+        config.set_global('ap_scan', '1')
+        self.assertEqual(config.get_global('ap_scan'), '1')
+
+    def test_save_keeps_mode(self):
+        os.chmod(self.path, 0o640)
+        save_network(self.path, 'New', 'password')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        self.assertEqual(os.listdir(self.directory), ['wpa_supplicant.conf'])
+
+    def test_new_file(self):
+        path = os.path.join(self.directory, 'new.conf')
+        self.assertTrue(save_network(path, 'PiSugar', 'password'))
+        self.assertEqual(WpaConfig(path).find('PiSugar').get('psk'), '"password"')
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+
+
+if __name__ == '__main__':
+    unittest.main()